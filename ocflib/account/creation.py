@@ -1,7 +1,8 @@
 import os
 import subprocess
+import threading
 from collections import namedtuple
-from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timezone
 from grp import getgrnam
@@ -10,29 +11,26 @@ from subprocess import call
 from Crypto.Cipher import PKCS1_OAEP
 from Crypto.PublicKey import RSA
 
+from ocflib.account.screening import BAD_WORDS  # noqa
+from ocflib.account.screening import RESTRICTED_WORDS  # noqa
+from ocflib.account.screening import screen_username
 import ocflib.account.search as search
 import ocflib.account.utils as utils
 import ocflib.account.validators as validators
 from ocflib.infra.kerberos import create_kerberos_principal_with_keytab
 from ocflib.infra.kerberos import get_kerberos_principal_with_keytab
+from ocflib.infra.kerberos import principals_exist
+from ocflib.infra.ldap import create_ldap_entries
 from ocflib.infra.ldap import create_ldap_entry
 from ocflib.infra.ldap import ldap_ocf
 from ocflib.infra.ldap import OCF_LDAP_PEOPLE
-from ocflib.misc.mail import jinja_mail_env
-from ocflib.misc.mail import send_mail
+from ocflib.misc.mail import queue_mail
+from ocflib.misc.mail import render_mail_template
 from ocflib.misc.validators import valid_email
 from ocflib.printing.quota import SEMESTERLY_QUOTA
 
 
 _KNOWN_UID = 105749
-BAD_WORDS = frozenset((
-    'anal', 'anus', 'arse', 'ass', 'bastard', 'bitch', 'biatch', 'bloody', 'blowjob', 'bollock',
-    'bollok', 'boner', 'chink', 'clit', 'cock', 'coon', 'cunt', 'damn', 'dick', 'dildo', 'douche',
-    'dyke', 'fag', 'fellate', 'fellatio', 'felching', 'fuck', 'flange', 'hell', 'homo', 'jerk', 'jizz', 'kike',
-    'labia', 'muff', 'nigger', 'nigga', 'penis', 'piss', 'prick', 'pube', 'pussy', 'queer', 'scrotum',
-    'sex', 'shit', 'slut', 'smegma', 'terrorist', 'twat', 'vagina', 'wank', 'whore'
-))
-RESTRICTED_WORDS = frozenset(('ocf', 'ucb', 'berkeley', 'university'))
 
 CREATE_PUBLIC_KEY = '''\
 -----BEGIN PUBLIC KEY-----
@@ -103,20 +101,161 @@ def _get_first_available_uid(known_uid=_KNOWN_UID):
     return next_uid
 
 
-def create_account(request, creds, report_status, known_uid=_KNOWN_UID):
+def _uid_block(first_uid, count):
+    """Return count UIDs counting up from first_uid, skipping reserved and
+    ignored ranges."""
+    uids = []
+    uid = first_uid
+    while len(uids) < count:
+        for start, end in sorted(RESERVED_UID_RANGES + IGNORED_UID_RANGES):
+            if start <= uid <= end:
+                uid = end + 1
+        uids.append(uid)
+        uid += 1
+    return uids
+
+
+def create_account(request, creds, report_status, known_uid=_KNOWN_UID, reserve_uid=None):
     """Create an account as idempotently as possible.
 
+    Creation happens in stages (see the create_* functions below); only
+    reserving a UID needs to be serialized across concurrent creations.
+
     :param known_uid: where to start searching for unused UIDs (see
         _get_first_available_uid)
-    :return: the UID of the newly created account
+    :param reserve_uid: function returning a UID which no other creation will
+        use; defaults to the first available UID starting from known_uid
+    :return: the UID of the account
+    """
+    if reserve_uid is None:
+        def reserve_uid():
+            return _get_first_available_uid(known_uid)
+
+    create_account_principal(request, creds, report_status)
+    uid = create_account_entry(request, creds, report_status, reserve_uid)
+    create_account_dirs(request, report_status)
+    send_created_mail(request)
+    # TODO: logging to syslog, files
+
+    return uid
+
+
+def create_accounts(requests, creds, report_status, reserve_uids):
+    """Create many accounts at once.
+
+    This goes through the same stages as create_account, but reserves a
+    single block of UIDs and creates all of the LDAP entries with one call
+    to ldapmodify. A failure creating one account doesn't stop the others,
+    and a failure in a stage shared by the whole batch (e.g. reserving UIDs)
+    fails every account which wasn't finished yet, rather than raising.
+
+    :param report_status: function taking a username and returning the
+        report_status to use for that request (see create_account)
+    :param reserve_uids: function taking a count and returning that many UIDs
+        which no other creation will use
+    :return: dict mapping each username to its UID, or to the exception
+        raised while creating the account
     """
-    # TODO: better docstring
+    results = {}
+
+    def fail(request, ex):
+        report_status(request.user_name)('Failed: {}'.format(ex))
+        results[request.user_name] = ex
+
+    try:
+        _create_accounts(requests, creds, report_status, reserve_uids, results, fail)
+    except Exception as ex:
+        for request in requests:
+            if not isinstance(results.get(request.user_name), Exception):
+                fail(request, ex)
+    return results
+
 
-    if get_kerberos_principal_with_keytab(
-        request.user_name,
+def _create_accounts(requests, creds, report_status, reserve_uids, results, fail):
+    def run(request, stage, *args):
+        try:
+            stage(request, *args)
+        except Exception as ex:
+            fail(request, ex)
+
+    existing_principals = principals_exist(
+        (request.user_name for request in requests),
         creds.kerberos_keytab,
         creds.kerberos_principal,
-    ):
+    )
+    for request in requests:
+        run(
+            request,
+            create_account_principal,
+            creds,
+            report_status(request.user_name),
+            request.user_name in existing_principals,
+        )
+
+    remaining = [request for request in requests if request.user_name not in results]
+    existing = search.existing_users(request.user_name for request in remaining)
+    for request in remaining:
+        if request.user_name in existing:
+            report_status(request.user_name)('LDAP entry already exists; skipping creation')
+            results[request.user_name] = int(search.user_attrs(request.user_name)['uidNumber'])
+
+    new = [request for request in remaining if request.user_name not in existing]
+    uids = reserve_uids(len(new))
+    for request, uid in zip(new, uids):
+        report_status(request.user_name)('Reserved UID {}'.format(uid))
+
+    errors = create_ldap_entries(
+        [
+            (utils.dn_for_username(request.user_name), account_entry_attrs(request, uid))
+            for request, uid in zip(new, uids)
+        ],
+        keytab=creds.kerberos_keytab,
+        admin_principal=creds.kerberos_principal,
+    )
+    for request, uid, error in zip(new, uids, errors):
+        if error is not None and _entry_added_by_batch(request, uid, error):
+            error = None
+
+        if error is None:
+            report_status(request.user_name)('Created LDAP entry')
+            results[request.user_name] = uid
+        else:
+            fail(request, error)
+
+    if new:
+        # invalidate passwd cache so that we can immediately chown files
+        call(('sudo', 'nscd', '-i', 'passwd'))
+
+    for request in requests:
+        if not isinstance(results[request.user_name], Exception):
+            run(request, create_account_dirs, report_status(request.user_name))
+        if not isinstance(results[request.user_name], Exception):
+            run(request, send_created_mail)
+
+
+def _entry_added_by_batch(request, uid, error):
+    """Return whether an LDAP entry which create_ldap_entries reported as a
+    duplicate is the one we tried to add (i.e. it has the UID reserved for
+    it), meaning the batch added it before failing on a later entry."""
+    if str(error) != 'Tried to create duplicate entry.':
+        return False
+    attrs = search.user_attrs(request.user_name)
+    return attrs is not None and int(attrs['uidNumber']) == uid
+
+
+def create_account_principal(request, creds, report_status, exists=None):
+    """Create the Kerberos principal for a new account, unless it exists.
+
+    :param exists: whether the principal is already known to exist (e.g.
+                   from principals_exist); if None, kadmin is asked
+    """
+    if exists is None:
+        exists = get_kerberos_principal_with_keytab(
+            request.user_name,
+            creds.kerberos_keytab,
+            creds.kerberos_principal,
+        )
+    if exists:
         report_status('kerberos principal already exists; skipping creation')
     else:
         with report_status('Creating', 'Created', 'Kerberos keytab'):
@@ -126,56 +265,68 @@ def create_account(request, creds, report_status, known_uid=_KNOWN_UID):
                 creds.kerberos_principal,
                 password=decrypt_password(
                     request.encrypted_password,
-                    RSA.importKey(open(creds.encryption_key).read()),
+                    load_encryption_key(creds.encryption_key),
                 ),
             )
 
-    if search.user_attrs(request.user_name):
-        report_status('LDAP entry already exists; skipping creation')
+
+def account_entry_attrs(request, uid):
+    """Return the LDAP attributes for a new account's entry."""
+    attrs = {
+        'objectClass': ['ocfAccount', 'account', 'posixAccount'],
+        'cn': [request.real_name],
+        'uidNumber': uid,
+        'gidNumber': getgrnam('ocf').gr_gid,
+        'homeDirectory': utils.home_dir(request.user_name),
+        'loginShell': '/bin/bash',
+        'ocfEmail': request.user_name + '@ocf.berkeley.edu',
+        'mail': [request.email],
+        'userPassword': '{SASL}' + request.user_name + '@OCF.BERKELEY.EDU',
+        'creationTime': datetime.now(timezone.utc).astimezone(),
+    }
+    if request.calnet_uid:
+        attrs['calnetUid'] = request.calnet_uid
     else:
-        with report_status('Finding', 'Found', 'first available UID'):
-            new_uid = _get_first_available_uid(known_uid)
-
-        dn = utils.dn_for_username(request.user_name)
-        attrs = {
-            'objectClass': ['ocfAccount', 'account', 'posixAccount'],
-            'cn': [request.real_name],
-            'uidNumber': new_uid,
-            'gidNumber': getgrnam('ocf').gr_gid,
-            'homeDirectory': utils.home_dir(request.user_name),
-            'loginShell': '/bin/bash',
-            'ocfEmail': request.user_name + '@ocf.berkeley.edu',
-            'mail': [request.email],
-            'userPassword': '{SASL}' + request.user_name + '@OCF.BERKELEY.EDU',
-            'creationTime': datetime.now(timezone.utc).astimezone(),
-        }
-        if request.calnet_uid:
-            attrs['calnetUid'] = request.calnet_uid
-        else:
-            attrs['callinkOid'] = request.callink_oid
-
-        with report_status('Creating', 'Created', 'LDAP entry'):
-            create_ldap_entry(
-                dn,
-                attrs,
-                keytab=creds.kerberos_keytab,
-                admin_principal=creds.kerberos_principal,
-            )
+        attrs['callinkOid'] = request.callink_oid
+    return attrs
+
 
-            # invalidate passwd cache so that we can immediately chown files
-            # XXX: sometimes this fails, but that's okay because it means
-            # nscd isn't running anyway
-            call(('sudo', 'nscd', '-i', 'passwd'))
+def create_account_entry(request, creds, report_status, reserve_uid):
+    """Create the LDAP entry for a new account, unless it exists.
 
+    :param reserve_uid: function returning the UID to use
+    :return: the UID of the account
+    """
+    existing = search.user_attrs(request.user_name)
+    if existing:
+        report_status('LDAP entry already exists; skipping creation')
+        return int(existing['uidNumber'])
+
+    with report_status('Reserving', 'Reserved', 'first available UID'):
+        uid = reserve_uid()
+
+    with report_status('Creating', 'Created', 'LDAP entry'):
+        create_ldap_entry(
+            utils.dn_for_username(request.user_name),
+            account_entry_attrs(request, uid),
+            keytab=creds.kerberos_keytab,
+            admin_principal=creds.kerberos_principal,
+        )
+
+        # invalidate passwd cache so that we can immediately chown files
+        # XXX: sometimes this fails, but that's okay because it means
+        # nscd isn't running anyway
+        call(('sudo', 'nscd', '-i', 'passwd'))
+
+    return uid
+
+
+def create_account_dirs(request, report_status):
+    """Create the home and web directories for a new account."""
     with report_status('Creating', 'Created', 'home and web directories'):
         create_home_dir(request.user_name)
         ensure_web_dir(request.user_name)
 
-    send_created_mail(request)
-    # TODO: logging to syslog, files
-
-    return new_uid
-
 
 def create_home_dir(user):
     """Create home directory for user with appropriate permissions."""
@@ -221,20 +372,21 @@ def ensure_web_dir(user):
 
 
 def send_created_mail(request):
-    body = jinja_mail_env.get_template(
+    body = render_mail_template(
         'account/mail_templates/account-created.jinja',
-    ).render(
         request=request,
         semesterly_quota=SEMESTERLY_QUOTA,
     )
-    send_mail(request.email, '[OCF] Your account has been created!', body)
+    queue_mail(request.email, '[OCF] Your account has been created!', body)
 
 
 def send_rejected_mail(request, reason):
-    body = jinja_mail_env.get_template(
+    body = render_mail_template(
         'account/mail_templates/account-rejected.jinja',
-    ).render(request=request, reason=reason)
-    send_mail(request.email, '[OCF] Your account request has been rejected', body)
+        request=request,
+        reason=reason,
+    )
+    queue_mail(request.email, '[OCF] Your account request has been rejected', body)
 
 
 class ValidationWarning(Exception):
@@ -357,18 +509,11 @@ def validate_username(username, realname):
     if search.user_exists(username):
         raise ValidationError('Username {} already exists.'.format(username))
 
-    try:
-        validators.validate_username(username)
-    except ValueError as ex:
-        raise ValidationError(str(ex))
-
-    for word in BAD_WORDS:
-        if word in username:
-            raise ValidationWarning('Username {} contains bad word: {}'.format(username, word))
-
-    for word in RESTRICTED_WORDS:
-        if word in username:
-            raise ValidationWarning('Username {} contains restricted word: {}'.format(username, word))
+    result = screen_username(username, report=True)
+    if result.error is not None:
+        raise ValidationError(result.error)
+    if result.warning is not None:
+        raise ValidationWarning(result.warning)
 
 
 def validate_email(email):
@@ -383,6 +528,52 @@ def validate_password(username, password):
         raise ValidationError(str(ex))
 
 
+_KeyMaterial = namedtuple('_KeyMaterial', ('mtime', 'key'))
+_key_cache = {}
+_cipher_cache = {}
+_CIPHER_CACHE_SIZE = 16
+_cache_lock = threading.Lock()
+
+
+def load_encryption_key(path):
+    """Return the RSA key stored at path.
+
+    Parsed keys are cached per process (so across Celery tasks) and only
+    re-read when the file's mtime changes.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _key_cache.get(path)
+    if cached is not None and cached.mtime == mtime:
+        return cached.key
+
+    with _cache_lock:
+        cached = _key_cache.get(path)
+        if cached is None or cached.mtime != mtime:
+            with open(path) as f:
+                cached = _KeyMaterial(mtime, RSA.importKey(f.read()))
+            _key_cache[path] = cached
+        return cached.key
+
+
+def _cipher(key):
+    """Return a PKCS1_OAEP cipher for the key, reusing one if possible.
+
+    The ciphers keep no per-message state, so they can be shared between
+    threads.
+    """
+    cached = _cipher_cache.get(id(key))
+    if cached is not None and cached[0] is key:
+        return cached[1]
+
+    cipher = PKCS1_OAEP.new(key)
+    with _cache_lock:
+        if len(_cipher_cache) >= _CIPHER_CACHE_SIZE:
+            _cipher_cache.clear()
+        # keep a reference to the key so its id can't be reused while cached
+        _cipher_cache[id(key)] = (key, cipher)
+    return cipher
+
+
 def encrypt_password(password, pubkey):
     """Encrypts (not hashes) a user password to be stored on disk while it
     awaits approval.
@@ -393,65 +584,83 @@ def encrypt_password(password, pubkey):
     >>> open("private.pem", "w").write(key.exportKey())
     >>> open("public.pem", "w").write(key.publickey().exportKey())
     """
-    RSA_CIPHER = PKCS1_OAEP.new(pubkey)
-    return RSA_CIPHER.encrypt(password.encode('ascii'))
+    return _cipher(pubkey).encrypt(password.encode('ascii'))
 
 
 def decrypt_password(password, privkey):
     """Decrypts a user password."""
-    RSA_CIPHER = PKCS1_OAEP.new(privkey)
-    return RSA_CIPHER.decrypt(password).decode('ascii')
+    return _cipher(privkey).decrypt(password).decode('ascii')
 
 
-def validate_request(request, credentials, session):
-    """Validate a request, returning lists of errors and warnings."""
-    from ocflib.account.submission import username_pending
-    from ocflib.account.submission import user_has_request_pending
+def _run_validation_section(section):
+    """Run a validation section, returning its (errors, warnings)."""
+    try:
+        section()
+    except ValidationWarning as ex:
+        return [], [str(ex)]
+    except ValidationError as ex:
+        return [str(ex)], []
+    return [], []
 
-    errors, warnings = [], []
 
-    @contextmanager
-    def validate_section():
-        try:
-            yield
-        except ValidationWarning as ex:
-            warnings.append(str(ex))
-        except ValidationError as ex:
-            errors.append(str(ex))
+def validate_request(request, credentials, session, stored=False):
+    """Validate a request, returning lists of errors and warnings.
+
+    The sections are independent and mostly wait on the network (LDAP, DNS),
+    so they run concurrently; errors and warnings are still reported in
+    section order.
+
+    :param stored: whether the request is a stored request being approved, so
+                   its own row doesn't count as a pending request
+    """
+    from ocflib.account.submission import request_pending
+
+    # sessions can't be shared between threads, so the (local, fast) pending
+    # request checks happen up front
+    name_pending, owner_pending = request_pending(session, request, stored=stored)
 
     # TODO: figure out where to sanitize real_name
 
-    # user name
-    with validate_section():
-        if username_pending(session, request):
+    def validate_name():
+        if name_pending:
             raise ValidationError('Username {} has already been requested.'.format(
                 request.user_name,
             ))
 
         validate_username(request.user_name, request.real_name)
 
-    # calnet uid / callink oid
-    with validate_section():
+    def validate_owner():
         if request.is_group:
             validate_callink_oid(request.callink_oid)
         else:
             validate_calnet_uid(request.calnet_uid)
 
-        if user_has_request_pending(session, request):
+        if owner_pending:
             raise ValidationError('You have already requested an account.')
 
-    # email
-    with validate_section():
+    def validate_request_email():
         validate_email(request.email)
 
-    # password
-    with validate_section():
+    def validate_request_password():
         password = decrypt_password(
             request.encrypted_password,
-            RSA.importKey(open(credentials.encryption_key).read()),
+            load_encryption_key(credentials.encryption_key),
         )
         validate_password(request.user_name, password)
 
+    sections = (
+        validate_name,
+        validate_owner,
+        validate_request_email,
+        validate_request_password,
+    )
+    with ThreadPoolExecutor(max_workers=len(sections)) as executor:
+        results = list(executor.map(_run_validation_section, sections))
+
+    errors, warnings = [], []
+    for section_errors, section_warnings in results:
+        errors.extend(section_errors)
+        warnings.extend(section_warnings)
     return errors, warnings
 
 
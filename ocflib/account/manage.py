@@ -9,6 +9,7 @@ import ocflib.account.search as search
 import ocflib.account.utils as utils
 import ocflib.account.validators as validators
 import ocflib.infra.ldap as ldap_ocf
+from ocflib.infra.kerberos import kadmin_session
 import ocflib.misc as misc
 import ocflib.misc.mail as mail
 
@@ -63,25 +64,14 @@ def change_password_with_keytab(username, password, keytab, principal, comment=N
     validators.validate_username(username, check_exists=True)
     validators.validate_password(username, password)
 
-    # try changing using kadmin pexpect
-    cmd = '{kadmin_path} -K {keytab} -p {principal} cpw {username}'.format(
-        kadmin_path=shlex.quote(KADMIN_PATH),
-        keytab=shlex.quote(keytab),
-        principal=shlex.quote(principal),
-        username=shlex.quote(username))
-
-    child = pexpect.spawn(cmd, timeout=10)
-
-    child.expect("{}@OCF.BERKELEY.EDU's Password:".format(username))
-    child.sendline(password)
-    child.expect("Verify password - {}@OCF.BERKELEY.EDU's Password:"
-                 .format(username))
-    child.sendline(password)
-
-    child.expect(pexpect.EOF)
-
-    output = child.before.decode('utf8')
-    if 'kadmin' in output:
+    output = kadmin_session(keytab, principal).run(
+        'cpw {}'.format(username),
+        (
+            ("{}@OCF.BERKELEY.EDU's Password:".format(username), password),
+            ("Verify password - {}@OCF.BERKELEY.EDU's Password:".format(username), password),
+        ),
+    )
+    if output:
         raise ValueError('kadmin Error: {}'.format(output))
 
     _notify_password_change(username, comment=comment)
@@ -138,4 +128,4 @@ If you're not sure why this happened, please reply to this email ASAP.
         comment_line=('\n' + comment + '\n') if comment else '',
     )
 
-    mail.send_mail_user(username, '[OCF] Account password changed', body)
+    mail.queue_mail_user(username, '[OCF] Account password changed', body)
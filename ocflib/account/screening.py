@@ -0,0 +1,172 @@
+"""Screening usernames against the bad and restricted word lists.
+
+Each word list is compiled once into an Aho-Corasick automaton, so checking a
+username takes time proportional to its length no matter how many words are
+listed. Screening doesn't touch LDAP or send problem reports, which makes it
+cheap enough to run over many candidate usernames at once (e.g. when
+suggesting usernames).
+"""
+import unicodedata
+from collections import deque
+from collections import namedtuple
+
+import ocflib.account.validators as validators
+
+BAD_WORDS = frozenset((
+    'anal', 'anus', 'arse', 'ass', 'bastard', 'bitch', 'biatch', 'bloody', 'blowjob', 'bollock',
+    'bollok', 'boner', 'chink', 'clit', 'cock', 'coon', 'cunt', 'damn', 'dick', 'dildo', 'douche',
+    'dyke', 'fag', 'fellate', 'fellatio', 'felching', 'fuck', 'flange', 'hell', 'homo', 'jerk', 'jizz', 'kike',
+    'labia', 'muff', 'nigger', 'nigga', 'penis', 'piss', 'prick', 'pube', 'pussy', 'queer', 'scrotum',
+    'sex', 'shit', 'slut', 'smegma', 'terrorist', 'twat', 'vagina', 'wank', 'whore'
+))
+RESTRICTED_WORDS = frozenset(('ocf', 'ucb', 'berkeley', 'university'))
+
+
+class WordMatcher:
+    """Aho-Corasick automaton for finding any of a set of words in a string."""
+
+    def __init__(self, words):
+        self.words = frozenset(words)
+
+        # state 0 is the root; each state has a dict of transitions, a failure
+        # link, and the words ending at that state, longest first
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+
+        for word in self.words:
+            state = 0
+            for char in word:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state] = (word,)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+
+                # words ending at the failure state (suffixes of this one)
+                # also end here
+                self._output[child] += self._output[self._fail[child]]
+
+    def _matches(self, text):
+        """Yield the words ending at each position of the text, in order."""
+        state = 0
+        for char in text:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            if self._output[state]:
+                yield self._output[state]
+
+    def find(self, text):
+        """Return the word which ends first in the text (the longest, if
+        several end at the same place), or None."""
+        for words in self._matches(text):
+            return words[0]
+
+    def find_all(self, text):
+        """Return the set of all words found in the text."""
+        return {word for words in self._matches(text) for word in words}
+
+    def __contains__(self, text):
+        return self.find(text) is not None
+
+
+BAD_WORD_MATCHER = WordMatcher(BAD_WORDS)
+RESTRICTED_WORD_MATCHER = WordMatcher(RESTRICTED_WORDS)
+
+
+class ScreeningResult(namedtuple('ScreeningResult', ('username', 'error', 'warning'))):
+    """Outcome of screening a username.
+
+    `error` is set if the username can't be used at all (e.g. it's reserved or
+    malformed); `warning` is set if it needs staff approval.
+    """
+
+    @property
+    def ok(self):
+        return self.error is None and self.warning is None
+
+
+def _name_parts(real_name):
+    """Split a real name into lowercase ASCII letter-only parts."""
+    ascii_name = unicodedata.normalize('NFKD', real_name).encode('ascii', 'ignore').decode('ascii')
+    parts = (''.join(c for c in part if c.isalpha()) for part in ascii_name.lower().split())
+    return [part for part in parts if part]
+
+
+def username_candidates(real_name):
+    """Return a list of plausible usernames for a real name, best first.
+
+    Candidates aren't screened or checked for availability.
+    """
+    parts = _name_parts(real_name)
+    if not parts:
+        return []
+
+    first, last = parts[0], parts[-1]
+    middle_initials = ''.join(part[0] for part in parts[1:-1])
+    candidates = [
+        first[0] + last,
+        first + last,
+        first,
+        first + last[0],
+        first[0] + middle_initials + last,
+        last + first[0],
+        last,
+        last + first,
+        ''.join(parts),
+    ]
+    candidates.extend(first[:i] + last for i in range(2, len(first)))
+    candidates.extend(first + last[:i] for i in range(2, len(last)))
+    candidates.extend(first[0] + last[:i] for i in range(len(last) - 1, 1, -1))
+
+    seen = set()
+    unique = []
+    for candidate in candidates:
+        candidate = candidate[:16]
+        if len(candidate) >= 3 and candidate not in seen:
+            seen.add(candidate)
+            unique.append(candidate)
+    return unique
+
+
+def screen_username(username, report=False):
+    """Screen a single username, returning a ScreeningResult.
+
+    This doesn't check whether the username is already taken. By default it
+    doesn't send problem reports either (candidates clashing with local users
+    are just rejected); pass report=True when screening a real request.
+    """
+    try:
+        validators.validate_username(username, report=report)
+    except ValueError as ex:
+        return ScreeningResult(username, str(ex), None)
+
+    word = BAD_WORD_MATCHER.find(username)
+    if word is not None:
+        return ScreeningResult(username, None, 'Username {} contains bad word: {}'.format(username, word))
+
+    word = RESTRICTED_WORD_MATCHER.find(username)
+    if word is not None:
+        return ScreeningResult(username, None, 'Username {} contains restricted word: {}'.format(username, word))
+
+    return ScreeningResult(username, None, None)
+
+
+def screen_usernames(usernames):
+    """Screen many usernames, returning a list of ScreeningResults in the same
+    order."""
+    return [screen_username(username) for username in usernames]
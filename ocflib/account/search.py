@@ -21,6 +21,19 @@ def users_by_filter(ldap_filter):
         return [entry['attributes']['uid'][0] for entry in c.response]
 
 
+def existing_users(usernames):
+    """Returns the set of the given usernames which are OCF accounts.
+
+    All usernames are checked with a single LDAP search."""
+    usernames = set(usernames)
+    if not usernames:
+        return set()
+    return set(users_by_filter('(|{})'.format(''.join(
+        '(uid={})'.format(escape_filter_chars(username))
+        for username in sorted(usernames)
+    )))) & usernames
+
+
 def users_by_calnet_uid(calnet_uid):
     """Get a list of users associated with a CalNet UID"""
     calnet_uid = int(calnet_uid)
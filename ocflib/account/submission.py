@@ -23,6 +23,8 @@ appropriate broker and backend URL (probably Redis).
     # result.id and fetch it later.
 """
 import datetime
+import functools
+import os
 import socket
 from collections import namedtuple
 from contextlib import contextmanager
@@ -30,27 +32,48 @@ from contextlib import contextmanager
 import redis
 import sqlalchemy.exc
 from redis.exceptions import LockError
+from sqlalchemy import and_
 from sqlalchemy import Boolean
 from sqlalchemy import Column
 from sqlalchemy import create_engine
 from sqlalchemy import Integer
 from sqlalchemy import LargeBinary
+from sqlalchemy import literal
 from sqlalchemy import String
 from sqlalchemy import Text
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import NullPool
 from sqlalchemy.sql import exists
 
+from ocflib.account.creation import _get_first_available_uid
+from ocflib.account.creation import _KNOWN_UID
+from ocflib.account.creation import _uid_block
 from ocflib.account.creation import create_account as real_create_account
+from ocflib.account.creation import create_accounts as real_create_accounts
 from ocflib.account.creation import NewAccountRequest
 from ocflib.account.creation import send_rejected_mail
 from ocflib.account.creation import validate_request
 from ocflib.account.manage import change_password_with_keytab
+from ocflib.account.screening import screen_usernames
+from ocflib.account.screening import username_candidates
+from ocflib.account.search import existing_users
+from ocflib.misc.mail import mail_queue
 
 
 Base = declarative_base()
 
+SUGGESTIONS = 5
+
+# Defaults for the engine used by submission tasks. These are added to (or
+# overridden by) get_tasks(..., engine_options={...}), e.g. to set pool_size
+# or max_overflow for the default connection pool.
+ENGINE_OPTIONS = {
+    # MySQL drops idle connections (wait_timeout), so check connections
+    # before use and replace them well before they'd time out
+    'pool_pre_ping': True,
+    'pool_recycle': 3600,
+}
+
 
 def username_pending(session, request):
     """Returns whether the username is currently pending creation."""
@@ -59,21 +82,155 @@ def username_pending(session, request):
     )).scalar()
 
 
+def _owner_pending_clause(request):
+    """Returns a clause matching stored requests from the same owner as the
+    request, or None if the owner may have any number of requests."""
+    if request.is_group and request.callink_oid != 0:
+        return StoredNewAccountRequest.callink_oid == request.callink_oid
+    elif not request.is_group:
+        return StoredNewAccountRequest.calnet_uid == request.calnet_uid
+
+
 def user_has_request_pending(session, request):
     """Returns whether the user has an account request pending.
     Checks based on CalNet UID / CalLink OID.
     """
-    query = None
-    if request.is_group and request.callink_oid != 0:
-        query = StoredNewAccountRequest.callink_oid == request.callink_oid
-    elif not request.is_group:
-        query = StoredNewAccountRequest.calnet_uid == request.calnet_uid
+    query = _owner_pending_clause(request)
     return (
         query is not None and
         session.query(exists().where(query)).scalar()
     )
 
 
+def request_pending(session, request, stored=False):
+    """Returns a (username_pending, user_has_request_pending) tuple for a
+    request, using a single query.
+
+    :param stored: whether the request is itself a stored request (e.g. one
+                   being approved), in which case its own row doesn't count
+    """
+    owner = _owner_pending_clause(request)
+    if stored and owner is not None:
+        owner = and_(owner, StoredNewAccountRequest.user_name != request.user_name)
+
+    name_pending, owner_pending = session.query(
+        exists().where(StoredNewAccountRequest.user_name == request.user_name) if not stored else literal(False),
+        exists().where(owner) if owner is not None else literal(False),
+    ).one()
+    return bool(name_pending), bool(owner_pending)
+
+
+def usernames_pending(session, usernames):
+    """Returns the set of the given usernames currently pending creation."""
+    usernames = set(usernames)
+    if not usernames:
+        return set()
+    return {
+        user_name for user_name, in session.query(StoredNewAccountRequest.user_name).filter(
+            StoredNewAccountRequest.user_name.in_(usernames),
+        )
+    }
+
+
+def username_suggestions(session, real_name, n=SUGGESTIONS):
+    """Returns up to n available usernames for a real name, best first.
+
+    Candidates are screened locally first, then the rest are checked against
+    LDAP and pending requests with one query each. Usernames which would need
+    staff approval (e.g. because of a restricted word) aren't suggested.
+    """
+    candidates = [
+        result.username
+        for result in screen_usernames(username_candidates(real_name))
+        if result.ok
+    ]
+    taken = existing_users(candidates) | usernames_pending(session, candidates)
+    return [candidate for candidate in candidates if candidate not in taken][:n]
+
+
+def _creation_lock_names(request):
+    """Return the names of the locks to hold while creating an account for the
+    request, in the order they should be acquired."""
+    names = {'user:' + request.user_name}
+    if request.is_group and request.callink_oid:
+        names.add('callink_oid:{}'.format(request.callink_oid))
+    elif not request.is_group and request.calnet_uid:
+        names.add('calnet_uid:{}'.format(request.calnet_uid))
+    return sorted(names)
+
+
+def reserve_uids(r, count):
+    """Reserve a block of count available UIDs, using the given Redis
+    connection.
+
+    The last reserved UID is stored in Redis as `known_uid`, so later
+    reservations skip UIDs whose LDAP entries haven't been created yet. This
+    is the only part of account creation which is serialized, and it holds
+    the lock just long enough for one LDAP search.
+    """
+    if count == 0:
+        return []
+
+    with r.lock('ocflib.account.submission.reserve_uid', timeout=60, blocking_timeout=60):
+        known_uid = r.get('known_uid')
+        uids = _uid_block(
+            _get_first_available_uid(int(known_uid) if known_uid else _KNOWN_UID),
+            count,
+        )
+        r.set('known_uid', uids[-1])
+        return uids
+
+
+def reserve_uid(r):
+    """Reserve the first available UID (see reserve_uids)."""
+    return reserve_uids(r, 1)[0]
+
+
+def _flushes_mail(f):
+    """Decorate a task to deliver any mail it queued before it returns.
+
+    Queued mail otherwise waits in memory for the mail queue's background
+    thread or atexit handler, and Celery's prefork worker processes can exit
+    without either getting to it.
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        finally:
+            mail_queue.flush()
+    return wrapper
+
+
+def _status_reporter(status, update):
+    """Return a report_status for account creation which appends lines to
+    the status list and then calls update.
+
+    report_status('line') reports a single line, and
+    `with report_status('Creating', 'Created', 'thing'):` reports the start
+    and end of a step.
+    """
+    class report_status:
+
+        def __init__(self, *args):
+            if len(args) == 1:
+                self(*args)
+            else:
+                self.start, self.stop, self.task = args
+
+        def __call__(self, line):
+            status.append(line)
+            update()
+
+        def __enter__(self, *args):
+            self(self.start + ' ' + self.task)
+
+        def __exit__(self, *args):
+            self(self.stop + ' ' + self.task)
+
+    return report_status
+
+
 class StoredNewAccountRequest(Base):
     """SQLAlchemy object for holding account requests."""
 
@@ -144,18 +301,32 @@ class NewAccountResponse(namedtuple('NewAccountResponse', [
     REJECTED = 'rejected'
 
 
-def get_tasks(celery_app, credentials=None):
-    """Return Celery tasks instantiated against the provided instance."""
+def get_tasks(celery_app, credentials=None, engine_options=None):
+    """Return Celery tasks instantiated against the provided instance.
+
+    :param engine_options: keyword arguments for create_engine, overriding
+                           ENGINE_OPTIONS
+    """
     # mysql, for stored account requests
+    engine = None
+    engine_pid = None
     Session = None
 
     @contextmanager
     def get_session():
-        nonlocal Session
-        if Session is None:
-            Session = sessionmaker(
-                create_engine(credentials.mysql_uri, poolclass=NullPool),
+        nonlocal engine, engine_pid, Session
+        # Each process gets its own engine. Celery's prefork workers inherit
+        # the parent's pool, whose connections must not be shared, so drop
+        # them (without closing them out from under the parent).
+        if engine is None or engine_pid != os.getpid():
+            if engine is not None:
+                engine.dispose(close=False)
+            engine = create_engine(
+                credentials.mysql_uri,
+                **dict(ENGINE_OPTIONS, **(engine_options or {}))
             )
+            engine_pid = os.getpid()
+            Session = sessionmaker(engine)
         session = Session()
         try:
             yield session
@@ -172,7 +343,7 @@ def get_tasks(celery_app, credentials=None):
         """First run validation, then create.
 
         This is handy because this task runs quickly, so you can wait for it to
-        finish (unlike create_account, which is slow and uses a global lock).
+        finish (unlike create_account, which is slow).
 
         If this task succeeds, it will launch create_account, and returns you
         the new task ID.
@@ -225,35 +396,33 @@ def get_tasks(celery_app, credentials=None):
         return create_account.delay(request).id
 
     @celery_app.task
+    @_flushes_mail
     def create_account(request):
-        # TODO: docstring
-        # lock account creation for up to 5 minutes
+        """Validate and create an account.
+
+        Accounts for different usernames and people are created in parallel;
+        only UID reservation is serialized (see reserve_uid).
+        """
         r = redis.from_url(credentials.redis_uri)
-        lock = r.lock('ocflib.account.submission.create_account', timeout=60 * 5)
+        # only one worker may create a given account (or an account for a
+        # given person or group) at a time
+        locks = [
+            r.lock('ocflib.account.submission.create_account:{}'.format(name), timeout=60 * 5)
+            for name in _creation_lock_names(request)
+        ]
+        acquired = []
         try:
-            if not lock.acquire(blocking=True, blocking_timeout=60 * 5):
-                raise RuntimeError('Couldn\'t lock account creation, abandoning.')
+            for lock in locks:
+                if not lock.acquire(blocking=True, blocking_timeout=60 * 5):
+                    raise RuntimeError('Couldn\'t lock account creation, abandoning.')
+                acquired.append(lock)
 
             # status reporting
             status = []
-
-            class report_status:
-
-                def __init__(self, *args):
-                    if len(args) == 1:
-                        self(*args)
-                    else:
-                        self.start, self.stop, self.task = args
-
-                def __call__(self, line):
-                    status.append(line)
-                    create_account.update_state(meta={'status': status})
-
-                def __enter__(self, *args):
-                    self(self.start + ' ' + self.task)
-
-                def __exit__(self, *args):
-                    self(self.stop + ' ' + self.task)
+            report_status = _status_reporter(
+                status,
+                lambda: create_account.update_state(meta={'status': status}),
+            )
 
             with report_status('Validating', 'Validated', 'request'), \
                     get_session() as session:
@@ -267,12 +436,12 @@ def get_tasks(celery_app, credentials=None):
                 )
 
             # actual account creation
-            kwargs = {}
-            known_uid = r.get('known_uid')
-            if known_uid:
-                kwargs['known_uid'] = int(known_uid)
-            new_uid = real_create_account(request, credentials, report_status, **kwargs)
-            r.set('known_uid', new_uid)
+            real_create_account(
+                request,
+                credentials,
+                report_status,
+                reserve_uid=lambda: reserve_uid(r),
+            )
 
             dispatch_event('ocflib.account_created', request=request.to_dict())
             return NewAccountResponse(
@@ -280,10 +449,11 @@ def get_tasks(celery_app, credentials=None):
                 errors=[],
             )
         finally:
-            try:
-                lock.release()
-            except LockError:
-                pass
+            for lock in reversed(acquired):
+                try:
+                    lock.release()
+                except LockError:
+                    pass
 
     @celery_app.task
     def get_pending_requests():
@@ -307,6 +477,164 @@ def get_tasks(celery_app, credentials=None):
         dispatch_event('ocflib.account_approved', request=request.to_dict())
 
     @celery_app.task
+    def approve_requests(user_names):
+        """Approve many stored requests at once.
+
+        The requests are created together by create_accounts, whose task ID
+        is returned. Stored requests are only removed as their accounts are
+        created (or rejected), so none are lost if creation fails; usernames
+        without a stored request are reported as not found.
+        """
+        with get_session() as session:
+            requests = [
+                row.to_request()
+                for row in session.query(StoredNewAccountRequest).filter(
+                    StoredNewAccountRequest.user_name.in_(user_names),
+                )
+            ]
+
+        for request in requests:
+            dispatch_event('ocflib.account_approved', request=request.to_dict())
+        found = {request.user_name for request in requests}
+        return create_accounts.delay(
+            requests,
+            stored=True,
+            not_found=sorted(set(user_names) - found),
+        ).id
+
+    def remove_stored_request(user_name):
+        with get_session() as session:
+            session.query(StoredNewAccountRequest).filter(
+                StoredNewAccountRequest.user_name == user_name,
+            ).delete()
+            session.commit()
+
+    @celery_app.task
+    @_flushes_mail
+    def create_accounts(requests, stored=False, not_found=()):
+        """Validate and create many accounts at once.
+
+        Status is reported per request, as a dict mapping username to status
+        lines. Requests whose accounts are already being created elsewhere
+        are put back in the queue (a new create_accounts task) rather than
+        waited for, and reported as pending.
+
+        :param stored: whether the requests are stored requests being approved
+                       (see approve_requests); each is removed once its
+                       account is created or it's rejected, and kept if
+                       creation fails so it can be approved again
+        :param not_found: usernames to report as not found (see
+                          approve_requests)
+        :return: dict mapping username to NewAccountResponse
+        """
+        r = redis.from_url(credentials.redis_uri)
+        statuses = {user_name: [] for user_name in not_found}
+        statuses.update((request.user_name, []) for request in requests)
+        reporters = {
+            user_name: _status_reporter(
+                status,
+                lambda: create_accounts.update_state(meta={'status': statuses}),
+            )
+            for user_name, status in statuses.items()
+        }
+        responses = {}
+        acquired = []
+        # the locks are held until the whole batch is created, so allow time
+        # for every account in it
+        lock_timeout = 60 * 5 + 60 * len(requests)
+
+        def lock_request(request):
+            locks = []
+            for name in _creation_lock_names(request):
+                lock = r.lock('ocflib.account.submission.create_account:{}'.format(name), timeout=lock_timeout)
+                if not lock.acquire(blocking=False):
+                    # don't keep the others, or the retry would wait on us
+                    for held in reversed(locks):
+                        held.release()
+                    return False
+                locks.append(lock)
+            acquired.extend((request.user_name, lock) for lock in locks)
+            return True
+
+        def reject_not_found(user_name):
+            reporters[user_name]('Request not found')
+            responses[user_name] = NewAccountResponse(
+                status=NewAccountResponse.REJECTED,
+                errors=['Request not found.'],
+            )
+
+        for user_name in not_found:
+            reject_not_found(user_name)
+
+        try:
+            to_create = []
+            contended = []
+            with get_session() as session:
+                if stored:
+                    # the request may have been rejected (or created by
+                    # another task) since it was approved
+                    pending = usernames_pending(session, (request.user_name for request in requests))
+                for request in requests:
+                    if stored and request.user_name not in pending:
+                        reject_not_found(request.user_name)
+                        continue
+
+                    if not lock_request(request):
+                        reporters[request.user_name]('Account is already being created; trying again later')
+                        contended.append(request)
+                        responses[request.user_name] = NewAccountResponse(
+                            status=NewAccountResponse.PENDING,
+                            errors=['Account is already being created.'],
+                        )
+                        continue
+
+                    errors, warnings = validate_request(request, credentials, session, stored=stored)
+                    if errors:
+                        send_rejected_mail(request, str(errors))
+                        if stored:
+                            remove_stored_request(request.user_name)
+                        responses[request.user_name] = NewAccountResponse(
+                            status=NewAccountResponse.REJECTED,
+                            errors=(errors + warnings),
+                        )
+                    else:
+                        to_create.append(request)
+
+            if contended:
+                create_accounts.apply_async((contended,), {'stored': stored}, countdown=60)
+
+            results = real_create_accounts(
+                to_create,
+                credentials,
+                lambda user_name: reporters[user_name],
+                lambda count: reserve_uids(r, count),
+            )
+            for request in to_create:
+                result = results[request.user_name]
+                if isinstance(result, Exception):
+                    responses[request.user_name] = NewAccountResponse(
+                        status=NewAccountResponse.REJECTED,
+                        errors=[str(result)],
+                    )
+                else:
+                    if stored:
+                        remove_stored_request(request.user_name)
+                    dispatch_event('ocflib.account_created', request=request.to_dict())
+                    responses[request.user_name] = NewAccountResponse(
+                        status=NewAccountResponse.CREATED,
+                        errors=[],
+                    )
+            return responses
+        finally:
+            for user_name, lock in reversed(acquired):
+                try:
+                    lock.release()
+                except LockError:
+                    # someone else may have created the same account
+                    reporters[user_name]('Warning: lock expired before the batch finished')
+
+    @celery_app.task
+    @_flushes_mail
     def reject_request(user_name):
         stored_request = get_remove_row_by_user_name(user_name)
         request = stored_request.to_request()
@@ -314,6 +642,7 @@ def get_tasks(celery_app, credentials=None):
         dispatch_event('ocflib.account_rejected', request=request.to_dict())
 
     @celery_app.task
+    @_flushes_mail
     def change_password(username, new_password, comment=None):
         """Change the password of a username.
 
@@ -332,6 +661,12 @@ def get_tasks(celery_app, credentials=None):
             comment=comment,
         )
 
+    @celery_app.task
+    def suggest_usernames(real_name, n=SUGGESTIONS):
+        """Return up to n available usernames for a real name, best first."""
+        with get_session() as session:
+            return username_suggestions(session, real_name, n)
+
     @celery_app.task
     def status():
         """A testing route."""
@@ -345,8 +680,11 @@ def get_tasks(celery_app, credentials=None):
         create_account=create_account,
         get_pending_requests=get_pending_requests,
         approve_request=approve_request,
+        approve_requests=approve_requests,
+        create_accounts=create_accounts,
         reject_request=reject_request,
         change_password=change_password,
+        suggest_usernames=suggest_usernames,
         status=status,
     )
 
@@ -356,8 +694,11 @@ _AccountSubmissionTasks = namedtuple('AccountSubmissionTasks', [
     'create_account',
     'get_pending_requests',
     'approve_request',
+    'approve_requests',
+    'create_accounts',
     'reject_request',
     'change_password',
+    'suggest_usernames',
     'status',
 ])
 
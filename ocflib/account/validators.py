@@ -1,13 +1,17 @@
 import difflib
+import os
 import pwd
 import string
 import sys
+import threading
 
 from zxcvbn import zxcvbn
 
 import ocflib.misc.mail
 import ocflib.account.search as search
 
+PASSWD_PATH = '/etc/passwd'
+
 RESERVED_USERNAMES = frozenset((
     # Misc
     'Debian-exim',
@@ -340,11 +344,15 @@ RESERVED_USERNAMES = frozenset((
 ))
 
 
-def validate_username(username, check_exists=False):
+def validate_username(username, check_exists=False, report=True):
     """Validate a username, raising a descriptive exception if problems are
-    encountered."""
+    encountered.
+
+    :param report: whether to send a problem report if the username is only
+                   reserved because of a local user (see username_reserved)
+    """
 
-    if username_reserved(username):
+    if username_reserved(username, report=report):
         raise ValueError('Username is reserved.')
 
     if not 3 <= len(username) <= 16:
@@ -388,7 +396,34 @@ def user_exists(username):
         return True
 
 
-def username_reserved(username):
+_local_usernames_cache = {}
+_local_usernames_lock = threading.Lock()
+
+
+def local_usernames(path=None):
+    """Return a frozenset of the usernames in /etc/passwd.
+
+    The file is only re-read when its mtime changes.
+    """
+    path = path or PASSWD_PATH
+    mtime = os.stat(path).st_mtime_ns
+    cached = _local_usernames_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with _local_usernames_lock:
+        with open(path) as f:
+            usernames = frozenset(line.split(':', 1)[0] for line in f if ':' in line)
+        _local_usernames_cache[path] = (mtime, usernames)
+        return usernames
+
+
+def username_reserved(username, report=True):
+    """Return whether a username is reserved.
+
+    :param report: whether to send a problem report if the username is only
+                   reserved because of a local user in /etc/passwd
+    """
     if username.startswith('ocf'):
         return True
 
@@ -396,8 +431,8 @@ def username_reserved(username):
         return True
 
     # sanity check: make sure no local users share the username
-    with open('/etc/passwd') as f:
-        if any(line.startswith(username + ':') for line in f):
+    if username in local_usernames():
+        if report:
             print(
                 'WARNING: Username {} rejected based on /etc/passwd!'
                 .format(username),
@@ -406,6 +441,6 @@ def username_reserved(username):
                 """Username {} rejected based on /etc/passwd. It should be \
 added to RESERVED_USERNAMES for consistency across \
 servers!""".format(username))
-            return True
+        return True
 
     return False
@@ -1,11 +1,142 @@
 import os
+import re
 import shlex
 import string
-import subprocess
+import threading
+import time
 
 import pexpect
 
 KADMIN_PATH = '/usr/bin/kadmin'
+KADMIN_PROMPT = 'kadmin> '
+
+# Number of principals to ask kadmin about per `list` command
+KADMIN_LIST_BATCH = 200
+
+# Restart kadmin sessions after this many seconds, well before the tickets
+# they got from the keytab expire
+KADMIN_SESSION_MAX_AGE = 60 * 60
+
+
+class KadminSession:
+    """A long-lived interactive kadmin process authenticated with a keytab.
+
+    Commands are sent to the same process one at a time, so each costs a
+    single exchange rather than starting kadmin and authenticating again. If
+    kadmin dies, times out, or gets too old, it is restarted for the next
+    command.
+
+    Example usage:
+
+        session = kadmin_session('/etc/ocf-create/create.keytab', 'create/admin')
+        output = session.run('get ckuehl')
+    """
+
+    def __init__(self, keytab, admin_principal, timeout=10, max_age=KADMIN_SESSION_MAX_AGE):
+        self.keytab = keytab
+        self.admin_principal = admin_principal
+        self.timeout = timeout
+        self.max_age = max_age
+        self._child = None
+        self._started = None
+        self._lock = threading.Lock()
+
+    def _spawn(self):
+        cmd = '{kadmin} -K {keytab} -p {admin}'.format(
+            kadmin=shlex.quote(KADMIN_PATH),
+            keytab=shlex.quote(self.keytab),
+            admin=shlex.quote(self.admin_principal),
+        )
+        child = pexpect.spawn(cmd, timeout=self.timeout)
+        try:
+            child.expect_exact(KADMIN_PROMPT)
+        except (pexpect.EOF, pexpect.TIMEOUT):
+            output = child.before.decode('utf8')
+            child.close(force=True)
+            raise ValueError('kadmin error: {}'.format(output))
+        self._child = child
+        self._started = time.monotonic()
+
+    def _close(self):
+        if self._child is not None:
+            self._child.close(force=True)
+            self._child = None
+
+    def close(self):
+        """Stop the kadmin process, if it's running."""
+        with self._lock:
+            self._close()
+
+    def run(self, command, responses=()):
+        """Run a kadmin command and return its output.
+
+        :param command: command line to send, e.g. 'get ckuehl'
+        :param responses: sequence of (prompt, response) pairs to answer, in
+                          order, while the command runs
+        :return: the output of the command, without the echoed command line
+        """
+        if '\n' in command or '\r' in command:
+            raise ValueError('kadmin commands must be a single line')
+
+        with self._lock:
+            if self._child is not None and (
+                not self._child.isalive() or
+                time.monotonic() - self._started > self.max_age
+            ):
+                self._close()
+            if self._child is None:
+                self._spawn()
+
+            try:
+                self._child.sendline(command)
+                for prompt, response in responses:
+                    # the command may finish (e.g. with an error) early
+                    if self._child.expect_exact([prompt, KADMIN_PROMPT]) == 1:
+                        break
+                    self._child.sendline(response)
+                else:
+                    self._child.expect_exact(KADMIN_PROMPT)
+            except (pexpect.EOF, pexpect.TIMEOUT):
+                output = self._child.before.decode('utf8')
+                self._close()
+                raise ValueError('kadmin error: {}'.format(output))
+
+            output = self._child.before.decode('utf8').replace('\r\n', '\n')
+
+        # the terminal echoes the command back to us
+        if output.startswith(command + '\n'):
+            output = output[len(command) + 1:]
+        return output.strip()
+
+
+_kadmin_sessions = {}
+_kadmin_sessions_lock = threading.Lock()
+
+
+def _reset_kadmin_sessions():
+    # a forked child gets its own kadmin processes, rather than interleaving
+    # commands with its parent's on the same pty
+    global _kadmin_sessions_lock
+    _kadmin_sessions.clear()
+    _kadmin_sessions_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_kadmin_sessions)
+
+
+def kadmin_session(keytab, admin_principal):
+    """Return the shared KadminSession for a keytab and admin principal."""
+    with _kadmin_sessions_lock:
+        key = (keytab, admin_principal)
+        if key not in _kadmin_sessions:
+            _kadmin_sessions[key] = KadminSession(keytab, admin_principal)
+        return _kadmin_sessions[key]
+
+
+def _check_principal_name(principal):
+    # names are sent as part of interactive kadmin commands
+    if not re.fullmatch(r'[\w./@-]+', principal):
+        raise ValueError('Invalid principal name: {!r}'.format(principal))
 
 
 def create_kerberos_principal_with_keytab(
@@ -14,7 +145,7 @@ def create_kerberos_principal_with_keytab(
     admin_principal,
     password=None,
 ):
-    """Creates a Kerberos principal by shelling out to kadmin.
+    """Creates a Kerberos principal using a shared kadmin session.
 
     :param principal: name of the principal to create
     :param keytab: path to the admin keytab
@@ -23,14 +154,7 @@ def create_kerberos_principal_with_keytab(
                      if not given, defaults to using a random password
     :return: the password of the newly-created account
     """
-    # try changing using kadmin pexpect
-    cmd = ('{kadmin} -K {keytab} -p {admin} add --use-defaults ' +
-           '{principal}').format(
-        kadmin=shlex.quote(KADMIN_PATH),
-        keytab=shlex.quote(keytab),
-        admin=shlex.quote(admin_principal),
-        principal=shlex.quote(principal),
-    )
+    _check_principal_name(principal)
 
     if not password:
         # XXX: using `--random-password` generates weak passwords, plus spits
@@ -39,19 +163,14 @@ def create_kerberos_principal_with_keytab(
         password = ''.join(allowed[byte % len(allowed)]
                            for byte in os.urandom(100))
 
-    child = pexpect.spawn(cmd, timeout=10)
-
-    child.expect("{}@OCF.BERKELEY.EDU's Password:".format(principal))
-    child.sendline(password)
-    child.expect("Verify password - {}@OCF.BERKELEY.EDU's Password:"
-                 .format(principal))
-    child.sendline(password)
-
-    child.expect(pexpect.EOF)
-
-    output = child.before.decode('utf8')
-    child.close()
-    if child.exitstatus:
+    output = kadmin_session(keytab, admin_principal).run(
+        'add --use-defaults {}'.format(principal),
+        (
+            ("{}@OCF.BERKELEY.EDU's Password:".format(principal), password),
+            ("Verify password - {}@OCF.BERKELEY.EDU's Password:".format(principal), password),
+        ),
+    )
+    if output:
         raise ValueError('kadmin error: {}'.format(output))
 
     return password
@@ -60,7 +179,7 @@ def create_kerberos_principal_with_keytab(
 def get_kerberos_principal_with_keytab(principal, keytab, admin_principal):
     """Returns information about an existing kerberos principal.
 
-    Currently, this requires shelling out to kadmin, so the only information
+    Currently, this requires talking to kadmin, so the only information
     returned is whether the principal exists.
 
     :param principal: name of the principal to create
@@ -69,19 +188,39 @@ def get_kerberos_principal_with_keytab(principal, keytab, admin_principal):
     :return: True if the principal exists, or
              None if the principal does not exist
     """
-    cmd = [
-        shlex.quote(KADMIN_PATH),
-        '-K', shlex.quote(keytab),
-        '-p', shlex.quote(admin_principal),
-        'get', shlex.quote(principal),
-    ]
-
-    try:
-        subprocess.check_output(cmd, timeout=10, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        if b'Principal does not exist' in e.output:
-            return None
-        else:
-            raise ValueError('kadmin error: {}'.format(e.output))
+    _check_principal_name(principal)
+    output = kadmin_session(keytab, admin_principal).run('get {}'.format(principal))
+    if 'Principal does not exist' in output:
+        return None
+    elif 'Principal:' not in output:
+        raise ValueError('kadmin error: {}'.format(output))
 
     return True
+
+
+def principals_exist(principals, keytab, admin_principal):
+    """Returns the set of the given principals which exist.
+
+    Principals are looked up with `list` commands over the shared kadmin
+    session, many at a time, rather than one `get` per principal. The result
+    is a frozenset, so it can be kept around and reused for the rest of a
+    batch of operations.
+
+    :param principals: names of the principals, without the realm
+    :param keytab: path to the admin keytab
+    :param admin_principal: admin principal to authenticate with keytab
+    """
+    principals = sorted(set(principals))
+    for principal in principals:
+        _check_principal_name(principal)
+
+    session = kadmin_session(keytab, admin_principal)
+    existing = set()
+    for i in range(0, len(principals), KADMIN_LIST_BATCH):
+        output = session.run('list ' + ' '.join(principals[i:i + KADMIN_LIST_BATCH]))
+        for line in output.splitlines():
+            line = line.strip()
+            if line and ' ' not in line:
+                existing.add(line.split('@', 1)[0])
+
+    return frozenset(existing & set(principals))
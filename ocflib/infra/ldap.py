@@ -85,13 +85,14 @@ def _format_attr(key, values):
     return lines
 
 
-def _write_ldif(lines, dn, keytab=None, admin_principal=None):
+def _write_ldif(lines, dn, keytab=None, admin_principal=None, timeout=10):
     """Issue an update to LDAP via ldapmodify in the form of lines of an LDIF
     file. This could be a new addition to LDAP, a modification of an existing
     item, or even a deletion depending on the changetype attribute given as
     part of the sequence of lines.
 
     :param lines: ldif file as a sequence of lines
+    :param timeout: seconds to wait for ldapmodify
 
     A ldif file looks something like this:
 
@@ -124,7 +125,7 @@ def _write_ldif(lines, dn, keytab=None, admin_principal=None):
             command,
             input='\n'.join(lines),
             universal_newlines=True,
-            timeout=10,
+            timeout=timeout,
         )
     except subprocess.CalledProcessError as e:
         if e.returncode == 32:
@@ -162,6 +163,14 @@ def _write_ldif(lines, dn, keytab=None, admin_principal=None):
             raise ValueError('Unknown LDAP failure was encountered.')
 
 
+def _add_lines(dn, attributes):
+    return chain(
+        _format_attr('dn', [dn]),
+        ('changetype: add',),
+        *(_format_attr(key, values) for key, values in sorted(attributes.items()))
+    )
+
+
 def create_ldap_entry(
     dn,
     attributes,
@@ -173,13 +182,51 @@ def create_ldap_entry(
     :param attributes: dict mapping attribute name to list of values
     :param **kwargs: any additional keyword arguments to pass on to _write_ldif
     """
-    lines = chain(
-        _format_attr('dn', [dn]),
-        ('changetype: add',),
-        *(_format_attr(key, values) for key, values in sorted(attributes.items()))
-    )
+    _write_ldif(_add_lines(dn, attributes), dn, **kwargs)
 
-    _write_ldif(lines, dn, **kwargs)
+
+def create_ldap_entries(
+    entries,
+    **kwargs  # TODO: Add a trailing comma here in Python 3.6+
+):
+    """Creates many LDAP entries with a single call to ldapmodify.
+
+    If the batch fails, the entries are retried one at a time to find out
+    which ones are at fault. Entries which already exist at that point may
+    have been added by the failed batch or by someone else, so they're
+    reported as duplicate entry errors; callers can check whether the
+    existing entries are theirs.
+
+    :param entries: list of (dn, attributes) pairs, as for create_ldap_entry
+    :param **kwargs: any additional keyword arguments to pass on to _write_ldif
+    :return: list with, for each entry, None if it was created or the
+             ValueError raised when creating it
+    """
+    entries = list(entries)
+    if not entries:
+        return []
+
+    lines = []
+    for dn, attributes in entries:
+        lines.extend(_add_lines(dn, attributes))
+        lines.append('')
+
+    try:
+        _write_ldif(lines, entries[0][0], **dict({'timeout': 10 + len(entries)}, **kwargs))
+    except ValueError:
+        pass
+    else:
+        return [None] * len(entries)
+
+    errors = []
+    for dn, attributes in entries:
+        try:
+            create_ldap_entry(dn, attributes, **kwargs)
+        except ValueError as ex:
+            errors.append(ex)
+        else:
+            errors.append(None)
+    return errors
 
 
 def modify_ldap_entry(
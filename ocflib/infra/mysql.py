@@ -1,5 +1,6 @@
 import pymysql
 from contextlib import contextmanager
+from pymysql.constants import SERVER_STATUS
 
 
 @contextmanager
@@ -32,3 +33,26 @@ def get_connection(user,
     finally:
         conn.commit()
         conn.close()
+
+
+@contextmanager
+def transaction(c):
+    """Context manager running the statements in the block in one transaction.
+
+    If the cursor's connection is already in a transaction (e.g. the caller
+    started one), the statements just become part of it, and it's left to the
+    caller to commit or roll back. Otherwise, the transaction is committed if
+    the block succeeds and rolled back if it raises.
+    """
+    conn = c.connection
+    if conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+        yield
+        return
+
+    conn.begin()
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
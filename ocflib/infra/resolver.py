@@ -0,0 +1,250 @@
+"""Caching DNS lookups.
+
+Validating an email address or host means a DNS round trip, and we tend to
+validate the same handful of domains (berkeley.edu, gmail.com, ...) over and
+over. Answers are cached in memory for as long as their TTL allows, and
+"doesn't exist" answers are cached too.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+import dns.asyncquery
+import dns.asyncresolver
+import dns.exception
+import dns.message
+import dns.name
+import dns.query
+import dns.rdatatype
+import dns.resolver
+
+from ocflib.infra.net import OCF_DNS_RESOLVER
+
+CACHE_SIZE = 4096
+NEGATIVE_TTL = 300
+MAX_TTL = 86400
+CONCURRENCY = 20
+
+
+def _negative_ttl(response):
+    """Return how long a negative response may be cached, per RFC 2308 (the
+    lesser of the SOA's TTL and its minimum field), or None."""
+    if response is None:
+        return None
+    for rrset in response.authority:
+        if rrset.rdtype == dns.rdatatype.SOA:
+            return min(rrset.ttl, rrset[0].minimum)
+
+
+def _any_answer(response):
+    if not response.answer:
+        return (), _negative_ttl(response)
+    return (
+        tuple(rdata.to_text() for rrset in response.answer for rdata in rrset),
+        min(rrset.ttl for rrset in response.answer),
+    )
+
+
+def _answer(answer):
+    return tuple(rdata.to_text() for rdata in answer), answer.rrset.ttl
+
+
+def _nxdomain_answer(ex):
+    return (), _negative_ttl(next(iter(ex.responses().values()), None))
+
+
+def dns_lookup(name, rdtype):
+    """Look up records of a type for a name.
+
+    Returns a tuple (records, ttl), where records is a tuple of record strings
+    (empty if the name or records don't exist), and ttl is the number of
+    seconds the answer is good for (or None if unknown).
+
+    ANY queries are sent straight to the OCF resolver, since dnspython's stub
+    resolver refuses metaqueries.
+    """
+    if rdtype == 'ANY':
+        message = dns.message.make_query(name, dns.rdatatype.ANY)
+        return _any_answer(dns.query.udp(message, str(OCF_DNS_RESOLVER)))
+
+    try:
+        return _answer(dns.resolver.resolve(name, rdtype, search=False))
+    except dns.resolver.NXDOMAIN as ex:
+        return _nxdomain_answer(ex)
+    except dns.resolver.NoAnswer as ex:
+        return (), _negative_ttl(ex.response())
+
+
+async def async_dns_lookup(name, rdtype):
+    """Like dns_lookup, but a coroutine using dnspython's async resolver."""
+    if rdtype == 'ANY':
+        message = dns.message.make_query(name, dns.rdatatype.ANY)
+        return _any_answer(await dns.asyncquery.udp(message, str(OCF_DNS_RESOLVER)))
+
+    try:
+        return _answer(await dns.asyncresolver.resolve(name, rdtype, search=False))
+    except dns.resolver.NXDOMAIN as ex:
+        return _nxdomain_answer(ex)
+    except dns.resolver.NoAnswer as ex:
+        return (), _negative_ttl(ex.response())
+
+
+class CachingResolver:
+    """DNS resolver which caches answers in memory.
+
+    Answers are kept for their TTL (capped at max_ttl); negative answers
+    (NXDOMAIN or no records of the type) are kept for the TTL the server
+    suggests, or negative_ttl if it doesn't. At most `size` answers are kept,
+    evicting the least recently used. Lookup errors (e.g. timeouts) are raised
+    and never cached.
+
+    `lookup` is a function with the same signature as `dns_lookup`; pass a
+    stub to avoid real DNS queries (e.g. in tests). `async_lookup` is the
+    coroutine equivalent used by `resolve_many`; if not given, `lookup` is run
+    in a thread pool instead.
+    """
+
+    def __init__(self, lookup=dns_lookup, async_lookup=None, size=CACHE_SIZE,
+                 negative_ttl=NEGATIVE_TTL, max_ttl=MAX_TTL, clock=time.monotonic):
+        self.lookup = lookup
+        self.async_lookup = async_lookup
+        self.size = size
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self.clock = clock
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, rdtype):
+        """Return the cache key for a query, or None if the name isn't a valid
+        domain name."""
+        if not name.strip('.'):
+            return None
+        try:
+            name = dns.name.from_text(name).to_text(omit_final_dot=True).lower()
+        except dns.exception.DNSException:
+            return None
+        return name, rdtype.upper()
+
+    def _get(self, key, now):
+        """Return the cached records for a key, or None if not cached."""
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                expires, records = entry
+                if now < expires:
+                    self._cache.move_to_end(key)
+                    return records
+                del self._cache[key]
+
+    def _put(self, key, now, answer):
+        """Cache the answer to a lookup, returning its records."""
+        records, ttl = answer
+        records = tuple(records)
+        if ttl is None:
+            ttl = 0 if records else self.negative_ttl
+        ttl = min(ttl, self.max_ttl)
+
+        if ttl > 0:
+            with self._lock:
+                self._cache[key] = (now + ttl, records)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.size:
+                    self._cache.popitem(last=False)
+        return records
+
+    def resolve(self, name, rdtype):
+        """Return a tuple of record strings of a type for a name.
+
+        The tuple is empty if there are no such records, or if the name isn't
+        a valid domain name.
+        """
+        key = self._key(name, rdtype)
+        if key is None:
+            return ()
+
+        now = self.clock()
+        records = self._get(key, now)
+        if records is None:
+            records = self._put(key, now, self.lookup(*key))
+        return records
+
+    def resolve_many(self, names, rdtype, concurrency=CONCURRENCY):
+        """Look up records of a type for many names at once.
+
+        Each distinct name is looked up at most once, and names which aren't
+        cached are looked up concurrently, at most `concurrency` at a time.
+        Returns a dict mapping each name to its tuple of records, or to the
+        exception raised looking it up (so one timeout doesn't lose the rest).
+
+        This runs its own event loop, so it can't be called from a coroutine.
+        """
+        now = self.clock()
+        results = {}
+        missing = {}
+        for name in names:
+            if name in results or name in missing:
+                continue
+            key = self._key(name, rdtype)
+            records = () if key is None else self._get(key, now)
+            if records is None:
+                missing[name] = key
+            else:
+                results[name] = records
+
+        keys = set(missing.values())
+        if keys:
+            answers = asyncio.run(self._lookup_all(keys, concurrency))
+            for key, answer in answers.items():
+                if not isinstance(answer, Exception):
+                    answers[key] = self._put(key, now, answer)
+            results.update((name, answers[key]) for name, key in missing.items())
+        return results
+
+    async def _lookup_all(self, keys, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def lookup(key):
+            async with semaphore:
+                if self.async_lookup is not None:
+                    return await self.async_lookup(*key)
+                return await asyncio.get_running_loop().run_in_executor(None, self.lookup, *key)
+
+        keys = list(keys)
+        answers = await asyncio.gather(*map(lookup, keys), return_exceptions=True)
+        return dict(zip(keys, answers))
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+_resolver = CachingResolver(async_lookup=async_dns_lookup)
+
+
+def get_resolver():
+    """Return the resolver shared by the validation functions."""
+    return _resolver
+
+
+def set_resolver(resolver):
+    """Replace the shared resolver (e.g. with one using a stub lookup),
+    returning the old one."""
+    global _resolver
+    old, _resolver = _resolver, resolver
+    return old
+
+
+def resolve(name, rdtype):
+    """Look up records using the shared caching resolver."""
+    return _resolver.resolve(name, rdtype)
+
+
+def resolve_many(names, rdtype, concurrency=CONCURRENCY):
+    """Look up records for many names using the shared caching resolver."""
+    return _resolver.resolve_many(names, rdtype, concurrency=concurrency)
@@ -46,6 +46,8 @@ CREATE TABLE IF NOT EXISTS `mirrors` (
     `down` bigint(20) NOT NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 
+CREATE INDEX `printer_pages_idx` ON `printer_pages` (`printer`, `date`);
+CREATE INDEX `printer_toner_idx` ON `printer_toner` (`printer`, `date`);
 
 DROP VIEW IF EXISTS session_duration;
 CREATE VIEW `session_duration` AS
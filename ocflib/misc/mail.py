@@ -1,12 +1,21 @@
 """Email handling and sending"""
+import atexit
+import collections
 import email.mime.multipart
 import email.mime.text
-import inspect
+import os
+import smtplib
 import socket
 import subprocess
+import sys
+import threading
+import time
+import traceback
+import weakref
 from email.utils import parseaddr
 
 from jinja2 import Environment
+from jinja2 import FileSystemBytecodeCache
 from jinja2 import PackageLoader
 
 import ocflib.misc.validators as validators
@@ -36,10 +45,89 @@ Need help connecting to the OCF?
 Need to reset your account password?
     https://ocf.io/password"""
 
-jinja_mail_env = Environment(loader=PackageLoader('ocflib', ''))
-jinja_mail_env.globals = {
-    'mail_signature': MAIL_SIGNATURE,
-}
+# compiled templates are cached on disk here (None means a per-user directory
+# under the system temp dir), so fresh worker processes don't recompile them;
+# this is read when the template environment is built (see get_mail_env)
+MAIL_TEMPLATE_CACHE_DIR = None
+
+
+class _BytecodeCache(FileSystemBytecodeCache):
+    """Bytecode cache which never lets a broken cache directory stop mail
+    from being rendered."""
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
+
+
+def _bytecode_cache(directory):
+    try:
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        return _BytecodeCache(directory)
+    except (OSError, RuntimeError):
+        # no usable cache directory; templates just get compiled in memory
+        return None
+
+
+_mail_env = None
+_mail_env_lock = threading.Lock()
+
+
+def get_mail_env():
+    """Return the Jinja environment for mail templates.
+
+    It's built on first use, so MAIL_TEMPLATE_CACHE_DIR can be set any time
+    before the first template is rendered.
+    """
+    global _mail_env
+    with _mail_env_lock:
+        if _mail_env is None:
+            # templates ship with ocflib, so there's no need to check them for
+            # changes
+            env = Environment(
+                loader=PackageLoader('ocflib', ''),
+                bytecode_cache=_bytecode_cache(MAIL_TEMPLATE_CACHE_DIR),
+                auto_reload=False,
+            )
+            env.globals = {
+                'mail_signature': MAIL_SIGNATURE,
+            }
+            _mail_env = env
+        return _mail_env
+
+
+def __getattr__(name):
+    # jinja_mail_env used to be built at import time
+    if name == 'jinja_mail_env':
+        return get_mail_env()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def warm_mail_templates():
+    """Load and compile every mail template now, so the first mail sent
+    doesn't pay for it (e.g. call this when a worker process starts)."""
+    env = get_mail_env()
+    for name in env.list_templates(extensions=('jinja',)):
+        env.get_template(name)
+
+
+def render_mail_template(name, **context):
+    """Render a mail template (e.g. 'account/mail_templates/account-created.jinja')."""
+    return get_mail_env().get_template(name).render(**context)
+
+
+def render_many(name, contexts, **shared):
+    """Render a mail template once for each context, for bulk mailings.
+
+    `contexts` is an iterable of dicts of per-message variables; keyword
+    arguments are variables shared by every message (and overridden by the
+    per-message ones). Returns a list of rendered bodies.
+    """
+    template = get_mail_env().get_template(name)
+    return [template.render(dict(shared, **context)) for context in contexts]
 
 
 def email_for_user(username, check_exists=True):
@@ -61,11 +149,10 @@ def send_mail_user(user, subject, body, html_body=None, sender=MAIL_FROM):
     send_mail(email_for_user(user), subject, body, html_body=html_body, sender=sender)
 
 
-def send_mail(to, subject, body, *, html_body=None, cc=None, sender=MAIL_FROM):
-    """Send a plain-text mail message.
-
-    `body` should be a string with newlines, wrapped at about 80 characters."""
-
+def _build_message(to, subject, body, html_body=None, cc=None, sender=MAIL_FROM):
+    """Validate the addresses and return a MIME message."""
+    # our own addresses (MAIL_FROM, MAIL_ROOT, users' @ocf.berkeley.edu) are
+    # in validators.KNOWN_EMAIL_DOMAINS, so checking them doesn't touch DNS
     if not validators.valid_email(parseaddr(sender)[1]):
         raise ValueError('Invalid sender address.')
 
@@ -88,35 +175,512 @@ def send_mail(to, subject, body, *, html_body=None, cc=None, sender=MAIL_FROM):
         html = email.mime.text.MIMEText(html_body, 'html')
         msg.attach(html)
 
-    # we send the message via sendmail because direct traffic to port 25
-    # is firewalled off
-    p = subprocess.Popen((SENDMAIL_PATH, '-t', '-oi'),
-                         stdin=subprocess.PIPE)
-    p.communicate(msg.as_string().encode('utf8'))
+    return msg
 
 
-def send_problem_report(problem):
-    """Send a problem report to OCF staff."""
+class SendmailSMTP(smtplib.SMTP):
+    """SMTP connection to a local `sendmail -bs` process.
+
+    This lets a whole batch of messages be delivered by one sendmail process
+    speaking SMTP over a pipe, rather than starting sendmail per message.
+    """
+
+    def __init__(self, timeout=30):
+        super().__init__(timeout=timeout)
+        ours, theirs = socket.socketpair()
+        ours.settimeout(timeout)
+        self._process = subprocess.Popen((SENDMAIL_PATH, '-bs'), stdin=theirs, stdout=theirs)
+        theirs.close()
+        self.sock = ours
+
+        code, message = self.getreply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, message)
+
+    def close(self):
+        super().close()
+        if self._process is not None:
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+            self._process = None
+
+
+class SendmailTransport:
+    """Delivers mail by running sendmail.
+
+    Single messages are piped to their own `sendmail -t` process (we go
+    through sendmail because direct traffic to port 25 is firewalled off);
+    batches are sent over SMTP to one `sendmail -bs` process.
+    """
+
+    def send(self, msg):
+        p = subprocess.Popen((SENDMAIL_PATH, '-t', '-oi'),
+                             stdin=subprocess.PIPE)
+        p.communicate(msg.as_string().encode('utf8'))
+
+    def send_many(self, msgs):
+        transport = SMTPTransport(connect=SendmailSMTP)
+        try:
+            return transport.send_many(msgs)
+        finally:
+            transport.close()
+
+    def close(self):
+        pass
+
+
+class SMTPTransport:
+    """Delivers mail over a persistent SMTP connection.
+
+    The connection is opened on first use and reused until it breaks (a
+    broken connection is reopened and the message retried once) or the
+    transport is closed.
+
+    :param connect: function returning a new smtplib.SMTP-like connection
+    """
+
+    def __init__(self, connect=lambda: smtplib.SMTP('localhost')):
+        self.connect = connect
+        self._smtp = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _discard(self):
+        smtp, self._smtp = self._smtp, None
+        try:
+            smtp.close()
+        except (OSError, smtplib.SMTPException):
+            pass
+
+    def _send(self, msg):
+        if self._pid != os.getpid():
+            # a connection inherited across fork belongs to the parent
+            self._smtp = None
+            self._pid = os.getpid()
+
+        reused = self._smtp is not None
+        if not reused:
+            self._smtp = self.connect()
+        try:
+            self._smtp.send_message(msg)
+        except OSError as ex:
+            # SMTP errors are OSErrors too, but most leave the connection usable
+            if isinstance(ex, smtplib.SMTPException) and not isinstance(ex, smtplib.SMTPServerDisconnected):
+                raise
+            self._discard()
+            if not reused:
+                raise
+            self._smtp = self.connect()
+            self._smtp.send_message(msg)
+
+    def send(self, msg):
+        with self._lock:
+            self._send(msg)
+
+    def send_many(self, msgs):
+        """Send each message, returning a list with None for each message
+        sent and the exception for each that failed."""
+        results = []
+        with self._lock:
+            for msg in msgs:
+                try:
+                    self._send(msg)
+                except (OSError, smtplib.SMTPException) as ex:
+                    results.append(ex)
+                else:
+                    results.append(None)
+        return results
+
+    def close(self):
+        with self._lock:
+            if self._smtp is not None and self._pid == os.getpid():
+                try:
+                    self._smtp.quit()
+                except (OSError, smtplib.SMTPException):
+                    pass
+                self._discard()
+            self._smtp = None
+
+
+class MemoryTransport:
+    """Keeps mail in a list (`outbox`) instead of delivering it, for tests."""
+
+    def __init__(self):
+        self.outbox = []
+
+    def send(self, msg):
+        self.outbox.append(msg)
+
+    def send_many(self, msgs):
+        msgs = list(msgs)
+        self.outbox.extend(msgs)
+        return [None] * len(msgs)
+
+    def close(self):
+        pass
+
+
+_transport = SendmailTransport()
+
+
+def get_transport():
+    """Return the transport used by send_mail and send_mails."""
+    return _transport
+
+
+def set_transport(transport):
+    """Replace the transport used by send_mail and send_mails (e.g. with an
+    SMTPTransport for a long-running mailer, or a MemoryTransport in tests),
+    returning the old one."""
+    global _transport
+    old, _transport = _transport, transport
+    return old
+
+
+def send_mail(to, subject, body, *, html_body=None, cc=None, sender=MAIL_FROM):
+    """Send a plain-text mail message.
+
+    `body` should be a string with newlines, wrapped at about 80 characters."""
+    msg = _build_message(to, subject, body, html_body=html_body, cc=cc, sender=sender)
+    _transport.send(msg)
 
-    def format_frame(frame):
-        _, filename, line, funcname, _, _ = frame
-        return '{}:{} ({})'.format(filename, line, funcname)
 
-    callstack = '\n        by '.join(map(format_frame, inspect.stack()))
-    body = \
-        """A problem was encountered and reported via ocflib:
+def send_mails(mails):
+    """Send many plain-text mail messages at once.
+
+    Each mail is a dict of send_mail's arguments (`to`, `subject`, `body`,
+    and optionally `html_body`, `cc` and `sender`). Mail is validated up
+    front and delivered in one batch by the transport, which for sendmail
+    means one process instead of one per message.
+
+    Returns a list with, for each mail in order, None if it was sent or the
+    exception if it was invalid or couldn't be sent.
+    """
+    results = []
+    msgs = []
+    for mail in mails:
+        try:
+            msgs.append(_build_message(**mail))
+        except ValueError as ex:
+            results.append(ex)
+        else:
+            results.append(None)
+
+    sent = iter(_transport.send_many(msgs) if msgs else ())
+    return [next(sent) if result is None else result for result in results]
+
+
+class MailQueue:
+    """Queue of outgoing messages, delivered in batches in the background.
+
+    A background thread delivers queued messages every `interval` seconds (or
+    as soon as `batch_size` are waiting), sending each batch over a single
+    SMTP connection. Messages which fail temporarily are retried with
+    exponential backoff; messages rejected outright (5xx) are dropped with a
+    warning, as are messages which still fail after `max_attempts`.
+
+    Queued messages only live in this process's memory, so processes which
+    may exit without running atexit handlers (e.g. Celery prefork workers)
+    should call flush() once they're done sending, e.g. at the end of each
+    task.
+
+    :param connect: function returning a new smtplib.SMTP-like connection,
+                    e.g. `lambda: smtplib.SMTP('localhost')` for a local MTA
+    """
+
+    def __init__(
+        self,
+        connect=SendmailSMTP,
+        batch_size=50,
+        interval=1,
+        max_attempts=5,
+        retry_delay=5,
+    ):
+        self.connect = connect
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._reset()
+
+        # threads don't survive fork, and the locks may have been held by one
+        # of them, so the child starts over with fresh state without touching
+        # the inherited locks (anything queued is the parent's to deliver)
+        ref = weakref.ref(self)
+
+        def reset_in_child():
+            queue = ref()
+            if queue is not None:
+                queue._reset()
+
+        os.register_at_fork(after_in_child=reset_in_child)
+
+    def _reset(self):
+        # each entry is a [message, attempts, not_before] list
+        self._pending = []
+        self._cond = threading.Condition()
+        # held while taking and delivering a batch, so flush can wait for
+        # whatever the background thread is in the middle of sending
+        self._deliver_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self._pid = os.getpid()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def put(self, msg):
+        """Queue a message for delivery."""
+        with self._cond:
+            self._ensure_started()
+            self._pending.append([msg, 0, 0])
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _take_batch(self, now):
+        ready = [entry for entry in self._pending if entry[2] <= now][:self.batch_size]
+        for entry in ready:
+            self._pending.remove(entry)
+        return ready
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                self._cond.wait(self.interval)
+            with self._deliver_lock:
+                with self._cond:
+                    batch = self._take_batch(time.monotonic())
+                if batch:
+                    self._deliver(batch)
+
+    def _retry(self, entry, error):
+        entry[1] += 1
+        if entry[1] >= self.max_attempts:
+            self._drop(entry, error)
+        else:
+            entry[2] = time.monotonic() + self.retry_delay * 2 ** (entry[1] - 1)
+            with self._cond:
+                self._pending.append(entry)
+
+    def _drop(self, entry, error):
+        print(
+            'WARNING: Dropping mail to {} after {} attempt(s): {}'.format(entry[0]['To'], entry[1], error),
+            file=sys.stderr,
+        )
+
+    def _deliver(self, batch):
+        # called with _deliver_lock held
+        try:
+            smtp = self.connect()
+        except (OSError, smtplib.SMTPException) as ex:
+            for entry in batch:
+                self._retry(entry, ex)
+            return
+
+        remaining = list(batch)
+        try:
+            while remaining:
+                entry = remaining[0]
+                try:
+                    smtp.send_message(entry[0])
+                except smtplib.SMTPRecipientsRefused as ex:
+                    self._drop(entry, ex)
+                except smtplib.SMTPResponseException as ex:
+                    if ex.smtp_code >= 500:
+                        entry[1] += 1
+                        self._drop(entry, ex)
+                    else:
+                        self._retry(entry, ex)
+                remaining.pop(0)
+            smtp.quit()
+        except (OSError, smtplib.SMTPException) as ex:
+            # the connection broke; try the rest again later
+            for entry in remaining:
+                self._retry(entry, ex)
+        finally:
+            smtp.close()
+
+    def flush(self):
+        """Try to deliver every queued message now (including ones waiting to
+        be retried), in the calling thread.
+
+        This also waits for any batch the background thread is delivering, so
+        once it returns, every message queued before the call has been tried.
+        """
+        with self._deliver_lock:
+            with self._cond:
+                entries, self._pending = self._pending, []
+            for i in range(0, len(entries), self.batch_size):
+                self._deliver(entries[i:i + self.batch_size])
+
+    def stop(self, timeout=None):
+        """Stop the background thread and flush whatever is left."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and self._pid == os.getpid():
+            thread.join(timeout)
+        self.flush()
+        with self._cond:
+            self._thread = None
+            self._stopping = False
+
+
+mail_queue = MailQueue()
+atexit.register(mail_queue.stop)
+
+
+def queue_mail(to, subject, body, *, html_body=None, cc=None, sender=MAIL_FROM):
+    """Queue a plain-text mail message to be sent in the background.
+
+    This takes the same arguments as send_mail, and validates the addresses
+    immediately, but returns without waiting for delivery (see MailQueue).
+    """
+    mail_queue.put(_build_message(to, subject, body, html_body=html_body, cc=cc, sender=sender))
+
 
-{problem}
+def queue_mail_user(user, subject, body, html_body=None, sender=MAIL_FROM):
+    """Queue a plain-text mail message to a user."""
+    queue_mail(email_for_user(user), subject, body, html_body=html_body, sender=sender)
 
-====
-Hostname: {hostname}
-Callstack:
-    at {callstack}
-""".format(problem=problem, hostname=socket.getfqdn(), callstack=callstack)
 
-    send_mail(
-        MAIL_ROOT,
-        '[ocflib] Problem report from ' + socket.getfqdn(),
-        body,
-        sender='ocflib <root@ocf.berkeley.edu>',
+def _capture_stack(frame):
+    """Return the call stack from a frame, innermost first, as a tuple of
+    "file:line (function)" strings.
+
+    Unlike inspect.stack(), this doesn't read any source files.
+    """
+    return tuple(
+        '{}:{} ({})'.format(summary.filename, summary.lineno, summary.name)
+        for summary in traceback.StackSummary.extract(traceback.walk_stack(frame), lookup_lines=False)
     )
+
+
+def _format_problem(problem, stack):
+    return '{problem}\n\nCallstack:\n    at {callstack}\n'.format(
+        problem=problem,
+        callstack='\n        by '.join(stack),
+    )
+
+
+class ProblemReporter:
+    """Mails problem reports to OCF staff without flooding them.
+
+    A report identical to an earlier one (same problem and call stack) within
+    `dedup_window` seconds isn't sent again, just counted. At most
+    `max_reports` mails are sent every `period` seconds; reports beyond that
+    are held and sent together in one digest when the period is up, along
+    with the counts of repeated reports.
+    """
+
+    def __init__(self, dedup_window=600, max_reports=5, period=600, clock=time.monotonic):
+        self.dedup_window = dedup_window
+        self.max_reports = max_reports
+        self.period = period
+        self.clock = clock
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        # (problem, stack) -> time first reported
+        self._seen = {}
+        # (problem, stack) -> times repeated since the last digest
+        self._repeats = collections.Counter()
+        # times mails were sent within the last period
+        self._sent = collections.deque()
+        self._held = []
+        self._timer = None
+        self._pid = os.getpid()
+
+    def _expire(self, now):
+        while self._sent and self._sent[0] <= now - self.period:
+            self._sent.popleft()
+        for key, first in list(self._seen.items()):
+            if first <= now - self.dedup_window:
+                del self._seen[key]
+
+    def report(self, problem, stack):
+        """Report a problem, given the call stack (see _capture_stack)."""
+        if self._pid != os.getpid():
+            # anything held belongs to the parent, and the timer is gone
+            self._reset()
+
+        key = (problem, stack)
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            if key in self._seen:
+                self._repeats[key] += 1
+                return
+            self._seen[key] = now
+
+            if self._held or len(self._sent) >= self.max_reports:
+                self._held.append(key)
+                if self._timer is None:
+                    delay = max(self._sent[0] + self.period - now, 0) if self._sent else 0
+                    self._timer = threading.Timer(delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            self._sent.append(now)
+
+        self._send(
+            '[ocflib] Problem report from ' + socket.getfqdn(),
+            'A problem was encountered and reported via ocflib:\n\n' + _format_problem(*key),
+        )
+
+    def flush(self):
+        """Send a digest of held and repeated reports now, if there are any."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            held, self._held = self._held, []
+            repeats, self._repeats = self._repeats, collections.Counter()
+            if not held and not repeats:
+                return
+            self._sent.append(self.clock())
+
+        sections = [_format_problem(*key) for key in held]
+        if repeats:
+            sections.append('Repeated reports:\n' + '\n'.join(
+                '    {} more time(s): {}'.format(count, problem)
+                for (problem, _), count in repeats.most_common()
+            ))
+        self._send(
+            '[ocflib] {} problem report(s) from {}'.format(len(held) + sum(repeats.values()), socket.getfqdn()),
+            'Problems were encountered and reported via ocflib:\n\n' + '\n====\n'.join(sections),
+        )
+
+    def _send(self, subject, body):
+        send_mail(
+            MAIL_ROOT,
+            subject,
+            '{body}\n====\nHostname: {hostname}\n'.format(body=body, hostname=socket.getfqdn()),
+            sender='ocflib <root@ocf.berkeley.edu>',
+        )
+
+
+problem_reporter = ProblemReporter()
+atexit.register(problem_reporter.flush)
+
+
+def send_problem_report(problem):
+    """Send a problem report to OCF staff.
+
+    Repeated and excessive reports are deduplicated and batched (see
+    ProblemReporter)."""
+    problem_reporter.report(problem, _capture_stack(sys._getframe(1)))
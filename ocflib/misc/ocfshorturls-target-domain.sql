@@ -0,0 +1,13 @@
+--
+-- Migration for existing `ocfshorturls` databases: adds the indexed
+-- `target_domain` column (the lowercased host of each target) used by
+-- search_shorturls(target_domain=...), and exposes it in `shorturls_public`.
+--
+-- New databases get this from ocfshorturls.sql and don't need it.
+--
+
+ALTER TABLE `shorturls`
+  ADD COLUMN `target_domain` varchar(255) GENERATED ALWAYS AS (lower(substring_index(substring_index(substring_index(substring_index(substring_index(`target`,'://',-1),'/',1),'?',1),'@',-1),':',1))) STORED,
+  ADD KEY `target_domain` (`target_domain`);
+
+CREATE OR REPLACE ALGORITHM=UNDEFINED DEFINER=`ocfshorturls`@`%` SQL SECURITY DEFINER VIEW `shorturls_public`  AS  select `shorturls`.`slug` AS `slug`,`shorturls`.`target` AS `target`,`shorturls`.`target_domain` AS `target_domain` from `shorturls` ;
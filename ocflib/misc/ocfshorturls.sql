@@ -32,7 +32,8 @@ CREATE TABLE `shorturls` (
   `id` int(11) NOT NULL,
   `time_created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
   `slug` varchar(100) NOT NULL,
-  `target` text NOT NULL
+  `target` text NOT NULL,
+  `target_domain` varchar(255) GENERATED ALWAYS AS (lower(substring_index(substring_index(substring_index(substring_index(substring_index(`target`,'://',-1),'/',1),'?',1),'@',-1),':',1))) STORED
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 -- --------------------------------------------------------
@@ -44,6 +45,7 @@ CREATE TABLE `shorturls` (
 CREATE TABLE `shorturls_public` (
 `slug` varchar(100)
 ,`target` text
+,`target_domain` varchar(255)
 );
 
 -- --------------------------------------------------------
@@ -53,7 +55,7 @@ CREATE TABLE `shorturls_public` (
 --
 DROP TABLE IF EXISTS `shorturls_public`;
 
-CREATE ALGORITHM=UNDEFINED DEFINER=`ocfshorturls`@`%` SQL SECURITY DEFINER VIEW `shorturls_public`  AS  select `shorturls`.`slug` AS `slug`,`shorturls`.`target` AS `target` from `shorturls` ;
+CREATE ALGORITHM=UNDEFINED DEFINER=`ocfshorturls`@`%` SQL SECURITY DEFINER VIEW `shorturls_public`  AS  select `shorturls`.`slug` AS `slug`,`shorturls`.`target` AS `target`,`shorturls`.`target_domain` AS `target_domain` from `shorturls` ;
 
 --
 -- Indexes for dumped tables
@@ -64,7 +66,8 @@ CREATE ALGORITHM=UNDEFINED DEFINER=`ocfshorturls`@`%` SQL SECURITY DEFINER VIEW
 --
 ALTER TABLE `shorturls`
   ADD PRIMARY KEY (`id`),
-  ADD UNIQUE KEY `slug` (`slug`);
+  ADD UNIQUE KEY `slug` (`slug`),
+  ADD KEY `target_domain` (`target_domain`);
 
 --
 -- AUTO_INCREMENT for dumped tables
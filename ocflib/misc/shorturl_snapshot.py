@@ -0,0 +1,251 @@
+"""Compiled shorturl snapshot files, for redirecting without MySQL.
+
+A snapshot is every shorturl from list_shorturls, written to a file which
+readers mmap; lookups binary search the file directly, so opening one is
+instant and the table lives in the page cache (shared between processes)
+rather than on each process's heap.
+
+The file is laid out as:
+
+    header:  magic (8 bytes), number of shorturls n (uint32), padding
+    offsets: 2n + 1 uint32 offsets into the data, from the start of the file
+    data:    slug 0, target 0, slug 1, target 1, ... (UTF-8, no separators)
+
+Shorturls are sorted by the UTF-8 bytes of their slugs, so slug i runs from
+offset 2i to 2i + 1 and its target from offset 2i + 1 to 2i + 2.
+
+Example usage:
+
+    # on a cron, or after shorturls change
+    with get_connection() as ctx:
+        export_shorturl_snapshot(ctx, '/var/lib/shorturls.snapshot')
+
+    # in the redirector
+    snapshots = SnapshotReader('/var/lib/shorturls.snapshot')
+    target = snapshots.get('wiki')
+    matches = snapshots.snapshot.containing('docs', limit=20)
+"""
+import array
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from ocflib.misc.shorturls import list_shorturls
+
+SNAPSHOT_MAGIC = b'OCFSURL1'
+_HEADER = struct.Struct('<8sII')
+_OFFSET = struct.Struct('<I')
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def write_shorturl_snapshot(path, shorturls):
+    """Write a snapshot of (slug, target) pairs to a file.
+
+    The snapshot is written to a temporary file which is then renamed over
+    `path`, so readers never see a partial file.
+    """
+    pairs = sorted(
+        (slug.encode('utf8'), target.encode('utf8'))
+        for slug, target in dict(shorturls).items()
+    )
+
+    offsets = []
+    offset = _HEADER.size + _OFFSET.size * (2 * len(pairs) + 1)
+    for slug, target in pairs:
+        offsets.append(offset)
+        offset += len(slug)
+        offsets.append(offset)
+        offset += len(target)
+    offsets.append(offset)
+    if offset > 0xffffffff:
+        raise ValueError('Too many shorturls for one snapshot.')
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.shorturls-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(SNAPSHOT_MAGIC, len(pairs), 0))
+            f.write(struct.pack('<{}I'.format(len(offsets)), *offsets))
+            for slug, target in pairs:
+                f.write(slug)
+                f.write(target)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def export_shorturl_snapshot(ctx, path):
+    """Write a snapshot of every shorturl to a file."""
+    write_shorturl_snapshot(path, ((row['slug'], row['target']) for row in list_shorturls(ctx)))
+
+
+class ShorturlSnapshot:
+    """A snapshot file, mmapped for lookups.
+
+    Raises ValueError if the file isn't a valid snapshot.
+    """
+
+    def __init__(self, path):
+        self._index = None
+        self._index_lock = threading.Lock()
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            if self.stat.st_size < _HEADER.size:
+                raise ValueError('{} is not a shorturl snapshot.'.format(path))
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._count, _ = _HEADER.unpack_from(self._map)
+        end = _HEADER.size + _OFFSET.size * (2 * self._count + 1)
+        if magic != SNAPSHOT_MAGIC or end > len(self._map) or self._offset(2 * self._count) != len(self._map):
+            self._map.close()
+            raise ValueError('{} is not a shorturl snapshot.'.format(path))
+
+    def _offset(self, i):
+        return _OFFSET.unpack_from(self._map, _HEADER.size + _OFFSET.size * i)[0]
+
+    def _slug(self, i):
+        return self._map[self._offset(2 * i):self._offset(2 * i + 1)]
+
+    def _target(self, i):
+        return self._map[self._offset(2 * i + 1):self._offset(2 * i + 2)].decode('utf8')
+
+    def _bisect(self, key):
+        """Return the index of the first slug not less than key."""
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._slug(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, slug):
+        """Return the target of a shorturl, or None if it doesn't exist."""
+        key = slug.encode('utf8')
+        i = self._bisect(key)
+        if i < self._count and self._slug(i) == key:
+            return self._target(i)
+
+    def with_prefix(self, prefix, limit=None):
+        """Return a list of (slug, target) pairs whose slugs start with the
+        prefix, sorted by slug, e.g. for autocomplete."""
+        key = prefix.encode('utf8')
+        matches = []
+        i = self._bisect(key)
+        while i < self._count and (limit is None or len(matches) < limit):
+            slug = self._slug(i)
+            if not slug.startswith(key):
+                break
+            matches.append((slug.decode('utf8'), self._target(i)))
+            i += 1
+        return matches
+
+    def _trigram_index(self):
+        """Return a dict mapping each trigram of the lowercased slugs and
+        targets to an array of the indexes containing it, in order.
+
+        It's built on first use, since only searches need it and it lives on
+        the heap rather than in the page cache.
+        """
+        with self._index_lock:
+            if self._index is None:
+                index = {}
+                for i in range(self._count):
+                    slug, target = self._slug(i).decode('utf8').lower(), self._target(i).lower()
+                    for trigram in _trigrams(slug) | _trigrams(target):
+                        index.setdefault(trigram, array.array('I')).append(i)
+                self._index = index
+            return self._index
+
+    def containing(self, text, limit=None):
+        """Return a list of (slug, target) pairs whose slugs or targets
+        contain the text (ignoring case), sorted by slug.
+
+        Candidates are found with a trigram index, so text shorter than three
+        characters means checking every shorturl.
+        """
+        text = text.lower()
+        if len(text) < 3:
+            candidates = range(self._count)
+        else:
+            index = self._trigram_index()
+            postings = sorted((index.get(trigram, ()) for trigram in _trigrams(text)), key=len)
+            candidates = sorted(set(postings[0]).intersection(*postings[1:]))
+
+        matches = []
+        for i in candidates:
+            if limit is not None and len(matches) >= limit:
+                break
+            slug, target = self._slug(i).decode('utf8'), self._target(i)
+            if text in slug.lower() or text in target.lower():
+                matches.append((slug, target))
+        return matches
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        """Yield (slug, target) pairs, sorted by slug."""
+        for i in range(self._count):
+            yield self._slug(i).decode('utf8'), self._target(i)
+
+    def close(self):
+        self._map.close()
+
+
+class SnapshotReader:
+    """Looks up shorturls in a snapshot file, picking up new snapshots.
+
+    At most every `check_interval` seconds, the file is checked to see if it
+    has been replaced (see write_shorturl_snapshot), and if so the new one is
+    mapped in. Lookups already using the old snapshot finish with it, and its
+    mapping goes away once nothing refers to it.
+    """
+
+    def __init__(self, path, check_interval=5, clock=time.monotonic):
+        self.path = path
+        self.check_interval = check_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._snapshot = ShorturlSnapshot(path)
+        self._checked = clock()
+
+    def _changed(self, stat):
+        old = self._snapshot.stat
+        return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size) != \
+            (old.st_dev, old.st_ino, old.st_mtime_ns, old.st_size)
+
+    def refresh(self):
+        """Map in the snapshot file if it has been replaced.
+
+        If the new file can't be read, the old snapshot stays in use.
+        """
+        with self._lock:
+            self._checked = self.clock()
+            try:
+                if self._changed(os.stat(self.path)):
+                    self._snapshot = ShorturlSnapshot(self.path)
+            except (OSError, ValueError):
+                pass
+
+    @property
+    def snapshot(self):
+        """The current ShorturlSnapshot."""
+        if self.clock() - self._checked >= self.check_interval:
+            self.refresh()
+        return self._snapshot
+
+    def get(self, slug):
+        """Return the target of a shorturl, or None if it doesn't exist."""
+        return self.snapshot.get(slug)
@@ -1,11 +1,17 @@
 import functools
 import re
+import threading
+import time
+from collections import namedtuple
+from collections import OrderedDict
 
 from ocflib.infra import mysql
 
 
 SHORTURL_SLUG_ALLOWED_CHARS = r'^[\w./+:-]+$'
 SHORTURL_REGEX = re.compile(SHORTURL_SLUG_ALLOWED_CHARS)
+BATCH_SIZE = 500
+SEARCH_LIMIT = 50
 
 get_connection = functools.partial(
     mysql.get_connection,
@@ -41,6 +47,7 @@ def add_shorturl(ctx, slug, target):
     # there's a uniqueness constraint on the slug column
     query = 'INSERT INTO `shorturls` (slug, target) VALUES (%s, %s)'
     ctx.execute(query, (slug, target))
+    shorturl_cache.invalidate(slug)
 
 
 def delete_shorturl(ctx, slug):
@@ -48,6 +55,7 @@ def delete_shorturl(ctx, slug):
 
     query = 'DELETE FROM `shorturls` WHERE `slug` = %s'
     ctx.execute(query, (slug,))
+    shorturl_cache.invalidate(slug)
 
 
 def rename_shorturl(ctx, old_slug, new_slug):
@@ -57,6 +65,7 @@ def rename_shorturl(ctx, old_slug, new_slug):
 
     query = 'UPDATE `shorturls` SET `slug` = %s WHERE `slug` = %s'
     ctx.execute(query, (new_slug, old_slug))
+    shorturl_cache.invalidate(old_slug, new_slug)
 
 
 def replace_shorturl(ctx, slug, new_target):
@@ -64,6 +73,7 @@ def replace_shorturl(ctx, slug, new_target):
 
     query = 'UPDATE `shorturls` SET `target` = %s WHERE `slug` = %s'
     ctx.execute(query, (new_target, slug))
+    shorturl_cache.invalidate(slug)
 
 
 def list_shorturls(ctx):
@@ -72,3 +82,280 @@ def list_shorturls(ctx):
     query = 'SELECT `slug`, `target` FROM `shorturls_public`'
     ctx.execute(query)
     return ctx.fetchall()
+
+
+def iter_shorturls(ctx, page_size=BATCH_SIZE):
+    """Yield all shorturls as (slug, target) pairs, in slug order.
+
+    Rows are fetched a page at a time (using keyset pagination on the unique
+    slug index), so the whole table is never held in memory.
+    """
+    last = None
+    while True:
+        if last is None:
+            ctx.execute(
+                'SELECT `slug`, `target` FROM `shorturls_public` ORDER BY `slug` LIMIT %s',
+                (page_size,),
+            )
+        else:
+            ctx.execute(
+                'SELECT `slug`, `target` FROM `shorturls_public` WHERE `slug` > %s ORDER BY `slug` LIMIT %s',
+                (last, page_size),
+            )
+        rows = ctx.fetchall()
+
+        for row in rows:
+            yield row['slug'], row['target']
+
+        if len(rows) < page_size:
+            return
+        last = rows[-1]['slug']
+
+
+ShorturlPage = namedtuple('ShorturlPage', ('shorturls', 'cursor'))
+
+
+def _like_escape(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_shorturls(ctx, prefix=None, target_domain=None, limit=SEARCH_LIMIT, cursor=None):
+    """Search shorturls, a page at a time in slug order.
+
+    :param prefix: slugs starting with this (uses the slug index)
+    :param target_domain: targets on this host, e.g. 'www.ocf.berkeley.edu'
+                          (uses the target_domain index)
+    :param limit: maximum number of shorturls to return
+    :param cursor: the cursor from the previous page, to get the next one
+
+    Returns a ShorturlPage of (slug, target) pairs and the cursor for the
+    next page (None if this is the last page).
+
+    Every filter here is backed by an index; for substring search, which
+    can't use one, see ShorturlSnapshot.containing.
+    """
+    clauses, args = [], []
+    if prefix:
+        clauses.append('`slug` LIKE %s')
+        args.append(_like_escape(prefix) + '%')
+    if target_domain:
+        clauses.append('`target_domain` = %s')
+        args.append(target_domain.lower())
+    if cursor is not None:
+        clauses.append('`slug` > %s')
+        args.append(cursor)
+
+    ctx.execute(
+        'SELECT `slug`, `target` FROM `shorturls_public` {where} ORDER BY `slug` LIMIT %s'.format(
+            where='WHERE ' + ' AND '.join(clauses) if clauses else '',
+        ),
+        tuple(args) + (limit + 1,),
+    )
+    rows = ctx.fetchall()
+
+    shorturls = [(row['slug'], row['target']) for row in rows[:limit]]
+    return ShorturlPage(
+        shorturls=shorturls,
+        cursor=shorturls[-1][0] if len(rows) > limit else None,
+    )
+
+
+ShorturlImport = namedtuple('ShorturlImport', ('added', 'replaced', 'conflicts', 'unchanged'))
+
+
+def _existing_targets(ctx, slugs):
+    """Return a dict of slug -> target for the slugs which exist."""
+    existing = {}
+    for i in range(0, len(slugs), BATCH_SIZE):
+        batch = slugs[i:i + BATCH_SIZE]
+        ctx.execute(
+            'SELECT `slug`, `target` FROM `shorturls` WHERE `slug` IN ({})'.format(', '.join(['%s'] * len(batch))),
+            tuple(batch),
+        )
+        existing.update((row['slug'], row['target']) for row in ctx.fetchall())
+    return existing
+
+
+def import_shorturls(ctx, shorturls, on_conflict='skip'):
+    """Add many shorturls at once.
+
+    `shorturls` is an iterable of (slug, target) pairs. Slugs which already
+    exist are left alone if `on_conflict` is 'skip', or pointed at the new
+    target if it's 'replace'. Problems with individual shorturls don't stop
+    the rest from being imported.
+
+    Returns a ShorturlImport of the slugs added, the slugs whose targets were
+    replaced, a dict of slug -> reason for each slug that wasn't imported
+    (invalid, repeated in the import, or already existing with a different
+    target when skipping), and the slugs which already existed with the same
+    target.
+
+    When skipping, slugs which are added by someone else between checking
+    and inserting are reported as conflicts if their targets differ (and as
+    added if they don't, since the result is the same).
+    """
+    if on_conflict not in ('skip', 'replace'):
+        raise ValueError("on_conflict must be 'skip' or 'replace', not '{}'".format(on_conflict))
+
+    conflicts = {}
+    targets = {}
+    for slug, target in shorturls:
+        if slug in targets or slug in conflicts:
+            targets.pop(slug, None)
+            conflicts[slug] = 'slug appears more than once in the import'
+            continue
+        try:
+            _validate_slug(slug)
+        except ValueError as ex:
+            conflicts[slug] = str(ex)
+        else:
+            targets[slug] = target
+
+    existing = _existing_targets(ctx, list(targets))
+    added = [slug for slug in targets if slug not in existing]
+    replaced = []
+    unchanged = []
+    for slug, old_target in existing.items():
+        if old_target == targets[slug]:
+            unchanged.append(slug)
+        elif on_conflict == 'skip':
+            conflicts[slug] = 'already exists with target {}'.format(old_target)
+        else:
+            replaced.append(slug)
+
+    rows = [(slug, targets[slug]) for slug in added + replaced]
+    for i in range(0, len(rows), BATCH_SIZE):
+        batch = rows[i:i + BATCH_SIZE]
+        # pymysql turns this into one multi-row INSERT per batch; rows which
+        # appeared since we looked are left alone when skipping
+        ctx.executemany(
+            'INSERT INTO `shorturls` (slug, target) VALUES (%s, %s) ' + (
+                'ON DUPLICATE KEY UPDATE `target` = VALUES(`target`)'
+                if on_conflict == 'replace' else
+                'ON DUPLICATE KEY UPDATE `slug` = `slug`'
+            ),
+            batch,
+        )
+        # each row we inserted counts as one affected row, and rows left
+        # alone as none, so a short count means some appeared since we looked
+        if on_conflict == 'skip' and ctx.rowcount < len(batch):
+            current = _existing_targets(ctx, [slug for slug, _ in batch])
+            for slug, target in batch:
+                if current.get(slug, target) != target:
+                    added.remove(slug)
+                    conflicts[slug] = 'already exists with target {}'.format(current[slug])
+    if rows:
+        shorturl_cache.invalidate(*(slug for slug, _ in rows))
+
+    return ShorturlImport(added=added, replaced=replaced, conflicts=conflicts, unchanged=unchanged)
+
+
+class ShorturlCache:
+    """In-process LRU cache of shorturl slug -> target, for redirecting.
+
+    Targets are kept for `ttl` seconds, and slugs which don't exist for
+    `negative_ttl` seconds. At most `size` slugs are kept. A hit doesn't touch
+    MySQL at all; a miss opens a connection with `connect` unless a cursor is
+    passed in.
+
+    The functions in this module which change shorturls invalidate the
+    affected slugs, but only in this process's cache. Other processes (and
+    changes made outside ocflib) aren't noticed until the entries expire, so
+    a changed or deleted shorturl can keep redirecting to its old target for
+    up to `ttl` seconds, and a new one can keep 404ing for up to
+    `negative_ttl` seconds. The defaults keep that window short; callers
+    which need to see changes immediately should call get_shorturl instead.
+
+    Every invalidation bumps `version`, and lookups or reloads which were
+    running at the time don't store what they read, since it may be stale.
+
+    Example usage:
+
+        target = shorturl_cache.get('wiki')
+    """
+
+    def __init__(self, size=10000, ttl=60, negative_ttl=10, connect=get_connection, clock=time.monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.connect = connect
+        self.clock = clock
+        self.version = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _query(self, ctx, func, *args):
+        if ctx is not None:
+            return func(ctx, *args)
+        with self.connect() as ctx:
+            return func(ctx, *args)
+
+    def get(self, slug, ctx=None):
+        """Return the target of a shorturl, or None if it doesn't exist."""
+        now = self.clock()
+        with self._lock:
+            entry = self._cache.get(slug)
+            if entry is not None:
+                expires, target = entry
+                if now < expires:
+                    self._cache.move_to_end(slug)
+                    return target
+                del self._cache[slug]
+            version = self.version
+
+        target = self._query(ctx, get_shorturl, slug)
+
+        with self._lock:
+            if self.version == version:
+                self._cache[slug] = (now + (self.ttl if target is not None else self.negative_ttl), target)
+                self._cache.move_to_end(slug)
+                while len(self._cache) > self.size:
+                    self._cache.popitem(last=False)
+        return target
+
+    def invalidate(self, *slugs):
+        """Forget the cached targets of some slugs."""
+        with self._lock:
+            for slug in slugs:
+                self._cache.pop(slug, None)
+            self.version += 1
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.version += 1
+
+    def reload(self, ctx=None, attempts=3):
+        """Replace the cache with every shorturl (see list_shorturls).
+
+        If shorturls are changed while loading, the load is retried (up to
+        `attempts` times in total). Returns whether the cache was replaced.
+        """
+        for _ in range(attempts):
+            with self._lock:
+                version = self.version
+            now = self.clock()
+            rows = self._query(ctx, list_shorturls)
+
+            cache = OrderedDict()
+            for row in rows[:self.size]:
+                cache[row['slug']] = (now + self.ttl, row['target'])
+
+            with self._lock:
+                if self.version == version:
+                    self._cache = cache
+                    self.version += 1
+                    return True
+        return False
+
+    def __len__(self):
+        return len(self._cache)
+
+
+shorturl_cache = ShorturlCache()
+
+
+def resolve_shorturl(slug):
+    """Get the target of a shorturl by its slug, using the in-process cache
+    (see ShorturlCache)."""
+    return shorturl_cache.get(slug)
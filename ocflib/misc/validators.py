@@ -1,19 +1,16 @@
 """Misc validators for things like emails, domains, etc."""
 import re
 
-import dns.resolver
-
-from ocflib.infra.net import OCF_DNS_RESOLVER
+from ocflib.infra.resolver import CONCURRENCY
+from ocflib.infra.resolver import resolve
+from ocflib.infra.resolver import resolve_many
 
 
 def host_exists(host):
-    try:
-        message = dns.message.make_query(host, dns.rdatatype.ANY)
-    except dns.name.EmptyLabel:
-        return False
+    """Verifies that the host has DNS records.
 
-    response = dns.query.udp(message, str(OCF_DNS_RESOLVER))
-    return bool(response.answer)
+    Answers are cached (see ocflib.infra.resolver)."""
+    return bool(resolve(host, 'ANY'))
 
 
 def email_host_exists(email_addr):
@@ -24,22 +21,71 @@ def email_host_exists(email_addr):
     return False
 
 
-def valid_email(email):
-    """Check the email with naive regex and check for the domain's MX record.
-    Returns True for valid email, False for bad email."""
-    regex = r'^[a-z0-9._%\-+]+@([a-z0-9._%\-]+.[a-z]{2,})$'
+EMAIL_REGEX = re.compile(r'^[a-z0-9._%\-+]+@([a-z0-9._%\-]+.[a-z]{2,})$', re.IGNORECASE)
+
+# Domains we know accept mail, so there's no need to ask DNS
+KNOWN_EMAIL_DOMAINS = frozenset({
+    'ocf.berkeley.edu',
+    'berkeley.edu',
+})
 
-    m = re.match(regex, email, re.IGNORECASE)
+
+def _email_domain(email):
+    """Return the domain of the email if it passes a naive regex, else None."""
+    m = EMAIL_REGEX.match(email)
     if m:
-        domain = m.group(1)
-        try:
-            # Check that the domain has MX record(s)
-            return bool(dns.resolver.query(domain, 'MX'))
-        except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
-            pass
+        return m.group(1)
+
+
+def _needs_mx_check(domain, check_dns, known_domains):
+    return check_dns and domain.lower() not in known_domains
+
+
+def valid_email(email, check_dns=True, known_domains=KNOWN_EMAIL_DOMAINS):
+    """Check the email with naive regex and check for the domain's MX record.
+    Returns True for valid email, False for bad email.
+
+    Domains in `known_domains` are assumed to have MX records, and only the
+    regex is checked if `check_dns` is False."""
+    domain = _email_domain(email)
+    if domain:
+        if not _needs_mx_check(domain, check_dns, known_domains):
+            return True
+        # Check that the domain has MX record(s)
+        return bool(resolve(domain, 'MX'))
     return False
 
 
+def validate_emails(emails, check_dns=True, known_domains=KNOWN_EMAIL_DOMAINS, concurrency=CONCURRENCY):
+    """Check many emails as valid_email does.
+
+    Each distinct domain is only looked up once, and uncached domains are
+    looked up concurrently (at most `concurrency` at a time), so this takes
+    time in proportion to the number of distinct domains.
+
+    Returns a dict mapping each email to True or False, or to the exception
+    raised looking up its domain (e.g. a timeout).
+    """
+    domains = {email: _email_domain(email) for email in emails}
+    records = resolve_many(
+        {domain for domain in domains.values() if domain and _needs_mx_check(domain, check_dns, known_domains)},
+        'MX',
+        concurrency=concurrency,
+    )
+
+    results = {}
+    for email, domain in domains.items():
+        if not domain:
+            results[email] = False
+        elif domain not in records:
+            results[email] = True
+        elif isinstance(records[domain], Exception):
+            results[email] = records[domain]
+        else:
+            results[email] = bool(records[domain])
+    return results
+
+
 # Pulled from /etc/shells on tsunami
 VALID_LOGIN_SHELLS = frozenset({
     '/bin/sh',
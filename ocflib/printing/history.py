@@ -0,0 +1,108 @@
+"""Reading print job and refund history.
+
+Jobs are streamed in (time, id) order using keyset pagination, so walking the
+history of even the heaviest users never needs large OFFSETs or holds the
+whole result set in memory. The filters are covered by the `jobs_*_time_idx`
+indexes in ocfprinting.sql.
+
+Example usage:
+
+    with get_connection(user='ocfprinting', password='...') as c:
+        for job in iter_jobs(c, user='ckuehl', since=datetime(2019, 1, 1)):
+            print(job.time, job.pages)
+"""
+from ocflib.printing.quota import Job
+from ocflib.printing.quota import Refund
+
+PAGE_SIZE = 1000
+
+
+def _filters(user=None, printer=None, since=None, until=None):
+    """Return a WHERE clause fragment and arguments for the given filters.
+
+    `since` is inclusive and `until` is exclusive.
+    """
+    clauses, args = [], []
+    for clause, value in (
+        ('`user` = %s', user),
+        ('`printer` = %s', printer),
+        ('`time` >= %s', since),
+        ('`time` < %s', until),
+    ):
+        if value is not None:
+            clauses.append(clause)
+            args.append(value)
+    return clauses, args
+
+
+def _iter_rows(c, table, cls, clauses, args, page_size):
+    columns = ', '.join('`{}`'.format(column) for column in ('id',) + cls._fields)
+    last = None
+    while True:
+        page_clauses, page_args = list(clauses), list(args)
+        if last is not None:
+            page_clauses.append('(`time` > %s OR (`time` = %s AND `id` > %s))')
+            page_args.extend((last['time'], last['time'], last['id']))
+
+        c.execute(
+            'SELECT {columns} FROM `{table}` {where} ORDER BY `time`, `id` LIMIT %s'.format(
+                columns=columns,
+                table=table,
+                where='WHERE ' + ' AND '.join(page_clauses) if page_clauses else '',
+            ),
+            tuple(page_args) + (page_size,),
+        )
+        rows = c.fetchall()
+
+        for row in rows:
+            yield cls(**{field: row[field] for field in cls._fields})
+
+        if len(rows) < page_size:
+            return
+        last = rows[-1]
+
+
+def iter_jobs(c, user=None, printer=None, since=None, until=None, page_size=PAGE_SIZE):
+    """Yield Job objects in chronological order, optionally filtered.
+
+    :param since: datetime, inclusive
+    :param until: datetime, exclusive
+    :param page_size: number of rows fetched per query
+    """
+    clauses, args = _filters(user=user, printer=printer, since=since, until=until)
+    return _iter_rows(c, 'jobs', Job, clauses, args, page_size)
+
+
+def iter_refunds(c, user=None, since=None, until=None, page_size=PAGE_SIZE):
+    """Yield Refund objects in chronological order, optionally filtered.
+
+    :param since: datetime, inclusive
+    :param until: datetime, exclusive
+    :param page_size: number of rows fetched per query
+    """
+    clauses, args = _filters(user=user, since=since, until=until)
+    return _iter_rows(c, 'refunds', Refund, clauses, args, page_size)
+
+
+def _aggregate(c, key, user, printer, since, until):
+    clauses, args = _filters(user=user, printer=printer, since=since, until=until)
+    c.execute(
+        'SELECT {key} AS `key`, SUM(`pages`) AS `pages` FROM `jobs` {where} '
+        'GROUP BY `key` ORDER BY `key`'.format(
+            key=key,
+            where='WHERE ' + ' AND '.join(clauses) if clauses else '',
+        ),
+        tuple(args),
+    )
+    return {row['key']: int(row['pages']) for row in c.fetchall()}
+
+
+def pages_by_printer(c, user=None, since=None, until=None):
+    """Return a dict mapping printer to total pages printed on it."""
+    return _aggregate(c, '`printer`', user, None, since, until)
+
+
+def pages_by_hour(c, user=None, printer=None, since=None, until=None):
+    """Return a dict mapping hour of the day (0-23) to total pages printed
+    during that hour."""
+    return _aggregate(c, 'HOUR(`time`)', user, printer, since, until)
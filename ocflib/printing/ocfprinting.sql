@@ -27,9 +27,24 @@ CREATE TABLE IF NOT EXISTS `refunds` (
     PRIMARY KEY(`id`)
 ) ENGINE=InnoDB;
 
+-- pages reserved by ocflib.printing.quota.price_job for jobs in flight
+CREATE TABLE IF NOT EXISTS `quota_holds` (
+    `user` varchar(255) NOT NULL,
+    `day` date NOT NULL,
+    `pages` int NOT NULL,
+    `color` int NOT NULL,
+    PRIMARY KEY (`user`)
+) ENGINE=InnoDB;
+
 CREATE INDEX `jobs_idx` ON `jobs` (`user`, `time`, `pages`);
 CREATE INDEX `refunds_idx` ON `refunds` (`user`, `time`, `pages`);
 
+-- keyset pagination in ocflib.printing.history orders by (time, id)
+CREATE INDEX `jobs_time_idx` ON `jobs` (`time`, `id`);
+CREATE INDEX `jobs_user_time_idx` ON `jobs` (`user`, `time`, `id`);
+CREATE INDEX `jobs_printer_time_idx` ON `jobs` (`printer`, `time`, `id`);
+CREATE INDEX `refunds_user_time_idx` ON `refunds` (`user`, `time`, `id`);
+
 DROP FUNCTION IF EXISTS semester_start;
 DELIMITER $$
 CREATE FUNCTION semester_start (d date) RETURNS date
@@ -1,10 +1,18 @@
 """Information, stats, and control of printers."""
 import asyncio
+import threading
+import time
+import traceback
+from collections import namedtuple
 
 import puresnmp
 
+from ocflib.misc.mail import send_problem_report
+
 PRINTERS = ['logjam', 'pagefault', 'papercut', 'fishpaper']
 
+SNMP_PORT = 161
+
 OID_TONER_MAX = '1.3.6.1.2.1.43.11.1.1.8.1.1'
 OID_TONER_CUR = '1.3.6.1.2.1.43.11.1.1.9.1.1'
 
@@ -22,7 +30,7 @@ OID_TRAY_NAME = '1.3.6.1.2.1.43.8.2.1.13.1'
 
 def _snmp(host, oid):
     try:
-        client = puresnmp.PyWrapper(puresnmp.Client(host, puresnmp.V2C('public')))
+        client = puresnmp.PyWrapper(puresnmp.Client(host, puresnmp.V2C('public'), port=SNMP_PORT))
         return asyncio.run(client.get(oid))
     except Exception as e:
         raise IOError('Device {} returned SNMP error: {}'.format(host, e)) from e
@@ -30,7 +38,7 @@ def _snmp(host, oid):
 
 def _snmp_walk(host, oid):
     try:
-        client = puresnmp.PyWrapper(puresnmp.Client(host, puresnmp.V2C('public')))
+        client = puresnmp.PyWrapper(puresnmp.Client(host, puresnmp.V2C('public'), port=SNMP_PORT))
 
         async def _collect():
             return [item async for item in client.walk(oid)]
@@ -94,3 +102,142 @@ def get_status(printer):
     """
     results = _snmp_walk(printer, OID_STATUS)
     return [value.decode() if isinstance(value, bytes) else str(value) for _, value in results if value]
+
+
+PrinterSnapshot = namedtuple('PrinterSnapshot', (
+    'printer',
+    'toner',
+    'trays',
+    'status',
+    'pages',
+    'polled_at',
+))
+
+CachedPrinterStatus = namedtuple('CachedPrinterStatus', (
+    'snapshot',
+    'age',
+    'stale',
+    'error',
+))
+
+
+def poll_printer(printer):
+    """Return a PrinterSnapshot with the current state of the given printer.
+
+    Raises IOError if the printer can't be reached.
+    """
+    return PrinterSnapshot(
+        printer=printer,
+        toner=get_toner(printer),
+        trays=get_paper_trays(printer),
+        status=get_status(printer),
+        pages=get_lifetime_pages(printer),
+        polled_at=time.time(),
+    )
+
+
+class PrinterStatusCache:
+    """Last-known status of a set of printers, refreshed in the background.
+
+    Readers never talk to the printers; they get whatever snapshot the most
+    recent successful poll produced, along with its age in seconds. A printer
+    which has missed `max_missed_polls` polls in a row (or which has never
+    been polled successfully) is reported as stale.
+
+    Example usage:
+
+        cache = PrinterStatusCache(interval=60)
+        cache.start()
+
+        status = cache.get('logjam')
+        if not status.stale:
+            cur, max = status.snapshot.toner
+    """
+
+    def __init__(self, printers=PRINTERS, interval=60, max_missed_polls=3, poll=poll_printer):
+        self.printers = tuple(printers)
+        self.interval = interval
+        self.max_missed_polls = max_missed_polls
+        self._poll = poll
+        self._lock = threading.Lock()
+        self._snapshots = {}
+        self._missed_polls = {printer: 0 for printer in self.printers}
+        self._errors = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """Poll every printer once, updating the cached snapshots."""
+        for printer in self.printers:
+            try:
+                snapshot = self._poll(printer)
+            except (IOError, ValueError) as ex:
+                # unreachable, or returned something other than a number
+                self._missed_poll(printer, ex)
+            except Exception as ex:
+                # a bug rather than a printer problem, but keep polling the
+                # rest (and keep the refresh thread alive)
+                send_problem_report(
+                    'Unexpected error polling printer {}:\n\n{}'.format(printer, traceback.format_exc()),
+                )
+                self._missed_poll(printer, ex)
+            else:
+                with self._lock:
+                    self._snapshots[printer] = snapshot
+                    self._missed_polls[printer] = 0
+                    self._errors.pop(printer, None)
+
+    def _missed_poll(self, printer, ex):
+        with self._lock:
+            self._missed_polls[printer] += 1
+            self._errors[printer] = str(ex)
+
+    def get(self, printer):
+        """Return a CachedPrinterStatus for the given printer.
+
+        The snapshot and age are None if the printer has never been polled
+        successfully. The error is that of the latest poll, or None if it
+        succeeded.
+        """
+        with self._lock:
+            snapshot = self._snapshots.get(printer)
+            missed = self._missed_polls.get(printer, 0)
+            error = self._errors.get(printer)
+
+        if snapshot is None:
+            return CachedPrinterStatus(snapshot=None, age=None, stale=True, error=error)
+
+        return CachedPrinterStatus(
+            snapshot=snapshot,
+            age=max(0, time.time() - snapshot.polled_at),
+            stale=missed >= self.max_missed_polls,
+            error=error,
+        )
+
+    def get_all(self):
+        """Return a dict mapping each printer to its CachedPrinterStatus."""
+        return {printer: self.get(printer) for printer in self.printers}
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """Start refreshing in a daemon thread, polling immediately."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='PrinterStatusCache',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the refresh thread, waiting for any in-progress poll."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
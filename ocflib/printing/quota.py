@@ -1,11 +1,17 @@
 import functools
+import os
 from collections import namedtuple
+from datetime import date
 from datetime import datetime
+from datetime import timedelta
+
+import yaml
 
 from ocflib.account.search import user_exists
 from ocflib.account.search import user_is_group
 from ocflib.account.utils import is_in_group
 from ocflib.infra import mysql
+from ocflib.lab.stats import semester_dates
 
 WEEKDAY_QUOTA = 30
 WEEKEND_QUOTA = 30
@@ -23,6 +29,18 @@ HAPPY_HOUR_QUOTA = 20
 HAPPY_HOUR_START = datetime(2019, 5, 6)
 HAPPY_HOUR_END = datetime(2019, 5, 17)
 
+# Temporary quota changes (see above) are listed here rather than in code, e.g.
+#
+#   overrides:
+#     - reason: Finals week happy hour
+#       start: 2019-05-06
+#       end: 2019-05-16
+#       quota: 20
+QUOTA_CONFIG = '/etc/ocf/printing-quota.yaml'
+
+# Queues whose jobs count against the color quota
+COLOR_QUEUES = ('color-single', 'color-double', 'epson', 'OCF-Color')
+
 
 get_connection = functools.partial(mysql.get_connection,
                                    user='anonymous',
@@ -56,16 +74,41 @@ Refund = namedtuple('Refund', (
     'color',
 ))
 
+QuotaOverride = namedtuple('QuotaOverride', (
+    'start',
+    'end',
+    'quota',
+    'reason',
+), defaults=('',))
 
-def daily_quota(day=None):
-    """Return the daily quota for a given day.
+JobPrice = namedtuple('JobPrice', (
+    'user',
+    'pages',
+    'color',
+    'approved',
+    'quota',
+))
+
+
+def _quota_override(override):
+    """Return a QuotaOverride from a QuotaOverride or a dict from the quota
+    config, raising ValueError if it's missing fields or has unknown ones."""
+    if isinstance(override, QuotaOverride):
+        return override
+
+    missing = {'start', 'end', 'quota'} - set(override)
+    unknown = set(override) - set(QuotaOverride._fields)
+    if missing or unknown:
+        raise ValueError('Invalid quota override {!r} (missing: {}, unknown: {})'.format(
+            override,
+            ', '.join(sorted(missing)) or 'none',
+            ', '.join(sorted(unknown)) or 'none',
+        ))
+    return QuotaOverride(**override)
 
-    :param day: date object (defaults to today)
-    """
-    if day is None:
-        day = datetime.today()
 
-    if HAPPY_HOUR_START <= day and day < HAPPY_HOUR_END:
+def _regular_daily_quota(day):
+    if HAPPY_HOUR_START.date() <= day < HAPPY_HOUR_END.date():
         return HAPPY_HOUR_QUOTA
     elif day.weekday() in {5, 6}:
         return WEEKEND_QUOTA
@@ -73,14 +116,122 @@ def daily_quota(day=None):
         return WEEKDAY_QUOTA
 
 
-def get_quota(c, user):
-    """Return a UserQuota representing the user's quota."""
+class QuotaCalendar:
+    """Daily quotas for every day of a semester, computed once up front.
+
+    Overrides (see QUOTA_CONFIG) take precedence over the regular weekday,
+    weekend, and happy hour quotas for the days they cover (inclusive). Days
+    outside the calendar are computed on demand.
+    """
+
+    def __init__(self, start, end, overrides=()):
+        if end < start:
+            raise ValueError('Calendar must end after it starts')
+
+        self.start = start
+        self.end = end
+        self.overrides = tuple(map(_quota_override, overrides))
+
+        self._quotas = [
+            self._compute(start + timedelta(days=i))
+            for i in range((end - start).days + 1)
+        ]
+
+    @classmethod
+    def for_semester(cls, day=None, overrides=()):
+        """Return the calendar for the semester containing the given day."""
+        start, end = semester_dates(day)
+        return cls(start, end, overrides)
+
+    def _compute(self, day):
+        # later overrides win, matching the order they're listed in
+        for override in reversed(self.overrides):
+            if override.start <= day <= override.end:
+                return override.quota
+        return _regular_daily_quota(day)
+
+    def quota_on(self, day=None):
+        """Return the daily quota for a given day.
+
+        :param day: date or datetime object (defaults to today)
+        """
+        if day is None:
+            day = date.today()
+        elif isinstance(day, datetime):
+            day = day.date()
+
+        offset = (day - self.start).days
+        if 0 <= offset < len(self._quotas):
+            return self._quotas[offset]
+        return self._compute(day)
+
+    def items(self):
+        """Yield (date, quota) pairs for each day of the calendar."""
+        for i, quota in enumerate(self._quotas):
+            yield self.start + timedelta(days=i), quota
+
+
+def _read_overrides(path):
+    with open(path) as f:
+        config = yaml.safe_load(f) or {}
+    return config.get('overrides') or ()
+
+
+def read_quota_calendar(day=None, path=QUOTA_CONFIG):
+    """Return the QuotaCalendar for the semester containing the given day,
+    including any overrides from the quota config."""
+    return QuotaCalendar.for_semester(day, _read_overrides(path))
+
+
+@functools.lru_cache(maxsize=4)
+def _regular_calendar(start, end):
+    return QuotaCalendar(start, end)
+
+
+@functools.lru_cache(maxsize=4)
+def _configured_calendar(start, end, path, mtime):
+    return QuotaCalendar(start, end, _read_overrides(path))
+
+
+def default_quota_calendar(day=None):
+    """Return the QuotaCalendar for the semester containing the given day,
+    with the overrides from QUOTA_CONFIG if it exists.
+
+    Calendars are cached, and the config is only read again once it changes.
+    """
+    start, end = semester_dates(day)
+    try:
+        mtime = os.stat(QUOTA_CONFIG).st_mtime_ns
+    except FileNotFoundError:
+        return _regular_calendar(start, end)
+    return _configured_calendar(start, end, QUOTA_CONFIG, mtime)
+
+
+def daily_quota(day=None):
+    """Return the daily quota for a given day, including any overrides from
+    the quota config.
+
+    :param day: date or datetime object (defaults to today)
+    """
+    if day is None:
+        day = datetime.today()
+    if isinstance(day, datetime):
+        day = day.date()
+
+    return default_quota_calendar(day).quota_on(day)
+
+
+def _special_quota(user):
+    """Return the fixed quota for users whose quota doesn't depend on what
+    they've printed, or None for everybody else."""
     if is_in_group(user, 'opstaff'):
         return UserQuota(user, 500, 500, 500)
 
     if not user_exists(user) or user_is_group(user):
         return UserQuota(user, 0, 0, 0)
 
+
+def _printed_quota(c, user, daily):
     c.execute(
         'SELECT `today`, `semester`, `color` FROM `printed` WHERE `user` = %s',
         (user,)
@@ -92,12 +243,108 @@ def get_quota(c, user):
     semesterly = SEMESTERLY_QUOTA - int(row['semester'])
     return UserQuota(
         user=user,
-        daily=min(semesterly, daily_quota() - int(row['today'])),
+        daily=min(semesterly, daily - int(row['today'])),
         semesterly=semesterly,
         color=min(semesterly, COLOR_QUOTA - int(row['color'])),
     )
 
 
+def get_quota(c, user, calendar=None):
+    """Return a UserQuota representing the user's quota.
+
+    :param calendar: QuotaCalendar to take today's quota from (defaults to
+                     default_quota_calendar)
+    """
+    special = _special_quota(user)
+    if special is not None:
+        return special
+
+    return _printed_quota(c, user, calendar.quota_on() if calendar else daily_quota())
+
+
+def price_job(c, user, pages, color=False, calendar=None):
+    """Check a job against the user's quota, reserving the pages if it fits.
+
+    Reserved pages are held (in the `quota_holds` table) until the job is
+    recorded with add_job, or released with release_job if it doesn't print.
+    Holds count against the quota, and the check and reservation happen in a
+    single conditional UPDATE on the user's (locked) hold row, so concurrent
+    jobs from the same user can't together exceed their quota. This all runs
+    in one transaction, or as part of the caller's if it has one open.
+
+    :param color: whether the job counts against the color quota
+    :param calendar: QuotaCalendar to take today's quota from (defaults to
+                     default_quota_calendar)
+    :return: JobPrice with the quota remaining after the job
+    """
+    special = _special_quota(user)
+    if special is not None:
+        approved = pages <= special.daily and (not color or pages <= special.color)
+        return JobPrice(user, pages, color, approved, special)
+
+    daily = calendar.quota_on() if calendar else daily_quota()
+    color_pages = pages if color else 0
+
+    with mysql.transaction(c):
+        # holds only last for the day they were made
+        c.execute(
+            'INSERT INTO `quota_holds` (`user`, `day`, `pages`, `color`) VALUES (%s, CURDATE(), 0, 0) '
+            'ON DUPLICATE KEY UPDATE '
+            '`pages` = IF(`day` = CURDATE(), `pages`, 0), '
+            '`color` = IF(`day` = CURDATE(), `color`, 0), '
+            '`day` = CURDATE()',
+            (user,)
+        )
+
+        # lock the hold row first so the quota we read stays accurate until
+        # we've made our reservation
+        c.execute('SELECT `pages`, `color` FROM `quota_holds` WHERE `user` = %s FOR UPDATE', (user,))
+        held = c.fetchone()
+        quota = _printed_quota(c, user, daily)
+
+        query = (
+            'UPDATE `quota_holds` SET `pages` = `pages` + %s, `color` = `color` + %s '
+            'WHERE `user` = %s AND `pages` + %s <= %s'
+        )
+        args = (pages, color_pages, user, pages, quota.daily)
+        if color:
+            query += ' AND `color` + %s <= %s'
+            args += (color_pages, quota.color)
+        c.execute(query, args)
+
+        # an empty job doesn't change the row, but is always within quota
+        approved = c.rowcount == 1 or (pages == 0 and held['pages'] <= quota.daily)
+
+    if approved:
+        held = {'pages': held['pages'] + pages, 'color': held['color'] + color_pages}
+    return JobPrice(
+        user=user,
+        pages=pages,
+        color=color,
+        approved=approved,
+        quota=quota._replace(
+            daily=quota.daily - held['pages'],
+            semesterly=quota.semesterly - held['pages'],
+            color=min(quota.semesterly - held['pages'], quota.color - held['color']),
+        ),
+    )
+
+
+def _release_hold(c, user, pages, color_pages):
+    c.execute(
+        'UPDATE `quota_holds` SET '
+        '`pages` = GREATEST(`pages` - %s, 0), '
+        '`color` = GREATEST(`color` - %s, 0) '
+        'WHERE `user` = %s AND `day` = CURDATE()',
+        (pages, color_pages, user),
+    )
+
+
+def release_job(c, user, pages, color=False):
+    """Release pages reserved by price_job for a job which won't be printed."""
+    _release_hold(c, user, pages, pages if color else 0)
+
+
 def _namedtuple_to_query(query, nt):
     """Return a filled-out query and arguments.
 
@@ -117,8 +364,15 @@ def _namedtuple_to_query(query, nt):
 
 
 def add_job(c, job):
-    """Add a new job to the database."""
-    c.execute(*_namedtuple_to_query('INSERT INTO jobs ({}) VALUES ({})', job))
+    """Add a new job to the database, releasing any pages held for it by
+    price_job.
+
+    Both happen in one transaction, or as part of the caller's if it has one
+    open.
+    """
+    with mysql.transaction(c):
+        c.execute(*_namedtuple_to_query('INSERT INTO jobs ({}) VALUES ({})', job))
+        _release_hold(c, job.user, job.pages, job.pages if job.queue in COLOR_QUEUES else 0)
 
 
 def add_refund(c, refund):
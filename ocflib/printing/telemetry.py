@@ -0,0 +1,228 @@
+"""Recording and analysis of printer page counts and toner levels.
+
+Samples are stored in the `printer_pages` and `printer_toner` tables of the
+ocfstats database (see ocfstats.sql). Only values which changed since the last
+recorded sample are written, so the tables stay small even when printers are
+polled frequently.
+
+Example usage:
+
+    from ocflib.printing.printers import PrinterStatusCache
+
+    recorder = TelemetryRecorder()
+    with ocflib.lab.stats.get_connection(user='ocfstats', password='...') as c:
+        recorder.record(c, [status.snapshot for status in cache.get_all().values()])
+
+    with ocflib.lab.stats.get_connection() as c:
+        days_until_empty(c, 'logjam')
+"""
+from collections import namedtuple
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+Sample = namedtuple('Sample', ('date', 'value'))
+
+
+class TelemetryRecorder:
+    """Writes printer snapshots to ocfstats, skipping unchanged values.
+
+    The last recorded value for each printer is loaded from the database the
+    first time the recorder is used and kept in memory afterwards, so each call
+    to `record` costs at most one bulk INSERT per table.
+    """
+
+    def __init__(self):
+        self._last_pages = None
+        self._last_toner = None
+
+    def _load_last_values(self, ctx):
+        ctx.execute(
+            'SELECT `p`.`printer`, `p`.`value` FROM `printer_pages` AS `p` '
+            'JOIN (SELECT MAX(`id`) AS `id` FROM `printer_pages` GROUP BY `printer`) AS `latest` '
+            'ON `p`.`id` = `latest`.`id`'
+        )
+        self._last_pages = {row['printer']: row['value'] for row in ctx.fetchall()}
+
+        ctx.execute(
+            'SELECT `t`.`printer`, `t`.`value`, `t`.`max` FROM `printer_toner` AS `t` '
+            'JOIN (SELECT MAX(`id`) AS `id` FROM `printer_toner` GROUP BY `printer`) AS `latest` '
+            'ON `t`.`id` = `latest`.`id`'
+        )
+        self._last_toner = {row['printer']: (row['value'], row['max']) for row in ctx.fetchall()}
+
+    def record(self, ctx, snapshots):
+        """Record a batch of PrinterSnapshot objects.
+
+        Snapshots which are None (e.g. printers which have never been polled
+        successfully) are ignored.
+
+        :return: tuple (pages rows written, toner rows written)
+        """
+        if self._last_pages is None:
+            self._load_last_values(ctx)
+
+        pages_rows, toner_rows = [], []
+        for snapshot in snapshots:
+            if snapshot is None:
+                continue
+            when = datetime.fromtimestamp(snapshot.polled_at)
+
+            if self._last_pages.get(snapshot.printer) != snapshot.pages:
+                pages_rows.append((when, snapshot.printer, snapshot.pages))
+
+            if self._last_toner.get(snapshot.printer) != tuple(snapshot.toner):
+                cur, max_ = snapshot.toner
+                toner_rows.append((when, snapshot.printer, cur, max_))
+
+        if pages_rows:
+            ctx.executemany(
+                'INSERT INTO `printer_pages` (`date`, `printer`, `value`) VALUES (%s, %s, %s)',
+                pages_rows,
+            )
+        if toner_rows:
+            ctx.executemany(
+                'INSERT INTO `printer_toner` (`date`, `printer`, `value`, `max`) VALUES (%s, %s, %s, %s)',
+                toner_rows,
+            )
+
+        # only update our view of the database once the inserts succeeded
+        for _, printer, value in pages_rows:
+            self._last_pages[printer] = value
+        for _, printer, cur, max_ in toner_rows:
+            self._last_toner[printer] = (cur, max_)
+
+        return len(pages_rows), len(toner_rows)
+
+
+def _series(ctx, table, printer, since):
+    ctx.execute(
+        'SELECT `date`, `value` FROM `{}` WHERE `printer` = %s AND `date` >= %s '
+        'ORDER BY `date`'.format(table),
+        (printer, since),
+    )
+    return [Sample(row['date'], row['value']) for row in ctx.fetchall()]
+
+
+def pages_series(ctx, printer, since=date(1970, 1, 1)):
+    """Return a list of Samples of the lifetime page counter for a printer."""
+    return _series(ctx, 'printer_pages_public', printer, since)
+
+
+def toner_series(ctx, printer, since=date(1970, 1, 1)):
+    """Return a list of Samples of the toner level for a printer."""
+    return _series(ctx, 'printer_toner_public', printer, since)
+
+
+def _last_before(ctx, table, printer, since):
+    """Return the last Sample before `since`, or None."""
+    ctx.execute(
+        'SELECT `date`, `value` FROM `{}` WHERE `printer` = %s AND `date` < %s '
+        'ORDER BY `date` DESC LIMIT 1'.format(table),
+        (printer, since),
+    )
+    row = ctx.fetchone()
+    return Sample(row['date'], row['value']) if row else None
+
+
+def daily_pages(samples, baseline=None):
+    """Return a dict mapping each day to the pages printed on it.
+
+    The page count of a day is the difference between the last counter value of
+    that day and the last value of the previous sampled day. Days without any
+    samples are attributed zero pages, since the counter didn't move.
+
+    For the first day, the counter is compared against `baseline` (the last
+    counter value before the samples start) if given, or else the first sample
+    of that day.
+    """
+    last_by_day = {}
+    for sample in samples:
+        last_by_day[sample.date.date()] = sample.value
+
+    if not last_by_day:
+        return {}
+
+    days = sorted(last_by_day)
+    result = {}
+    day = days[0]
+    prev = baseline if baseline is not None else samples[0].value
+    while day <= days[-1]:
+        cur = last_by_day.get(day, prev)
+        result[day] = max(0, cur - prev)
+        prev = cur
+        day += timedelta(days=1)
+    return result
+
+
+def pages_per_day(ctx, printer, since=date(1970, 1, 1)):
+    """Return a dict mapping each day to pages printed on the given printer."""
+    before = _last_before(ctx, 'printer_pages_public', printer, since)
+    return daily_pages(
+        pages_series(ctx, printer, since),
+        baseline=before.value if before is not None else None,
+    )
+
+
+def _current_cartridge(samples):
+    """Return the samples since the last toner replacement.
+
+    A replacement shows up as the toner level going up.
+    """
+    start = 0
+    for i in range(1, len(samples)):
+        if samples[i].value > samples[i - 1].value:
+            start = i
+    return samples[start:]
+
+
+def depletion_rate(samples):
+    """Return the toner depletion rate (units per day) of a toner series.
+
+    The rate is the negated least-squares slope of the toner level over time
+    for the current cartridge, computed in a single pass over the samples.
+    Returns None if there aren't enough samples to estimate a rate.
+    """
+    samples = _current_cartridge(samples)
+    n = len(samples)
+    if n < 2:
+        return None
+
+    t0 = samples[0].date
+    xs = [(s.date - t0).total_seconds() / SECONDS_PER_DAY for s in samples]
+    ys = [s.value for s in samples]
+
+    sum_x = sum(xs)
+    sum_y = sum(ys)
+    sum_xx = sum(x * x for x in xs)
+    sum_xy = sum(x * y for x, y in zip(xs, ys))
+
+    denominator = n * sum_xx - sum_x * sum_x
+    if denominator == 0:
+        return None
+    return -(n * sum_xy - sum_x * sum_y) / denominator
+
+
+def toner_depletion_rate(ctx, printer, since=date(1970, 1, 1)):
+    """Return the toner depletion rate (units per day) of the given printer."""
+    return depletion_rate(toner_series(ctx, printer, since))
+
+
+def forecast_days_until_empty(samples):
+    """Return the estimated number of days until the toner runs out.
+
+    Returns None if the toner isn't being used up (or there isn't enough data
+    to tell).
+    """
+    rate = depletion_rate(samples)
+    if not rate or rate <= 0:
+        return None
+    return samples[-1].value / rate
+
+
+def days_until_empty(ctx, printer, since=date(1970, 1, 1)):
+    """Return the estimated number of days until the printer runs out of
+    toner."""
+    return forecast_days_until_empty(toner_series(ctx, printer, since))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Benchmark printer polling against simulated SNMP agents.
+
+Runs one fake agent per simulated printer (see tests/printing/fake_snmp_agent.py)
+and reports wall time for each polling function, so changes to the poller can
+be checked for regressions without real printers. Run from the repository root:
+
+    PYTHONPATH=. tests-manual/printing/benchmark.py --printers 4 --latency 0.005
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import mock
+
+import ocflib.printing.printers as printers
+from tests.printing.fake_snmp_agent import printer_mib
+from tests.printing.fake_snmp_agent import start_agents
+
+
+def timeit(f, iterations):
+    """Return a list of wall times (in seconds) of calling f repeatedly."""
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name, times):
+    print('{:<24} mean {:8.3f} ms   median {:8.3f} ms   max {:8.3f} ms'.format(
+        name,
+        1000 * statistics.mean(times),
+        1000 * statistics.median(times),
+        1000 * max(times),
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--printers', type=int, default=len(printers.PRINTERS))
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0, help='seconds of latency per request')
+    parser.add_argument('--loss', type=float, default=0, help='probability of dropping a request')
+    args = parser.parse_args()
+
+    agents = start_agents(
+        [printer_mib() for _ in range(args.printers)],
+        latency=args.latency,
+        loss=args.loss,
+        seed=0,
+    )
+    hosts = [agent.address[0] for agent in agents]
+
+    try:
+        with mock.patch.object(printers, 'SNMP_PORT', agents[0].address[1]):
+            report('event loop creation', timeit(lambda: asyncio.run(asyncio.sleep(0)), args.iterations))
+
+            for func in (printers.get_toner, printers.get_paper_trays, printers.get_status):
+                report(func.__name__, timeit(lambda: [func(host) for host in hosts], args.iterations))
+
+            report('poll_printer', timeit(lambda: [printers.poll_printer(host) for host in hosts], args.iterations))
+
+        print('{} printers, {} requests served'.format(
+            len(agents),
+            sum(agent.requests for agent in agents),
+        ))
+    finally:
+        for agent in agents:
+            agent.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,6 @@
+import os
+import subprocess
+import time
 from contextlib import contextmanager
 from datetime import datetime
 from datetime import timezone
@@ -12,12 +15,16 @@ from sqlalchemy.orm import sessionmaker
 
 from ocflib.account.creation import _get_first_available_uid
 from ocflib.account.creation import _KNOWN_UID
+from ocflib.account.creation import _uid_block
 from ocflib.account.creation import create_account
+from ocflib.account.creation import create_account_entry
+from ocflib.account.creation import create_accounts
 from ocflib.account.creation import create_home_dir
 from ocflib.account.creation import decrypt_password
 from ocflib.account.creation import eligible_for_account
 from ocflib.account.creation import encrypt_password
 from ocflib.account.creation import ensure_web_dir
+from ocflib.account.creation import load_encryption_key
 from ocflib.account.creation import NewAccountRequest
 from ocflib.account.creation import send_created_mail
 from ocflib.account.creation import send_rejected_mail
@@ -29,6 +36,7 @@ from ocflib.account.creation import validate_request
 from ocflib.account.creation import validate_username
 from ocflib.account.creation import ValidationError
 from ocflib.account.creation import ValidationWarning
+from ocflib.account.screening import screen_username
 from ocflib.account.submission import AccountCreationCredentials
 from ocflib.account.submission import Base
 from ocflib.infra.ldap import ldap_ocf
@@ -222,8 +230,9 @@ class TestUsernameCheck:
     @mock.patch('ocflib.account.search.user_exists', return_value=False)
     def test_warning_names(self, _, username):
         """Ensure that we raise warnings when bad/restricted words appear."""
-        with pytest.raises(ValidationWarning):
+        with pytest.raises(ValidationWarning) as ex:
             validate_username(username, username)
+        assert str(ex.value) == screen_username(username).warning
 
     @pytest.mark.parametrize('username', [
         'wordpress',
@@ -288,36 +297,36 @@ class TestSendMail:
     FREE_PRINTING_TEXT = 'pages of free printing per semester'
     VHOST_TEXT = 'virtual hosting'
 
-    @mock.patch('ocflib.account.creation.send_mail')
-    def test_send_created_mail_individual(self, send_mail, fake_new_account_request):
+    @mock.patch('ocflib.account.creation.queue_mail')
+    def test_send_created_mail_individual(self, queue_mail, fake_new_account_request):
         fake_new_account_request = fake_new_account_request._replace(is_group=False)
         send_created_mail(fake_new_account_request)
-        send_mail.assert_called_once_with(
+        queue_mail.assert_called_once_with(
             fake_new_account_request.email,
             '[OCF] Your account has been created!',
             mock.ANY,
         )
-        body = send_mail.call_args[0][2]
+        body = queue_mail.call_args[0][2]
         assert self.FREE_PRINTING_TEXT in body
         assert self.VHOST_TEXT not in body
 
-    @mock.patch('ocflib.account.creation.send_mail')
-    def test_send_created_mail_group(self, send_mail, fake_new_account_request):
+    @mock.patch('ocflib.account.creation.queue_mail')
+    def test_send_created_mail_group(self, queue_mail, fake_new_account_request):
         fake_new_account_request = fake_new_account_request._replace(is_group=True)
         send_created_mail(fake_new_account_request)
-        send_mail.assert_called_once_with(
+        queue_mail.assert_called_once_with(
             fake_new_account_request.email,
             '[OCF] Your account has been created!',
             mock.ANY,
         )
-        body = send_mail.call_args[0][2]
+        body = queue_mail.call_args[0][2]
         assert self.FREE_PRINTING_TEXT not in body
         assert self.VHOST_TEXT in body
 
-    @mock.patch('ocflib.account.creation.send_mail')
-    def test_send_rejected_mail(self, send_mail, fake_new_account_request):
+    @mock.patch('ocflib.account.creation.queue_mail')
+    def test_send_rejected_mail(self, queue_mail, fake_new_account_request):
         send_rejected_mail(fake_new_account_request, 'some reason')
-        send_mail.called_called_once_with(
+        queue_mail.called_called_once_with(
             fake_new_account_request.email,
             '[OCF] Your account has been created!',
             mock.ANY,
@@ -337,6 +346,25 @@ class TestPasswordEncryption:
             RSA.importKey(WEAK_KEY),
         ) == password
 
+    def test_load_encryption_key_is_cached(self, mock_rsa_key):
+        key = load_encryption_key(mock_rsa_key)
+        assert key == RSA.importKey(WEAK_KEY)
+
+        with mock.patch('ocflib.account.creation.RSA.importKey') as import_key:
+            assert load_encryption_key(mock_rsa_key) is key
+        assert not import_key.called
+
+    def test_load_encryption_key_reloads_on_change(self, mock_rsa_key):
+        key = load_encryption_key(mock_rsa_key)
+
+        new_key = RSA.generate(1024)
+        with open(mock_rsa_key, 'wb') as f:
+            f.write(new_key.exportKey())
+        os.utime(mock_rsa_key, ns=(0, 0))
+
+        assert load_encryption_key(mock_rsa_key) != key
+        assert load_encryption_key(mock_rsa_key) == new_key
+
 
 class TestValidateCallinkOid:
 
@@ -463,7 +491,7 @@ class TestValidateRequest:
         session,
     ):
         # test where username has already been requested
-        with mock.patch('ocflib.account.submission.username_pending', return_value=True):
+        with mock.patch('ocflib.account.submission.request_pending', return_value=(True, False)):
             errors, warnings = validate_request(
                 fake_new_account_request,
                 fake_credentials,
@@ -472,7 +500,7 @@ class TestValidateRequest:
         assert errors
 
         # test where this user (calnet/callink oid) has already submitted a request
-        with mock.patch('ocflib.account.submission.user_has_request_pending', return_value=True):
+        with mock.patch('ocflib.account.submission.request_pending', return_value=(False, True)):
             errors, warnings = validate_request(
                 fake_new_account_request,
                 fake_credentials,
@@ -480,6 +508,39 @@ class TestValidateRequest:
             )
         assert errors
 
+    def test_sections_run_concurrently(
+        self,
+        fake_new_account_request,
+        fake_credentials,
+        session,
+    ):
+        def slow(exception=None):
+            def check(*args):
+                time.sleep(0.2)
+                if exception:
+                    raise exception
+            return check
+
+        with mock.patch('ocflib.account.creation.validate_username',
+                        side_effect=slow(ValidationWarning('bad name'))), \
+                mock.patch('ocflib.account.creation.validate_calnet_uid',
+                           side_effect=slow(ValidationError('no calnet'))), \
+                mock.patch('ocflib.account.creation.validate_email',
+                           side_effect=slow(ValidationError('bad email'))), \
+                mock.patch('ocflib.account.creation.validate_password',
+                           side_effect=slow(ValidationWarning('weak password'))):
+            start = time.monotonic()
+            errors, warnings = validate_request(
+                fake_new_account_request,
+                fake_credentials,
+                session,
+            )
+            assert time.monotonic() - start < 0.6
+
+        # results are reported in section order, not completion order
+        assert errors == ['no calnet', 'bad email']
+        assert warnings == ['bad name', 'weak password']
+
 
 class TestCreateAccount:
     @pytest.mark.skip(reason="Broken on self-hosted runner for some reason, need to investgate.")
@@ -552,3 +613,146 @@ class TestCreateAccount:
             home_dir.assert_called_once_with(fake_new_account_request.user_name)
             web_dir.assert_called_once_with(fake_new_account_request.user_name)
             send_created_mail.assert_called_once_with(fake_new_account_request)
+
+    def test_reserve_uid(self, fake_new_account_request, fake_credentials):
+        reserve_uid = mock.Mock(return_value=42)
+        with mock.patch('ocflib.account.creation.search.user_attrs', return_value=None), \
+                mock.patch('ocflib.account.creation.getgrnam'), \
+                mock.patch('ocflib.account.creation.create_ldap_entry') as ldap, \
+                mock.patch('ocflib.account.creation.call'), \
+                mock.patch('ocflib.account.creation._get_first_available_uid') as get_uid:
+            assert create_account_entry(
+                fake_new_account_request,
+                fake_credentials,
+                mock.MagicMock(),
+                reserve_uid,
+            ) == 42
+        reserve_uid.assert_called_once_with()
+        assert not get_uid.called
+        assert ldap.call_args[0][1]['uidNumber'] == 42
+
+    def test_existing_entry(self, fake_new_account_request, fake_credentials):
+        reserve_uid = mock.Mock()
+        with mock.patch('ocflib.account.creation.search.user_attrs', return_value={'uidNumber': 1234}), \
+                mock.patch('ocflib.account.creation.create_ldap_entry') as ldap:
+            assert create_account_entry(
+                fake_new_account_request,
+                fake_credentials,
+                mock.MagicMock(),
+                reserve_uid,
+            ) == 1234
+        assert not reserve_uid.called
+        assert not ldap.called
+
+
+@pytest.mark.parametrize('first_uid,count,expected', [
+    (100, 0, []),
+    (100, 3, [100, 101, 102]),
+    (61183, 3, [61183, 65536, 65537]),
+    (61184, 1, [65536]),
+    (13371336, 2, [13371336, 13371871]),
+])
+def test_uid_block(first_uid, count, expected):
+    assert _uid_block(first_uid, count) == expected
+
+
+class TestCreateAccounts:
+
+    def test_create_accounts(self, fake_new_account_request, fake_credentials):
+        requests = [
+            fake_new_account_request._replace(user_name=user_name)
+            for user_name in ('nokerberos', 'existing', 'newuser', 'badldap', 'nohome')
+        ]
+        statuses = {request.user_name: mock.MagicMock() for request in requests}
+
+        def create_principal(request, creds, report_status, exists):
+            assert exists == (request.user_name == 'existing')
+            if request.user_name == 'nokerberos':
+                raise RuntimeError('kerberos is down')
+
+        def create_dirs(request, report_status):
+            if request.user_name == 'nohome':
+                raise RuntimeError('no space left on device')
+
+        reserve_uids = mock.Mock(return_value=[42, 43, 44])
+        with mock.patch('ocflib.account.creation.principals_exist', return_value={'existing'}) as principals_exist, \
+                mock.patch('ocflib.account.creation.create_account_principal', side_effect=create_principal), \
+                mock.patch('ocflib.account.creation.search.existing_users', return_value={'existing'}), \
+                mock.patch('ocflib.account.creation.search.user_attrs', return_value={'uidNumber': 7}), \
+                mock.patch('ocflib.account.creation.getgrnam'), \
+                mock.patch('ocflib.account.creation.create_ldap_entries',
+                           return_value=[None, ValueError('bad'), None]) as ldap, \
+                mock.patch('ocflib.account.creation.call'), \
+                mock.patch('ocflib.account.creation.create_account_dirs', side_effect=create_dirs), \
+                mock.patch('ocflib.account.creation.send_created_mail') as send_created_mail:
+            results = create_accounts(requests, fake_credentials, statuses.__getitem__, reserve_uids)
+
+        principals_exist.assert_called_once_with(mock.ANY, fake_credentials.kerberos_keytab, 'create/admin')
+        reserve_uids.assert_called_once_with(3)
+        assert ldap.call_count == 1
+        assert [attrs['uidNumber'] for _, attrs in ldap.call_args[0][0]] == [42, 43, 44]
+
+        assert str(results.pop('nokerberos')) == 'kerberos is down'
+        assert str(results.pop('badldap')) == 'bad'
+        assert str(results.pop('nohome')) == 'no space left on device'
+        assert results == {'existing': 7, 'newuser': 42}
+        assert sorted(call[0][0].user_name for call in send_created_mail.call_args_list) == ['existing', 'newuser']
+        statuses['nokerberos'].assert_called_with('Failed: kerberos is down')
+
+    @contextmanager
+    def mock_stages(self, **kwargs):
+        with mock.patch('ocflib.account.creation.principals_exist', return_value=set()), \
+                mock.patch('ocflib.account.creation.create_account_principal'), \
+                mock.patch('ocflib.account.creation.search.existing_users', return_value={'existing'}), \
+                mock.patch('ocflib.account.creation.search.user_attrs', return_value={'uidNumber': 7}), \
+                mock.patch('ocflib.account.creation.getgrnam'), \
+                mock.patch('ocflib.account.creation.create_ldap_entries', **kwargs), \
+                mock.patch('ocflib.account.creation.call'), \
+                mock.patch('ocflib.account.creation.create_account_dirs') as create_dirs, \
+                mock.patch('ocflib.account.creation.send_created_mail') as send_created_mail:
+            yield create_dirs, send_created_mail
+
+    @pytest.mark.parametrize('reserve_error,ldap_error', [
+        (RuntimeError('redis is down'), None),
+        (None, subprocess.TimeoutExpired('ldapmodify', 12)),
+    ])
+    def test_shared_stage_failure(self, fake_new_account_request, fake_credentials, reserve_error, ldap_error):
+        requests = [
+            fake_new_account_request._replace(user_name=user_name)
+            for user_name in ('existing', 'newuser', 'another')
+        ]
+        statuses = {request.user_name: mock.MagicMock() for request in requests}
+        reserve_uids = mock.Mock(return_value=[42, 43], side_effect=reserve_error)
+
+        with self.mock_stages(side_effect=ldap_error) as (create_dirs, send_created_mail):
+            results = create_accounts(requests, fake_credentials, statuses.__getitem__, reserve_uids)
+
+        # every unfinished account fails, rather than the whole batch raising
+        error = reserve_error or ldap_error
+        assert results == {'existing': error, 'newuser': error, 'another': error}
+        for status in statuses.values():
+            status.assert_called_with('Failed: {}'.format(error))
+        assert not create_dirs.called
+        assert not send_created_mail.called
+
+    def test_duplicate_entries(self, fake_new_account_request, fake_credentials):
+        requests = [
+            fake_new_account_request._replace(user_name=user_name)
+            for user_name in ('mine', 'theirs')
+        ]
+        statuses = {request.user_name: mock.MagicMock() for request in requests}
+        uids = {'mine': {'uidNumber': 42}, 'theirs': {'uidNumber': 1000}}
+
+        with self.mock_stages(return_value=[
+            ValueError('Tried to create duplicate entry.'),
+            ValueError('Tried to create duplicate entry.'),
+        ]), \
+                mock.patch('ocflib.account.creation.search.existing_users', return_value=set()), \
+                mock.patch('ocflib.account.creation.search.user_attrs', side_effect=uids.get):
+            results = create_accounts(
+                requests, fake_credentials, statuses.__getitem__, mock.Mock(return_value=[42, 43]),
+            )
+
+        # only an entry with the UID we reserved was added by our batch
+        assert results['mine'] == 42
+        assert str(results['theirs']) == 'Tried to create duplicate entry.'
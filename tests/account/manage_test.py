@@ -68,33 +68,41 @@ class TestChangePasswordWithStaffer:
         assert not mock_notify_password_change.called
 
 
+@pytest.yield_fixture
+def mock_kadmin_session():
+    with mock.patch('ocflib.account.manage.kadmin_session') as kadmin_session:
+        kadmin_session.return_value.run.return_value = ''
+        yield kadmin_session
+
+
 class TestChangePasswordWithKeytab:
 
-    def _chpass(self, mock_spawn):
+    def _chpass(self, mock_kadmin_session):
         change_password_with_keytab(
             'ggroup',
             'strong_hunter2837162',
             '/some/keytab',
             'create/admin',
         )
-        mock_spawn.assert_called_with(
-            f'{KADMIN_PATH} -K /some/keytab -p create/admin cpw ggroup',
-            timeout=10,
-        )
-        mock_spawn.return_value.sendline.assert_has_calls(
-            [mock.call('strong_hunter2837162'), mock.call('strong_hunter2837162')],
+        mock_kadmin_session.assert_called_with('/some/keytab', 'create/admin')
+        mock_kadmin_session.return_value.run.assert_called_with(
+            'cpw ggroup',
+            (
+                ("ggroup@OCF.BERKELEY.EDU's Password:", 'strong_hunter2837162'),
+                ("Verify password - ggroup@OCF.BERKELEY.EDU's Password:", 'strong_hunter2837162'),
+            ),
         )
 
-    def test_success(self, mock_spawn, mock_notify_password_change):
-        self._chpass(mock_spawn)
+    def test_success(self, mock_kadmin_session, mock_notify_password_change):
+        self._chpass(mock_kadmin_session)
         mock_notify_password_change.assert_called_once_with('ggroup', comment=None)
 
-    def test_kadmin_failure(self, mock_spawn, mock_notify_password_change):
-        mock_spawn.return_value.before.decode.return_value = (
+    def test_kadmin_failure(self, mock_kadmin_session, mock_notify_password_change):
+        mock_kadmin_session.return_value.run.return_value = (
             'kadmin: cpw ggroup: Looping detected inside krb5_get_in_tkt'
         )
         with pytest.raises(ValueError):
-            self._chpass(mock_spawn)
+            self._chpass(mock_kadmin_session)
         assert not mock_notify_password_change.called
 
 
@@ -131,13 +139,13 @@ class TestModifyLdapAttributes:
 
 class TestNotifyPasswordChange:
 
-    @mock.patch('ocflib.misc.mail.send_mail_user')
-    def test_without_comment(self, mock_send_mail_user):
+    @mock.patch('ocflib.misc.mail.queue_mail_user')
+    def test_without_comment(self, mock_queue_mail_user):
         _notify_password_change('ckuehl')
-        mock_send_mail_user.assert_called_once_with('ckuehl', mock.ANY, mock.ANY)
+        mock_queue_mail_user.assert_called_once_with('ckuehl', mock.ANY, mock.ANY)
 
-    @mock.patch('ocflib.misc.mail.send_mail_user')
-    def test_with_comment(self, mock_send_mail_user):
+    @mock.patch('ocflib.misc.mail.queue_mail_user')
+    def test_with_comment(self, mock_queue_mail_user):
         _notify_password_change('ckuehl', comment='HERPDERP')
-        mock_send_mail_user.assert_called_once_with('ckuehl', mock.ANY, mock.ANY)
-        assert '\nHERPDERP\n' in mock_send_mail_user.call_args_list[0][0][2]
+        mock_queue_mail_user.assert_called_once_with('ckuehl', mock.ANY, mock.ANY)
+        assert '\nHERPDERP\n' in mock_queue_mail_user.call_args_list[0][0][2]
@@ -0,0 +1,134 @@
+import mock
+import pytest
+
+from ocflib.account.screening import BAD_WORD_MATCHER
+from ocflib.account.screening import BAD_WORDS
+from ocflib.account.screening import RESTRICTED_WORDS
+from ocflib.account.screening import screen_username
+from ocflib.account.screening import screen_usernames
+from ocflib.account.screening import ScreeningResult
+from ocflib.account.screening import username_candidates
+from ocflib.account.screening import WordMatcher
+
+
+@pytest.yield_fixture(autouse=True)
+def no_local_users():
+    with mock.patch('ocflib.account.validators.local_usernames', return_value=frozenset()):
+        yield
+
+
+class TestWordMatcher:
+
+    @pytest.mark.parametrize('text,expected', [
+        ('', None),
+        ('ckuehl', None),
+        ('sh', None),
+        ('she', 'she'),
+        ('ushers', 'she'),
+        ('his', 'his'),
+        ('ahishers', 'his'),
+        ('hers', 'he'),
+    ])
+    def test_find(self, text, expected):
+        matcher = WordMatcher(('he', 'she', 'his', 'hers'))
+        assert matcher.find(text) == expected
+
+    def test_find_prefers_longest_at_same_end(self):
+        assert WordMatcher(('a', 'ba', 'cba')).find('xcba') == 'cba'
+
+    @pytest.mark.parametrize('text,expected', [
+        ('', set()),
+        ('ushers', {'she', 'he', 'hers'}),
+        ('ahishers', {'his', 'she', 'he', 'hers'}),
+    ])
+    def test_find_all(self, text, expected):
+        matcher = WordMatcher(('he', 'she', 'his', 'hers'))
+        assert matcher.find_all(text) == expected
+
+    def test_contains(self):
+        assert 'sshit' in BAD_WORD_MATCHER
+        assert 'ckuehl' not in BAD_WORD_MATCHER
+
+    def test_matches_naive_search(self):
+        words = BAD_WORDS | RESTRICTED_WORDS
+        matcher = WordMatcher(words)
+        for text in ('', 'jvperrin', 'assbitch', 'ocfucb', 'shellfish', 'berkeleyocf', 'fellatio'):
+            assert matcher.find_all(text) == {word for word in words if word in text}
+
+
+class TestScreenUsername:
+
+    @pytest.mark.parametrize('username', ['ckuehl', 'jvperrin', 'mattmcal'])
+    def test_ok(self, username):
+        result = screen_username(username)
+        assert result == ScreeningResult(username, None, None)
+        assert result.ok
+
+    @pytest.mark.parametrize('username,error', [
+        ('ocfdeploy', 'Username is reserved.'),
+        ('root', 'Username is reserved.'),
+        ('ab', 'Username must be between 3 and 16 characters.'),
+        ('Ckuehl', 'Username must be all lowercase letters.'),
+    ])
+    def test_error(self, username, error):
+        result = screen_username(username)
+        assert result.error == error
+        assert result.warning is None
+        assert not result.ok
+
+    @pytest.mark.parametrize('username,warning', [
+        ('asstastic', 'Username asstastic contains bad word: ass'),
+        ('ucbjohndoe', 'Username ucbjohndoe contains restricted word: ucb'),
+        ('shitocf', 'Username shitocf contains bad word: shit'),
+    ])
+    def test_warning(self, username, warning):
+        result = screen_username(username)
+        assert result.error is None
+        assert result.warning == warning
+        assert not result.ok
+
+    def test_local_users_are_not_reported(self):
+        with mock.patch('ocflib.account.validators.local_usernames', return_value=frozenset({'ckuehl'})), \
+                mock.patch('ocflib.misc.mail.send_problem_report') as send_report:
+            assert screen_username('ckuehl').error == 'Username is reserved.'
+            assert [result.ok for result in screen_usernames(['ckuehl', 'mattmcal'])] == [False, True]
+        assert not send_report.called
+
+    def test_local_users_reported_on_request(self):
+        with mock.patch('ocflib.account.validators.local_usernames', return_value=frozenset({'ckuehl'})), \
+                mock.patch('ocflib.misc.mail.send_problem_report') as send_report:
+            assert screen_username('ckuehl', report=True).error == 'Username is reserved.'
+        assert send_report.called
+
+    def test_screen_usernames(self):
+        assert [result.ok for result in screen_usernames(
+            iter(['ckuehl', 'root', 'asstastic', 'mattmcal']),
+        )] == [True, False, False, True]
+
+
+class TestUsernameCandidates:
+
+    def test_candidates(self):
+        candidates = username_candidates('Chris Kuehl')
+        assert candidates[:4] == ['ckuehl', 'chriskuehl', 'chris', 'chrisk']
+        assert len(candidates) == len(set(candidates))
+
+    def test_middle_names(self):
+        assert 'jmdlcruz' in username_candidates('José María de la Cruz')
+
+    @pytest.mark.parametrize('real_name', [
+        "Conan O'Brien",
+        'Ángel Ñúñez',
+        'Jean-Luc Picard',
+        'Wolfeschlegelsteinhausenbergerdorff Hubert',
+    ])
+    def test_valid_usernames(self, real_name):
+        candidates = username_candidates(real_name)
+        assert candidates
+        for candidate in candidates:
+            assert 3 <= len(candidate) <= 16
+            assert candidate.isalpha() and candidate.islower() and candidate.isascii()
+
+    @pytest.mark.parametrize('real_name', ['', '   ', '42', '金'])
+    def test_no_candidates(self, real_name):
+        assert username_candidates(real_name) == []
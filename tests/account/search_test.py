@@ -1,6 +1,8 @@
+import mock
 import pytest
 from ldap3.core.exceptions import LDAPAttributeError
 
+from ocflib.account.search import existing_users
 from ocflib.account.search import user_attrs
 from ocflib.account.search import user_attrs_ucb
 from ocflib.account.search import user_exists
@@ -81,6 +83,21 @@ def test_user_exists(user, exists):
     assert user_exists(user) == exists
 
 
+@pytest.mark.parametrize('users,existing', [
+    ({'ckuehl', 'bpreview', 'doesnotexist'}, {'ckuehl', 'bpreview'}),
+    ({'doesnotexist'}, set()),
+    (set(), set()),
+])
+def test_existing_users(users, existing):
+    assert existing_users(users) == existing
+
+
+def test_existing_users_single_search():
+    with mock.patch('ocflib.account.search.users_by_filter', return_value=['ckuehl']) as users_by_filter:
+        assert existing_users(['ckuehl', 'doesnotexist', 'ckuehl']) == {'ckuehl'}
+    users_by_filter.assert_called_once_with('(|(uid=ckuehl)(uid=doesnotexist))')
+
+
 @pytest.mark.parametrize('user,sorried', [
     ('ckuehl', False),
     ('ofc', True),
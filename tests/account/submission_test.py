@@ -2,6 +2,7 @@ from contextlib import contextmanager
 
 import mock
 import pytest
+from redis.exceptions import LockError
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
@@ -9,9 +10,14 @@ from ocflib.account.creation import NewAccountRequest
 from ocflib.account.submission import Base
 from ocflib.account.submission import get_tasks
 from ocflib.account.submission import NewAccountResponse
+from ocflib.account.submission import request_pending
+from ocflib.account.submission import reserve_uid
+from ocflib.account.submission import reserve_uids
 from ocflib.account.submission import StoredNewAccountRequest
 from ocflib.account.submission import user_has_request_pending
 from ocflib.account.submission import username_pending
+from ocflib.account.submission import username_suggestions
+from ocflib.account.submission import usernames_pending
 from tests.account.creation_test import fake_credentials  # noqa
 from tests.account.creation_test import fake_new_account_request  # noqa
 from tests.account.creation_test import mock_rsa_key  # noqa
@@ -63,6 +69,85 @@ class TestUserHasRequestPending:
         assert not user_has_request_pending(session, fake_new_account_request)
 
 
+class TestRequestPending:
+
+    def test_not_pending(self, session, fake_new_account_request):
+        assert request_pending(session, fake_new_account_request) == (False, False)
+
+    def test_username_pending(self, session, fake_new_account_request):
+        session.add(StoredNewAccountRequest.from_request(
+            fake_new_account_request._replace(calnet_uid=14),
+            'reason',
+        ))
+        session.commit()
+        assert request_pending(session, fake_new_account_request) == (True, False)
+
+    def test_user_pending(self, session, fake_new_account_request):
+        session.add(StoredNewAccountRequest.from_request(
+            fake_new_account_request._replace(user_name='other'),
+            'reason',
+        ))
+        session.commit()
+        assert request_pending(session, fake_new_account_request) == (False, True)
+
+    def test_zero_group_never_pending(self, session, fake_new_account_request):
+        fake_new_account_request = fake_new_account_request._replace(
+            user_name='other',
+            is_group=True,
+            callink_oid=0,
+            calnet_uid=None,
+        )
+        session.add(StoredNewAccountRequest.from_request(
+            fake_new_account_request._replace(user_name='another'),
+            'reason',
+        ))
+        session.commit()
+        assert request_pending(session, fake_new_account_request) == (False, False)
+
+    def test_stored_request_ignores_own_row(self, session, fake_new_account_request):
+        session.add(StoredNewAccountRequest.from_request(fake_new_account_request, 'reason'))
+        session.commit()
+        assert request_pending(session, fake_new_account_request, stored=True) == (False, False)
+
+        session.add(StoredNewAccountRequest.from_request(
+            fake_new_account_request._replace(user_name='other'),
+            'reason',
+        ))
+        session.commit()
+        assert request_pending(session, fake_new_account_request, stored=True) == (False, True)
+
+
+def test_usernames_pending(session, fake_new_account_request):
+    session.add(StoredNewAccountRequest.from_request(fake_new_account_request, 'reason'))
+    session.commit()
+    assert usernames_pending(session, [fake_new_account_request.user_name, 'other']) == {
+        fake_new_account_request.user_name,
+    }
+    assert usernames_pending(session, []) == set()
+
+
+class TestUsernameSuggestions:
+
+    @pytest.yield_fixture(autouse=True)
+    def no_local_users(self):
+        with mock.patch('ocflib.account.validators.local_usernames', return_value=frozenset()):
+            yield
+
+    def test_skips_taken_usernames(self, session, fake_new_account_request):
+        session.add(StoredNewAccountRequest.from_request(
+            fake_new_account_request._replace(user_name='chriskuehl'),
+            'reason',
+        ))
+        session.commit()
+        with mock.patch('ocflib.account.submission.existing_users', return_value={'ckuehl'}) as existing_users:
+            assert username_suggestions(session, 'Chris Kuehl', 3) == ['chris', 'chrisk', 'kuehlc']
+        assert existing_users.call_count == 1
+
+    def test_skips_flagged_usernames(self, session):
+        with mock.patch('ocflib.account.submission.existing_users', return_value=set()):
+            assert 'ucb' not in username_suggestions(session, 'Ucb Bear', 20)
+
+
 @pytest.yield_fixture
 def tasks(session, celery_app, fake_credentials):
     with mock.patch('ocflib.account.submission.sessionmaker', return_value=lambda: session):
@@ -94,6 +179,24 @@ def test_approve_request(celery_app, fake_new_account_request, session_with_requ
     ]
 
 
+def test_approve_requests(celery_app, fake_new_account_request, session_with_requests, tasks):
+    tasks.approve_requests([fake_new_account_request.user_name, 'other', 'nonexistent'])
+
+    # requests are only removed once their accounts are created
+    assert len(session_with_requests.query(StoredNewAccountRequest).all()) == 2
+
+    requests = [
+        StoredNewAccountRequest.from_request(
+            fake_new_account_request._replace(user_name=user_name),
+            'reason',
+        ).to_request()
+        for user_name in (fake_new_account_request.user_name, 'other')
+    ]
+    tasks.create_accounts.delay.assert_called_once_with(mock.ANY, stored=True, not_found=['nonexistent'])
+    assert sorted(tasks.create_accounts.delay.call_args[0][0]) == sorted(requests)
+    assert sorted(message['request']['user_name'] for message in celery_app._sent_messages) == ['other', 'someuser']
+
+
 @mock.patch('ocflib.account.submission.send_rejected_mail')
 def test_reject_request(send_rejected_mail, celery_app, fake_new_account_request, session_with_requests, tasks):
     tasks.reject_request(fake_new_account_request.user_name)
@@ -209,6 +312,10 @@ class TestValidateThenCreateAccount:
             assert not tasks.create_account.delay.called
 
 
+def failed_accounts(requests, credentials, report_status, reserve_uids):
+    return {request.user_name: ValueError('oops') for request in requests}
+
+
 @pytest.yield_fixture
 def mock_redis_locking():
     with mock.patch('redis.from_url') as m:
@@ -236,9 +343,13 @@ class TestCreateAccount:
                 fake_new_account_request,
                 fake_credentials,
                 mock.ANY,
-                known_uid=mock.ANY,
+                reserve_uid=mock.ANY,
             )
-            mock_redis_locking().set.assert_called_once_with('known_uid', mock.ANY)
+            assert mock_redis_locking().lock.call_args_list == [
+                mock.call('ocflib.account.submission.create_account:calnet_uid:123456', timeout=300),
+                mock.call('ocflib.account.submission.create_account:user:someuser', timeout=300),
+            ]
+            assert mock_redis_locking().lock().release.call_count == 2
             assert celery_app._sent_messages == [
                 {'type': 'ocflib.account_created', 'request': fake_new_account_request.to_dict()}
             ]
@@ -263,6 +374,198 @@ class TestCreateAccount:
             assert send_rejected_mail.called
 
 
+class TestReserveUID:
+
+    @pytest.mark.parametrize('known_uid,expected', [
+        (None, 105749),
+        (b'42', 42),
+    ])
+    def test_reserve_uid(self, known_uid, expected):
+        r = mock.MagicMock(**{'get.return_value': known_uid})
+        with mock.patch('ocflib.account.submission._get_first_available_uid', return_value=1000) as get_uid:
+            assert reserve_uid(r) == 1000
+        get_uid.assert_called_once_with(expected)
+        r.set.assert_called_once_with('known_uid', 1000)
+
+    def test_reserve_uids(self):
+        r = mock.MagicMock(**{'get.return_value': b'61180'})
+        with mock.patch('ocflib.account.submission._get_first_available_uid', return_value=61182):
+            assert reserve_uids(r, 4) == [61182, 61183, 65536, 65537]
+        r.set.assert_called_once_with('known_uid', 65537)
+
+    def test_reserve_no_uids(self):
+        r = mock.MagicMock()
+        assert reserve_uids(r, 0) == []
+        assert not r.lock.called
+
+    def test_reserved_uid_skipped(self):
+        """A reserved UID whose LDAP entry doesn't exist yet isn't reused."""
+        store = {}
+        r = mock.MagicMock(get=store.get, set=store.__setitem__)
+        with mock.patch('ocflib.account.creation.ldap_ocf') as ldap_ocf:
+            ldap_ocf().__enter__().response = []
+            first = reserve_uid(r)
+            second = reserve_uid(r)
+        assert second == first + 1
+
+
+class TestCreateAccounts:
+
+    def test_create_accounts(
+        self,
+        tasks,
+        fake_new_account_request,
+        fake_credentials,
+        celery_app,
+        mock_redis_locking,
+    ):
+        good = fake_new_account_request
+        bad = fake_new_account_request._replace(user_name='baduser', calnet_uid=14)
+        broken = fake_new_account_request._replace(user_name='broken', calnet_uid=15)
+
+        def validate_request(request, credentials, session, stored=False):
+            return (['bad error'], []) if request is bad else ([], [])
+
+        def create_accounts(requests, credentials, report_status, reserve_uids):
+            assert requests == [good, broken]
+            report_status(good.user_name)('Created LDAP entry')
+            return {good.user_name: 42, broken.user_name: ValueError('oops')}
+
+        with mock.patch('ocflib.account.submission.validate_request', side_effect=validate_request), \
+                mock.patch('ocflib.account.submission.send_rejected_mail') as send_rejected_mail, \
+                mock.patch('ocflib.account.submission.real_create_accounts', side_effect=create_accounts):
+            responses = tasks.create_accounts([good, bad, broken])
+
+        assert responses == {
+            good.user_name: NewAccountResponse(status=NewAccountResponse.CREATED, errors=[]),
+            bad.user_name: NewAccountResponse(status=NewAccountResponse.REJECTED, errors=['bad error']),
+            broken.user_name: NewAccountResponse(status=NewAccountResponse.REJECTED, errors=['oops']),
+        }
+        send_rejected_mail.assert_called_once_with(bad, "['bad error']")
+        assert celery_app._sent_messages == [
+            {'type': 'ocflib.account_created', 'request': good.to_dict()},
+        ]
+        tasks.create_accounts.update_state.assert_called_with(meta={'status': {
+            good.user_name: ['Created LDAP entry'],
+            bad.user_name: [],
+            broken.user_name: [],
+        }})
+
+    def test_already_being_created(self, tasks, fake_new_account_request, mock_redis_locking):
+        mock_redis_locking().lock().acquire.return_value = False
+        with mock.patch('ocflib.account.submission.real_create_accounts', return_value={}) as create_accounts:
+            responses = tasks.create_accounts([fake_new_account_request])
+        assert responses[fake_new_account_request.user_name].status == NewAccountResponse.PENDING
+        create_accounts.assert_called_once_with([], mock.ANY, mock.ANY, mock.ANY)
+
+        # the request is put back in the queue rather than rejected
+        tasks.create_accounts.apply_async.assert_called_once_with(
+            ([fake_new_account_request],),
+            {'stored': False},
+            countdown=60,
+        )
+
+    def test_contended_request_releases_its_locks(self, tasks, fake_new_account_request, mock_redis_locking):
+        calnet_lock, user_lock = mock.Mock(), mock.Mock()
+        user_lock.acquire.return_value = False
+        mock_redis_locking().lock.side_effect = [calnet_lock, user_lock]
+        with mock.patch('ocflib.account.submission.real_create_accounts', return_value={}):
+            tasks.create_accounts([fake_new_account_request])
+        calnet_lock.release.assert_called_once_with()
+        assert not user_lock.release.called
+
+    def test_lock_timeout_scales_with_batch(self, tasks, fake_new_account_request, mock_redis_locking):
+        requests = [
+            fake_new_account_request._replace(user_name='user{}'.format(i), calnet_uid=i)
+            for i in range(10)
+        ]
+        with mock.patch('ocflib.account.submission.validate_request', return_value=([], [])), \
+                mock.patch('ocflib.account.submission.real_create_accounts', side_effect=failed_accounts):
+            tasks.create_accounts(requests)
+        assert {
+            call[1]['timeout'] for call in mock_redis_locking().lock.call_args_list if call[0]
+        } == {60 * 5 + 60 * 10}
+
+    def test_expired_lock_is_reported(self, tasks, fake_new_account_request, mock_redis_locking):
+        mock_redis_locking().lock().release.side_effect = LockError
+        with mock.patch('ocflib.account.submission.validate_request', return_value=([], [])), \
+                mock.patch('ocflib.account.submission.real_create_accounts', side_effect=failed_accounts):
+            tasks.create_accounts([fake_new_account_request])
+        tasks.create_accounts.update_state.assert_called_with(meta={'status': {
+            fake_new_account_request.user_name: ['Warning: lock expired before the batch finished'] * 2,
+        }})
+
+    def test_stored_requests(
+        self,
+        tasks,
+        fake_new_account_request,
+        session_with_requests,
+        mock_redis_locking,
+    ):
+        good = StoredNewAccountRequest.from_request(fake_new_account_request, 'reason').to_request()
+        broken = good._replace(user_name='other')
+        gone = good._replace(user_name='gone')
+
+        def validate_request(request, credentials, session, stored=False):
+            # the requests' own rows don't make them look already requested
+            assert stored
+            return [], []
+
+        with mock.patch('ocflib.account.submission.validate_request', side_effect=validate_request), \
+                mock.patch('ocflib.account.submission.real_create_accounts', return_value={
+                    good.user_name: 42,
+                    broken.user_name: RuntimeError('kerberos is down'),
+                }) as create_accounts:
+            responses = tasks.create_accounts([good, broken, gone], stored=True, not_found=['nonexistent'])
+
+        create_accounts.assert_called_once_with([good, broken], mock.ANY, mock.ANY, mock.ANY)
+        assert responses == {
+            good.user_name: NewAccountResponse(status=NewAccountResponse.CREATED, errors=[]),
+            broken.user_name: NewAccountResponse(status=NewAccountResponse.REJECTED, errors=['kerberos is down']),
+            'gone': NewAccountResponse(status=NewAccountResponse.REJECTED, errors=['Request not found.']),
+            'nonexistent': NewAccountResponse(status=NewAccountResponse.REJECTED, errors=['Request not found.']),
+        }
+
+        # only the created account's request is removed
+        assert [row.user_name for row in session_with_requests.query(StoredNewAccountRequest)] == ['other']
+
+    def test_failure_keeps_stored_requests(
+        self,
+        tasks,
+        fake_new_account_request,
+        session_with_requests,
+        mock_redis_locking,
+    ):
+        requests = [
+            row.to_request()
+            for row in session_with_requests.query(StoredNewAccountRequest)
+        ]
+        with mock.patch('ocflib.account.submission.validate_request', return_value=([], [])), \
+                mock.patch('ocflib.account.submission.real_create_accounts', side_effect=RuntimeError('oops')), \
+                pytest.raises(RuntimeError):
+            tasks.create_accounts(requests, stored=True)
+
+        assert len(session_with_requests.query(StoredNewAccountRequest).all()) == 2
+        assert mock_redis_locking().lock().release.called
+
+    def test_rejected_stored_request_is_removed(
+        self,
+        tasks,
+        fake_new_account_request,
+        session_with_requests,
+        mock_redis_locking,
+    ):
+        request = StoredNewAccountRequest.from_request(fake_new_account_request, 'reason').to_request()
+        with mock.patch('ocflib.account.submission.validate_request', return_value=(['bad error'], [])), \
+                mock.patch('ocflib.account.submission.send_rejected_mail') as send_rejected_mail, \
+                mock.patch('ocflib.account.submission.real_create_accounts', return_value={}):
+            responses = tasks.create_accounts([request], stored=True)
+
+        assert responses[request.user_name].status == NewAccountResponse.REJECTED
+        send_rejected_mail.assert_called_once_with(request, "['bad error']")
+        assert [row.user_name for row in session_with_requests.query(StoredNewAccountRequest)] == ['other']
+
+
 class TestStoredNewAccountRequest:
 
     def test_str(self, fake_new_account_request):
@@ -272,6 +575,49 @@ class TestStoredNewAccountRequest:
         )
 
 
+class TestGetSession:
+
+    def test_engine_reused(self, celery_app, fake_credentials):
+        with mock.patch('ocflib.account.submission.create_engine') as create_engine:
+            tasks = get_tasks(celery_app, credentials=fake_credentials, engine_options={'pool_size': 2})
+            tasks.get_pending_requests()
+            tasks.get_pending_requests()
+
+        create_engine.assert_called_once_with(
+            fake_credentials.mysql_uri,
+            pool_pre_ping=True,
+            pool_recycle=3600,
+            pool_size=2,
+        )
+
+    def test_engine_replaced_after_fork(self, celery_app, fake_credentials):
+        with mock.patch('ocflib.account.submission.create_engine') as create_engine:
+            tasks = get_tasks(celery_app, credentials=fake_credentials)
+            tasks.get_pending_requests()
+            parent_engine = create_engine.return_value
+            create_engine.return_value = mock.Mock()
+
+            with mock.patch('os.getpid', return_value=-1):
+                tasks.get_pending_requests()
+
+        assert create_engine.call_count == 2
+        parent_engine.dispose.assert_called_once_with(close=False)
+
+
+def test_suggest_usernames(tasks):
+    with mock.patch('ocflib.account.submission.username_suggestions', return_value=['ckuehl']) as suggestions:
+        assert tasks.suggest_usernames('Chris Kuehl') == ['ckuehl']
+    assert suggestions.call_args[0][1:] == ('Chris Kuehl', 5)
+
+
+def test_tasks_flush_queued_mail(tasks):
+    with mock.patch('ocflib.account.submission.change_password_with_keytab', side_effect=ValueError('bad')), \
+            mock.patch('ocflib.account.submission.mail_queue') as mail_queue, \
+            pytest.raises(ValueError):
+        tasks.change_password('ggroup', 'hello world')
+    mail_queue.flush.assert_called_once_with()
+
+
 def test_change_password(tasks, fake_credentials):
     with mock.patch('ocflib.account.submission.change_password_with_keytab') as m:
         tasks.change_password('ggroup', 'hello world', comment='comment')
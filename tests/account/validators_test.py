@@ -1,6 +1,9 @@
+import os
+
 import mock
 import pytest
 
+from ocflib.account.validators import local_usernames
 from ocflib.account.validators import user_exists
 from ocflib.account.validators import username_reserved
 from ocflib.account.validators import validate_password
@@ -115,15 +118,49 @@ class TestUsernameReserved:
     def test_not_reserved(self, username):
         assert not username_reserved(username)
 
-    def test_checks_etc_passwd(self):
-        lines = [
-            'root:x:0:0:root:/root:/bin/bash',
-            'somename:x:1:1:daemon:/usr/sbin:/usr/sbin/nologin'
-        ]
-
-        with mock.patch('builtins.open',
-                        new=mock.mock_open(read_data='\n'.join(lines))):
-            with mock.patch('ocflib.misc.mail.send_problem_report') \
-                    as send_report:
-                assert username_reserved('somename')
-                assert send_report.called
+    def test_checks_etc_passwd(self, fake_passwd):
+        with mock.patch('ocflib.misc.mail.send_problem_report') \
+                as send_report:
+            assert username_reserved('somename')
+            assert send_report.called
+
+    def test_checks_etc_passwd_without_report(self, fake_passwd):
+        with mock.patch('ocflib.misc.mail.send_problem_report') \
+                as send_report:
+            assert username_reserved('somename', report=False)
+            assert not send_report.called
+
+    def test_validate_username_without_report(self, fake_passwd):
+        with mock.patch('ocflib.misc.mail.send_problem_report') \
+                as send_report:
+            with pytest.raises(ValueError):
+                validate_username('somename', report=False)
+            assert not send_report.called
+
+
+@pytest.yield_fixture
+def fake_passwd(tmpdir):
+    passwd = tmpdir.join('passwd')
+    passwd.write('\n'.join([
+        'root:x:0:0:root:/root:/bin/bash',
+        'somename:x:1:1:daemon:/usr/sbin:/usr/sbin/nologin'
+    ]))
+    with mock.patch('ocflib.account.validators.PASSWD_PATH', passwd.strpath):
+        yield passwd
+
+
+class TestLocalUsernames:
+
+    def test_local_usernames(self, fake_passwd):
+        assert local_usernames() == {'root', 'somename'}
+
+    def test_cached_until_modified(self, fake_passwd):
+        assert local_usernames() == {'root', 'somename'}
+
+        with mock.patch('builtins.open') as mock_open:
+            assert local_usernames() == {'root', 'somename'}
+        assert not mock_open.called
+
+        fake_passwd.write('newuser:x:2:2::/:/bin/sh\n')
+        os.utime(fake_passwd.strpath, ns=(0, 0))
+        assert local_usernames() == {'newuser'}
@@ -34,3 +34,14 @@ def celery_app():
             'events.default_dispatcher': dispatcher,
         }
     )
+
+
+class FakeClock:
+    """A clock to pass to code taking a `clock` function; tests move it on by
+    adding to `now`."""
+
+    def __init__(self, now=1000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
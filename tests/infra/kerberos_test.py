@@ -1,107 +1,247 @@
-import subprocess
+import os
+import signal
+import stat
+import sys
+from textwrap import dedent
 
 import mock
 import pytest
 
+import ocflib.infra.kerberos as kerberos
 from ocflib.infra.kerberos import create_kerberos_principal_with_keytab
 from ocflib.infra.kerberos import get_kerberos_principal_with_keytab
+from ocflib.infra.kerberos import kadmin_session
+from ocflib.infra.kerberos import KadminSession
+from ocflib.infra.kerberos import principals_exist
+
+
+FAKE_KADMIN = dedent('''\
+    #!{python}
+    """A tiny imitation of Heimdal's interactive kadmin.
+
+    Principals are stored one per line in the file named by FAKE_KADMIN_DB, and
+    every start is logged to FAKE_KADMIN_LOG.
+    """
+    import getpass
+    import os
+    import sys
+
+    db = os.environ['FAKE_KADMIN_DB']
+    with open(os.environ['FAKE_KADMIN_LOG'], 'a') as log:
+        log.write(' '.join(sys.argv[1:]) + '\\n')
+
+    def principals():
+        with open(db) as f:
+            return set(f.read().split())
+
+    while True:
+        try:
+            line = input('kadmin> ')
+        except EOFError:
+            break
+        command, *args = line.split()
+        if command == 'exit':
+            break
+        elif command == 'die':
+            sys.exit(1)
+        elif command == 'list':
+            for name in args:
+                if name in principals():
+                    print('{{}}@OCF.BERKELEY.EDU'.format(name))
+        elif command == 'get':
+            if args[0] in principals():
+                print('            Principal: {{}}@OCF.BERKELEY.EDU'.format(args[0]))
+            else:
+                print('kadmin: get {{}}: Principal does not exist'.format(args[0]))
+        elif command in ('add', 'cpw'):
+            name = args[-1]
+            if (name in principals()) == (command == 'add'):
+                print('kadmin: {{}}: Principal does not exist or already exists'.format(command))
+                continue
+            first = getpass.getpass("{{}}@OCF.BERKELEY.EDU's Password: ".format(name))
+            second = getpass.getpass("Verify password - {{}}@OCF.BERKELEY.EDU's Password: ".format(name))
+            if first != second:
+                print('kadmin: {{}}: Passwords do not match'.format(command))
+            elif command == 'add':
+                with open(db, 'a') as f:
+                    f.write(name + '\\n')
+        else:
+            print('kadmin: Unknown command {{}}'.format(command))
+''').format(python=sys.executable)
+
+
+@pytest.yield_fixture
+def fake_kadmin(tmpdir):
+    kadmin = tmpdir.join('kadmin')
+    kadmin.write(FAKE_KADMIN)
+    os.chmod(kadmin.strpath, stat.S_IRWXU)
+
+    db = tmpdir.join('principals')
+    db.write('ckuehl\n')
+    log = tmpdir.join('log')
+    log.write('')
+
+    with mock.patch.object(kerberos, 'KADMIN_PATH', kadmin.strpath), \
+            mock.patch.dict(os.environ, {'FAKE_KADMIN_DB': db.strpath, 'FAKE_KADMIN_LOG': log.strpath}), \
+            mock.patch.dict(kerberos._kadmin_sessions, clear=True):
+        yield log
+        for session in kerberos._kadmin_sessions.values():
+            session.close()
+
+
+def starts(log):
+    return log.read().splitlines()
+
+
+class TestKadminSession:
+
+    def test_reuses_process(self, fake_kadmin):
+        session = KadminSession('/some/keytab', 'create/admin')
+        try:
+            assert session.run('get ckuehl') == 'Principal: ckuehl@OCF.BERKELEY.EDU'
+            assert 'Principal does not exist' in session.run('get nobody')
+        finally:
+            session.close()
+        assert starts(fake_kadmin) == ['-K /some/keytab -p create/admin']
+
+    def test_restarts_after_failure(self, fake_kadmin):
+        session = KadminSession('/some/keytab', 'create/admin')
+        try:
+            with pytest.raises(ValueError):
+                session.run('die')
+            assert session.run('get ckuehl') == 'Principal: ckuehl@OCF.BERKELEY.EDU'
+        finally:
+            session.close()
+        assert len(starts(fake_kadmin)) == 2
+
+    def test_restarts_when_old(self, fake_kadmin):
+        session = KadminSession('/some/keytab', 'create/admin', max_age=0)
+        try:
+            session.run('get ckuehl')
+            session.run('get ckuehl')
+        finally:
+            session.close()
+        assert len(starts(fake_kadmin)) == 2
+
+    def test_rejects_multiple_lines(self, fake_kadmin):
+        with pytest.raises(ValueError):
+            KadminSession('/some/keytab', 'create/admin').run('get ckuehl\nget ggroup')
+
+    def test_shared_sessions(self, fake_kadmin):
+        assert kadmin_session('/some/keytab', 'create/admin') is kadmin_session('/some/keytab', 'create/admin')
+        assert kadmin_session('/some/keytab', 'create/admin') is not kadmin_session('/other/keytab', 'create/admin')
+
+    def test_sessions_not_shared_after_fork(self, fake_kadmin):
+        session = kadmin_session('/some/keytab', 'create/admin')
+        session.run('get ckuehl')
+
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover (child)
+            signal.alarm(5)
+            try:
+                child_session = kadmin_session('/some/keytab', 'create/admin')
+                ok = child_session is not session and \
+                    child_session.run('get ckuehl') == 'Principal: ckuehl@OCF.BERKELEY.EDU'
+                child_session.close()
+                os._exit(0 if ok else 1)
+            finally:
+                os._exit(2)
+
+        _, status = os.waitpid(pid, 0)
+        assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+        # the parent's process is still there, and still ours
+        assert kadmin_session('/some/keytab', 'create/admin') is session
+        assert session.run('get ckuehl') == 'Principal: ckuehl@OCF.BERKELEY.EDU'
+        assert len(starts(fake_kadmin)) == 2
 
 
 class TestCreateKerberosPrincipal:
 
-    @mock.patch('pexpect.spawn')
-    def test_normal_password(self, mock_spawn):
-        mock_spawn.return_value.exitstatus = 0
-
-        create_kerberos_principal_with_keytab(
+    def test_normal_password(self, fake_kadmin):
+        assert create_kerberos_principal_with_keytab(
             'ggroup',
             '/some/keytab',
             'create/admin',
             password='hunter2',
-        )
-
-        mock_spawn.assert_called_once_with(
-            ('/usr/bin/kadmin -K /some/keytab -p create/admin add ' +
-             '--use-defaults ggroup'),
-            timeout=10,
-        )
-        mock_spawn.return_value.sendline.assert_has_calls(
-            [mock.call('hunter2'), mock.call('hunter2')],
-        )
+        ) == 'hunter2'
+        assert get_kerberos_principal_with_keytab('ggroup', '/some/keytab', 'create/admin')
 
-    @mock.patch('pexpect.spawn')
-    def test_random_password(self, mock_spawn):
-        mock_spawn.return_value.exitstatus = 0
-
-        create_kerberos_principal_with_keytab(
+    def test_random_password(self, fake_kadmin):
+        password = create_kerberos_principal_with_keytab(
             'ggroup',
             '/some/keytab',
             'create/admin',
         )
+        assert len(password) == 100
 
-        mock_spawn.assert_called_once_with(
-            ('/usr/bin/kadmin -K /some/keytab -p create/admin add ' +
-             '--use-defaults ggroup'),
-            timeout=10,
-        )
-        assert len(mock_spawn.return_value.sendline.call_args[0][0]) == 100
-
-    @mock.patch('pexpect.spawn')
-    def test_errors(self, mock_spawn):
-        mock_spawn.return_value.before.decode.return_value = (
-            'kadmin: kadm5_create_principal: Principal already exists'
-        )
-        mock_spawn.return_value.exitstatus = 1
-
+    def test_errors(self, fake_kadmin):
         with pytest.raises(ValueError):
             create_kerberos_principal_with_keytab(
-                'ggroup',
+                'ckuehl',
                 '/some/keytab',
                 'create/admin',
             )
 
+    @pytest.mark.parametrize('principal', ['ggroup\nget ckuehl', 'g group', ''])
+    def test_invalid_name(self, principal, fake_kadmin):
+        with pytest.raises(ValueError):
+            create_kerberos_principal_with_keytab(principal, '/some/keytab', 'create/admin')
+
+    def test_single_process(self, fake_kadmin):
+        for principal in ('ggroup', 'jvperrin', 'mattmcal'):
+            if not get_kerberos_principal_with_keytab(principal, '/some/keytab', 'create/admin'):
+                create_kerberos_principal_with_keytab(principal, '/some/keytab', 'create/admin')
+        assert len(starts(fake_kadmin)) == 1
+
 
 class TestGetKerberosPrincipal:
 
-    @mock.patch('subprocess.check_output')
-    def test_existing_principal(self, mock_check_output):
+    def test_existing_principal(self, fake_kadmin):
         assert get_kerberos_principal_with_keytab(
-            'ggroup',
+            'ckuehl',
             '/some/keytab',
             'create/admin',
         )
 
-        mock_check_output.assert_called_once_with(
-            ['/usr/bin/kadmin', '-K', '/some/keytab', '-p', 'create/admin', 'get', 'ggroup'],
-            timeout=10,
-            stderr=subprocess.STDOUT,
-        )
-
-    @mock.patch('subprocess.check_output')
-    def test_nonexistent_principal(self, mock_check_output):
-        mock_check_output.side_effect = subprocess.CalledProcessError(
-            1,
-            ['/usr/bin/kadmin', '-K', '/some/keytab', '-p', 'create/admin', 'get', 'ggroup'],
-            b'kadmin: get ggroup: Principal does not exist',
-        )
-
+    def test_nonexistent_principal(self, fake_kadmin):
         assert not get_kerberos_principal_with_keytab(
             'ggroup',
             '/some/keytab',
             'create/admin',
         )
 
-    @mock.patch('subprocess.check_output')
-    def test_error(self, mock_check_output):
-        mock_check_output.side_effect = subprocess.CalledProcessError(
-            1,
-            ['/usr/bin/kadmin', '-K', '/some/keytab', '-p', 'create/admin', 'get', 'ggroup'],
-            b'kadmin: get ggroup: no such file or directory'
-        )
+    def test_error(self, fake_kadmin):
+        with mock.patch.object(KadminSession, 'run', return_value='kadmin: get: no such file or directory'):
+            with pytest.raises(ValueError):
+                get_kerberos_principal_with_keytab(
+                    'ggroup',
+                    '/some/keytab',
+                    'create/admin',
+                )
+
 
+class TestPrincipalsExist:
+
+    def test_principals_exist(self, fake_kadmin):
+        create_kerberos_principal_with_keytab('ggroup', '/some/keytab', 'create/admin')
+        assert principals_exist(
+            ['ckuehl', 'ggroup', 'nobody', 'ckuehl'],
+            '/some/keytab',
+            'create/admin',
+        ) == {'ckuehl', 'ggroup'}
+
+    def test_batches(self, fake_kadmin):
+        names = ['user{}'.format(i) for i in range(5)] + ['ckuehl']
+        with mock.patch.object(kerberos, 'KADMIN_LIST_BATCH', 2), \
+                mock.patch.object(KadminSession, 'run', autospec=True, side_effect=KadminSession.run) as run:
+            assert principals_exist(names, '/some/keytab', 'create/admin') == {'ckuehl'}
+        assert run.call_count == 3
+        assert len(starts(fake_kadmin)) == 1
+
+    def test_empty(self, fake_kadmin):
+        assert principals_exist([], '/some/keytab', 'create/admin') == frozenset()
+        assert starts(fake_kadmin) == []
+
+    def test_invalid_name(self, fake_kadmin):
         with pytest.raises(ValueError):
-            get_kerberos_principal_with_keytab(
-                'ggroup',
-                '/some/keytab',
-                'create/admin',
-            )
+            principals_exist(['ckuehl', '*'], '/some/keytab', 'create/admin')
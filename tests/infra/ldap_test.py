@@ -7,6 +7,7 @@ from textwrap import dedent
 import mock
 import pytest
 
+from ocflib.infra.ldap import create_ldap_entries
 from ocflib.infra.ldap import create_ldap_entry
 from ocflib.infra.ldap import modify_ldap_entry
 
@@ -105,6 +106,54 @@ class TestCreateLdapEntry:
         assert mock_subprocess_check_output.assert_not_called
 
 
+class TestCreateLdapEntries:
+
+    def test_single_call(self, mock_subprocess_check_output, mock_send_problem_report):
+        assert create_ldap_entries([
+            ('uid=ckuehl,ou=People,dc=OCF,dc=Berkeley,dc=EDU', {'a': 'b'}),
+            ('uid=jvperrin,ou=People,dc=OCF,dc=Berkeley,dc=EDU', {'a': 'c'}),
+        ]) == [None, None]
+
+        ldif = dedent("""
+            dn:: dWlkPWNrdWVobCxvdT1QZW9wbGUsZGM9T0NGLGRjPUJlcmtlbGV5LGRjPUVEVQ==
+            changetype: add
+            a:: Yg==
+
+            dn:: dWlkPWp2cGVycmluLG91PVBlb3BsZSxkYz1PQ0YsZGM9QmVya2VsZXksZGM9RURV
+            changetype: add
+            a:: Yw==
+        """).lstrip()
+
+        mock_subprocess_check_output.assert_called_once_with(
+            ('/usr/bin/ldapmodify', '-Q'),
+            input=ldif,
+            universal_newlines=True,
+            timeout=12,
+        )
+
+    def test_empty(self, mock_subprocess_check_output):
+        assert create_ldap_entries([]) == []
+        assert not mock_subprocess_check_output.called
+
+    def test_falls_back_to_single_entries(self, mock_subprocess_check_output, mock_send_problem_report):
+        mock_subprocess_check_output.side_effect = [
+            # the batch fails after adding the first entry
+            CalledProcessError(68, 'cmd', output='Already exists (68)'),
+            CalledProcessError(68, 'cmd', output='Already exists (68)'),
+            CalledProcessError(35, 'cmd', output='lol random error'),
+            None,
+        ]
+        errors = create_ldap_entries([
+            ('uid=ckuehl,ou=People,dc=OCF,dc=Berkeley,dc=EDU', {'a': 'b'}),
+            ('uid=jvperrin,ou=People,dc=OCF,dc=Berkeley,dc=EDU', {'a': 'c'}),
+            ('uid=mattmcal,ou=People,dc=OCF,dc=Berkeley,dc=EDU', {'a': 'd'}),
+        ])
+        assert mock_subprocess_check_output.call_count == 4
+        assert str(errors[0]) == 'Tried to create duplicate entry.'
+        assert str(errors[1]) == 'Unknown LDAP failure was encountered.'
+        assert errors[2] is None
+
+
 class TestModifyLdapEntry:
 
     def test_normal_modification(self, mock_subprocess_check_output, mock_send_problem_report):
@@ -0,0 +1,186 @@
+import asyncio
+import threading
+
+import mock
+import pytest
+
+import ocflib.infra.resolver as resolver
+from ocflib.infra.resolver import CachingResolver
+from ocflib.infra.resolver import get_resolver
+from ocflib.infra.resolver import set_resolver
+from tests.fixtures_test import FakeClock
+
+
+RECORDS = {
+    ('berkeley.edu', 'MX'): (('10 mx.berkeley.edu.',), 300),
+    ('ocf.berkeley.edu', 'MX'): (('5 mail.ocf.berkeley.edu.',), 60),
+    ('nxdomain.berkeley.edu', 'MX'): ((), 30),
+    ('www.ocf.berkeley.edu', 'MX'): ((), None),
+    ('uncacheable.berkeley.edu', 'MX'): (('10 mx.berkeley.edu.',), 0),
+}
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def lookup():
+    return mock.Mock(side_effect=lambda name, rdtype: RECORDS[name, rdtype])
+
+
+@pytest.fixture
+def caching_resolver(lookup, clock):
+    return CachingResolver(lookup=lookup, negative_ttl=120, clock=clock)
+
+
+class TestCachingResolver:
+
+    def test_caches_answers(self, caching_resolver, lookup):
+        for _ in range(3):
+            assert caching_resolver.resolve('berkeley.edu', 'MX') == ('10 mx.berkeley.edu.',)
+        assert lookup.call_count == 1
+
+    def test_normalizes_names(self, caching_resolver, lookup):
+        for name in ('berkeley.edu', 'Berkeley.EDU', 'berkeley.edu.'):
+            assert caching_resolver.resolve(name, 'mx') == ('10 mx.berkeley.edu.',)
+        lookup.assert_called_once_with('berkeley.edu', 'MX')
+
+    def test_honours_ttl(self, caching_resolver, lookup, clock):
+        caching_resolver.resolve('ocf.berkeley.edu', 'MX')
+        clock.now += 59
+        caching_resolver.resolve('ocf.berkeley.edu', 'MX')
+        assert lookup.call_count == 1
+        clock.now += 1
+        caching_resolver.resolve('ocf.berkeley.edu', 'MX')
+        assert lookup.call_count == 2
+
+    @pytest.mark.parametrize('name,ttl', [
+        ('nxdomain.berkeley.edu', 30),
+        ('www.ocf.berkeley.edu', 120),
+    ])
+    def test_negative_caching(self, caching_resolver, lookup, clock, name, ttl):
+        assert caching_resolver.resolve(name, 'MX') == ()
+        clock.now += ttl - 1
+        assert caching_resolver.resolve(name, 'MX') == ()
+        assert lookup.call_count == 1
+        clock.now += 1
+        caching_resolver.resolve(name, 'MX')
+        assert lookup.call_count == 2
+
+    def test_zero_ttl_not_cached(self, caching_resolver, lookup):
+        caching_resolver.resolve('uncacheable.berkeley.edu', 'MX')
+        caching_resolver.resolve('uncacheable.berkeley.edu', 'MX')
+        assert lookup.call_count == 2
+
+    def test_max_ttl(self, lookup, clock):
+        caching_resolver = CachingResolver(lookup=lookup, max_ttl=10, clock=clock)
+        caching_resolver.resolve('berkeley.edu', 'MX')
+        clock.now += 10
+        caching_resolver.resolve('berkeley.edu', 'MX')
+        assert lookup.call_count == 2
+
+    def test_bounded_size(self, lookup, clock):
+        caching_resolver = CachingResolver(lookup=lookup, size=2, clock=clock)
+        caching_resolver.resolve('berkeley.edu', 'MX')
+        caching_resolver.resolve('ocf.berkeley.edu', 'MX')
+        caching_resolver.resolve('berkeley.edu', 'MX')
+        caching_resolver.resolve('nxdomain.berkeley.edu', 'MX')
+        assert len(caching_resolver) == 2
+
+        # ocf.berkeley.edu was least recently used, so it was evicted
+        caching_resolver.resolve('berkeley.edu', 'MX')
+        assert lookup.call_count == 3
+        caching_resolver.resolve('ocf.berkeley.edu', 'MX')
+        assert lookup.call_count == 4
+
+    def test_errors_not_cached(self, caching_resolver, lookup):
+        lookup.side_effect = [ValueError('timed out'), RECORDS['berkeley.edu', 'MX']]
+        with pytest.raises(ValueError):
+            caching_resolver.resolve('berkeley.edu', 'MX')
+        assert caching_resolver.resolve('berkeley.edu', 'MX') == ('10 mx.berkeley.edu.',)
+
+    @pytest.mark.parametrize('name', ['', 'a..b', 'a' * 64 + '.com'])
+    def test_invalid_names(self, caching_resolver, lookup, name):
+        assert caching_resolver.resolve(name, 'MX') == ()
+        assert not lookup.called
+
+    def test_clear(self, caching_resolver, lookup):
+        caching_resolver.resolve('berkeley.edu', 'MX')
+        caching_resolver.clear()
+        caching_resolver.resolve('berkeley.edu', 'MX')
+        assert lookup.call_count == 2
+
+
+class TestResolveMany:
+
+    def test_resolve_many(self, caching_resolver, lookup):
+        assert caching_resolver.resolve_many(
+            ['berkeley.edu', 'Berkeley.edu', 'nxdomain.berkeley.edu', 'berkeley.edu', 'a..b'],
+            'MX',
+        ) == {
+            'berkeley.edu': ('10 mx.berkeley.edu.',),
+            'Berkeley.edu': ('10 mx.berkeley.edu.',),
+            'nxdomain.berkeley.edu': (),
+            'a..b': (),
+        }
+        assert sorted(lookup.call_args_list) == [
+            mock.call('berkeley.edu', 'MX'),
+            mock.call('nxdomain.berkeley.edu', 'MX'),
+        ]
+
+        # answers are cached for later lookups
+        caching_resolver.resolve('berkeley.edu', 'MX')
+        caching_resolver.resolve_many(['nxdomain.berkeley.edu'], 'MX')
+        assert lookup.call_count == 2
+
+    def test_uses_cache(self, caching_resolver, lookup):
+        caching_resolver.resolve('berkeley.edu', 'MX')
+        caching_resolver.resolve_many(['berkeley.edu', 'ocf.berkeley.edu'], 'MX')
+        assert lookup.call_args_list == [
+            mock.call('berkeley.edu', 'MX'),
+            mock.call('ocf.berkeley.edu', 'MX'),
+        ]
+
+    def test_errors(self, caching_resolver, lookup):
+        def fail(name, rdtype):
+            if name == 'ocf.berkeley.edu':
+                raise ValueError('timed out')
+            return RECORDS[name, rdtype]
+        lookup.side_effect = fail
+
+        results = caching_resolver.resolve_many(['berkeley.edu', 'ocf.berkeley.edu'], 'MX')
+        assert results['berkeley.edu'] == ('10 mx.berkeley.edu.',)
+        assert isinstance(results['ocf.berkeley.edu'], ValueError)
+        assert len(caching_resolver) == 1
+
+    def test_concurrency(self, clock):
+        running = []
+        most = []
+        lock = threading.Lock()
+
+        async def async_lookup(name, rdtype):
+            with lock:
+                running.append(name)
+                most.append(len(running))
+            await asyncio.sleep(0.01)
+            with lock:
+                running.remove(name)
+            return ('10 mx.berkeley.edu.',), 300
+
+        caching_resolver = CachingResolver(lookup=None, async_lookup=async_lookup, clock=clock)
+        names = ['host{}.berkeley.edu'.format(i) for i in range(10)]
+        results = caching_resolver.resolve_many(names, 'MX', concurrency=3)
+        assert set(results) == set(names)
+        assert max(most) == 3
+
+
+def test_set_resolver(caching_resolver, lookup):
+    old = set_resolver(caching_resolver)
+    try:
+        assert get_resolver() is caching_resolver
+        assert resolver.resolve('berkeley.edu', 'MX') == ('10 mx.berkeley.edu.',)
+    finally:
+        assert set_resolver(old) is caching_resolver
+    lookup.assert_called_once_with('berkeley.edu', 'MX')
@@ -1,13 +1,34 @@
+import os
+import signal
+import smtplib
+import stat
 import subprocess
+import sys
+import threading
+import time
 from email.parser import Parser
+from textwrap import dedent
 
 import mock
 import pytest
 
+import ocflib.misc.mail as mail
 from ocflib.misc.mail import email_for_user
+from ocflib.misc.mail import MailQueue
+from ocflib.misc.mail import MemoryTransport
+from ocflib.misc.mail import ProblemReporter
+from ocflib.misc.mail import queue_mail
+from ocflib.misc.mail import render_mail_template
+from ocflib.misc.mail import render_many
 from ocflib.misc.mail import send_mail
 from ocflib.misc.mail import send_mail_user
+from ocflib.misc.mail import send_mails
 from ocflib.misc.mail import send_problem_report
+from ocflib.misc.mail import SendmailTransport
+from ocflib.misc.mail import set_transport
+from ocflib.misc.mail import SMTPTransport
+from ocflib.misc.mail import warm_mail_templates
+from tests.fixtures_test import FakeClock
 
 MAIL_ROOT = 'root@ocf.berkeley.edu'
 SENDMAIL_PATH = '/usr/sbin/sendmail'
@@ -110,3 +131,446 @@ class TestEmailSending:
         assert msg['To'] == MAIL_ROOT
         assert msg['Cc'] == ''
         assert 'hellllo world' in msg.get_payload(0).get_payload()
+
+
+FAKE_SENDMAIL = dedent('''\
+    #!{python}
+    """Just enough of `sendmail -bs` to accept mail over SMTP on stdin.
+
+    Each message is saved to a file in FAKE_SENDMAIL_DIR, and every start is
+    logged to FAKE_SENDMAIL_DIR/starts. Recipients containing "reject" are
+    refused.
+    """
+    import os
+    import sys
+
+    outdir = os.environ['FAKE_SENDMAIL_DIR']
+    with open(os.path.join(outdir, 'starts'), 'a') as f:
+        f.write(' '.join(sys.argv[1:]) + '\\n')
+
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+
+    def reply(line):
+        stdout.write(line.encode('ascii') + b'\\r\\n')
+        stdout.flush()
+
+    reply('220 fake ESMTP')
+    count = 0
+    for line in stdin:
+        command = line.decode('ascii').strip().upper()
+        if command.startswith('EHLO'):
+            reply('250 fake')
+        elif command.startswith('RCPT') and 'REJECT' in command:
+            reply('550 no such user')
+        elif command == 'DATA':
+            reply('354 go ahead')
+            data = []
+            for line in stdin:
+                if line == b'.\\r\\n':
+                    break
+                data.append(line)
+            count += 1
+            with open(os.path.join(outdir, '{{}}-{{}}.eml'.format(os.getpid(), count)), 'wb') as f:
+                f.write(b''.join(data))
+            reply('250 queued')
+        elif command == 'QUIT':
+            reply('221 bye')
+            break
+        else:
+            reply('250 ok')
+''').format(python=sys.executable)
+
+
+@pytest.yield_fixture
+def valid_emails():
+    with mock.patch('ocflib.misc.validators.valid_email', return_value=True):
+        yield
+
+
+@pytest.yield_fixture
+def fake_sendmail(tmpdir, valid_emails):
+    sendmail = tmpdir.join('sendmail')
+    sendmail.write(FAKE_SENDMAIL)
+    os.chmod(sendmail.strpath, stat.S_IRWXU)
+    outdir = tmpdir.mkdir('out')
+    outdir.join('starts').write('')
+
+    with mock.patch.object(mail, 'SENDMAIL_PATH', sendmail.strpath), \
+            mock.patch.dict(os.environ, {'FAKE_SENDMAIL_DIR': outdir.strpath}):
+        yield outdir
+
+
+def delivered(outdir):
+    return sorted(
+        (Parser().parsestr(f.read()) for f in outdir.listdir('*.eml')),
+        key=lambda msg: msg['Subject'],
+    )
+
+
+class FakeSMTP:
+    """In-memory stand-in for an smtplib.SMTP connection."""
+
+    def __init__(self, sent, fail):
+        self.sent = sent
+        self.fail = fail
+
+    def send_message(self, msg):
+        if self.fail:
+            raise self.fail.pop(0)
+        self.sent.append(msg)
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TestMailQueue:
+
+    def test_batches_over_one_sendmail(self, fake_sendmail):
+        queue = MailQueue(interval=60)
+        for i in range(3):
+            queue.put(mail._build_message('devnull@ocf.berkeley.edu', 'message {}'.format(i), 'body'))
+        assert len(queue) == 3
+        queue.stop()
+
+        messages = delivered(fake_sendmail)
+        assert [msg['Subject'] for msg in messages] == ['message 0', 'message 1', 'message 2']
+        assert messages[0].get_payload(0).get_payload() == 'body'
+        assert fake_sendmail.join('starts').read() == '-bs\n'
+        assert len(queue) == 0
+
+    def test_background_delivery(self, fake_sendmail):
+        queue = MailQueue(interval=0.05)
+        queue.put(mail._build_message('devnull@ocf.berkeley.edu', 'hello', 'body'))
+        try:
+            for _ in range(100):
+                if delivered(fake_sendmail):
+                    break
+                time.sleep(0.05)
+            assert [msg['Subject'] for msg in delivered(fake_sendmail)] == ['hello']
+        finally:
+            queue.stop()
+
+    def test_rejected_recipient_dropped(self, fake_sendmail):
+        queue = MailQueue(interval=60)
+        queue.put(mail._build_message('reject@ocf.berkeley.edu', 'rejected', 'body'))
+        queue.put(mail._build_message('devnull@ocf.berkeley.edu', 'accepted', 'body'))
+        queue.stop()
+
+        assert [msg['Subject'] for msg in delivered(fake_sendmail)] == ['accepted']
+        assert len(queue) == 0
+
+    def test_retries_temporary_failures(self, valid_emails):
+        sent = []
+        failures = [smtplib.SMTPServerDisconnected('gone'), smtplib.SMTPResponseException(451, 'try later')]
+        queue = MailQueue(connect=lambda: FakeSMTP(sent, failures), interval=60, retry_delay=0)
+        for subject in ('first', 'second'):
+            queue.put(mail._build_message('devnull@ocf.berkeley.edu', subject, 'body'))
+
+        queue.flush()
+        assert sent == []
+        assert len(queue) == 2
+
+        queue.flush()
+        assert [msg['Subject'] for msg in sent] == ['second']
+
+        queue.flush()
+        assert [msg['Subject'] for msg in sent] == ['second', 'first']
+        assert len(queue) == 0
+        queue.stop()
+
+    def test_gives_up_eventually(self, valid_emails, capsys):
+        def connect():
+            raise ConnectionRefusedError()
+
+        queue = MailQueue(connect=connect, interval=60, max_attempts=2, retry_delay=0)
+        queue.put(mail._build_message('devnull@ocf.berkeley.edu', 'subject', 'body'))
+        queue.flush()
+        assert len(queue) == 1
+        queue.flush()
+        assert len(queue) == 0
+        assert 'Dropping mail to devnull@ocf.berkeley.edu' in capsys.readouterr().err
+        queue.stop()
+
+    def test_flush_waits_for_background_delivery(self, valid_emails):
+        sent = []
+        queue = MailQueue(connect=lambda: FakeSMTP(sent, []), interval=60)
+        queue.put(mail._build_message('devnull@ocf.berkeley.edu', 'subject', 'body'))
+
+        # the background thread has taken the batch but not yet sent it
+        with queue._deliver_lock:
+            with queue._cond:
+                batch = queue._take_batch(time.monotonic())
+            flusher = threading.Thread(target=queue.flush)
+            flusher.start()
+            flusher.join(0.1)
+            assert flusher.is_alive()
+            queue._deliver(batch)
+
+        flusher.join(5)
+        assert [msg['Subject'] for msg in sent] == ['subject']
+        queue.stop()
+
+    def test_fork_with_locks_held(self, valid_emails):
+        sent = []
+        queue = MailQueue(connect=lambda: FakeSMTP(sent, []), interval=60)
+        queue.put(mail._build_message('devnull@ocf.berkeley.edu', 'parent', 'body'))
+
+        with queue._cond, queue._deliver_lock:
+            pid = os.fork()
+            if pid == 0:  # pragma: no cover (child)
+                signal.alarm(5)
+                try:
+                    queue.put(mail._build_message('devnull@ocf.berkeley.edu', 'child', 'body'))
+                    queue.flush()
+                    os._exit(0 if [msg['Subject'] for msg in sent] == ['child'] else 1)
+                finally:
+                    os._exit(2)
+
+        _, status = os.waitpid(pid, 0)
+        assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+        queue.stop()
+        assert [msg['Subject'] for msg in sent] == ['parent']
+
+    def test_queue_mail(self, valid_emails):
+        with mock.patch.object(mail.mail_queue, 'put') as put:
+            queue_mail('devnull@ocf.berkeley.edu', 'hello world', 'this is a body')
+        msg = put.call_args[0][0]
+        assert msg['To'] == 'devnull@ocf.berkeley.edu'
+        assert msg['Subject'] == 'hello world'
+
+    def test_queue_mail_invalid(self):
+        with mock.patch('ocflib.misc.validators.valid_email', return_value=False), \
+                mock.patch.object(mail.mail_queue, 'put') as put:
+            with pytest.raises(ValueError):
+                queue_mail('devnull@ocf.berkeley.edu', 'hello world', 'this is a body')
+        assert not put.called
+
+
+@pytest.yield_fixture
+def memory_transport():
+    transport = MemoryTransport()
+    old = set_transport(transport)
+    try:
+        yield transport
+    finally:
+        set_transport(old)
+
+
+class TestTransports:
+
+    def test_sendmail_send_many(self, fake_sendmail):
+        results = SendmailTransport().send_many([
+            mail._build_message('devnull@ocf.berkeley.edu', 'first', 'body'),
+            mail._build_message('reject@ocf.berkeley.edu', 'rejected', 'body'),
+            mail._build_message('devnull@ocf.berkeley.edu', 'second', 'body'),
+        ])
+        assert results[0] is None and results[2] is None
+        assert isinstance(results[1], smtplib.SMTPRecipientsRefused)
+        assert [msg['Subject'] for msg in delivered(fake_sendmail)] == ['first', 'second']
+        assert fake_sendmail.join('starts').read() == '-bs\n'
+
+    def test_smtp_reuses_connection(self, valid_emails):
+        sent = []
+        connect = mock.Mock(side_effect=lambda: FakeSMTP(sent, []))
+        transport = SMTPTransport(connect=connect)
+        for subject in ('first', 'second', 'third'):
+            transport.send(mail._build_message('devnull@ocf.berkeley.edu', subject, 'body'))
+        transport.close()
+        assert [msg['Subject'] for msg in sent] == ['first', 'second', 'third']
+        assert connect.call_count == 1
+
+    def test_smtp_reconnects(self, valid_emails):
+        sent = []
+        failures = []
+        connect = mock.Mock(side_effect=lambda: FakeSMTP(sent, failures))
+        transport = SMTPTransport(connect=connect)
+        transport.send(mail._build_message('devnull@ocf.berkeley.edu', 'first', 'body'))
+
+        failures.append(smtplib.SMTPServerDisconnected('idle too long'))
+        transport.send(mail._build_message('devnull@ocf.berkeley.edu', 'second', 'body'))
+        assert [msg['Subject'] for msg in sent] == ['first', 'second']
+        assert connect.call_count == 2
+
+        # a fresh connection failing isn't retried
+        transport.close()
+        failures.append(smtplib.SMTPServerDisconnected('gone'))
+        with pytest.raises(smtplib.SMTPServerDisconnected):
+            transport.send(mail._build_message('devnull@ocf.berkeley.edu', 'third', 'body'))
+
+    def test_smtp_send_many(self, valid_emails):
+        sent = []
+        failures = [smtplib.SMTPResponseException(451, 'try later')]
+        transport = SMTPTransport(connect=lambda: FakeSMTP(sent, failures))
+        results = transport.send_many(
+            mail._build_message('devnull@ocf.berkeley.edu', subject, 'body')
+            for subject in ('first', 'second')
+        )
+        assert isinstance(results[0], smtplib.SMTPResponseException)
+        assert results[1] is None
+        assert [msg['Subject'] for msg in sent] == ['second']
+
+    def test_send_mail(self, memory_transport):
+        send_mail('devnull@ocf.berkeley.edu', 'hello world', 'this is a body')
+        msg, = memory_transport.outbox
+        assert msg['To'] == 'devnull@ocf.berkeley.edu'
+        assert msg['Subject'] == 'hello world'
+
+    def test_send_mails(self, memory_transport):
+        results = send_mails([
+            {'to': 'devnull@ocf.berkeley.edu', 'subject': 'first', 'body': 'body'},
+            {'to': 'not@a.real@email', 'subject': 'invalid', 'body': 'body'},
+            {'to': 'devnull@ocf.berkeley.edu', 'subject': 'second', 'body': 'body', 'cc': 'keur@ocf.berkeley.edu'},
+        ])
+        assert results[0] is None and results[2] is None
+        assert isinstance(results[1], ValueError)
+        assert [msg['Subject'] for msg in memory_transport.outbox] == ['first', 'second']
+        assert memory_transport.outbox[1]['Cc'] == 'keur@ocf.berkeley.edu'
+
+    def test_send_mails_empty(self, memory_transport):
+        assert send_mails([]) == []
+
+
+class TestProblemReporter:
+
+    @pytest.yield_fixture
+    def reporter(self, memory_transport):
+        reporter = ProblemReporter(dedup_window=60, max_reports=2, period=600, clock=FakeClock())
+        try:
+            yield reporter
+        finally:
+            reporter.flush()
+
+    def test_capture_stack(self):
+        def inner():
+            return mail._capture_stack(sys._getframe())
+
+        stack = inner()
+        assert stack[0].endswith('(inner)')
+        assert stack[1].endswith('(test_capture_stack)')
+        assert stack[0].startswith(__file__ + ':')
+
+    def test_send_problem_report(self, memory_transport):
+        with mock.patch.object(mail, 'problem_reporter', ProblemReporter()):
+            send_problem_report('hellllo world')
+        msg, = memory_transport.outbox
+        body = msg.get_payload(0).get_payload()
+        assert 'hellllo world' in body
+        assert '(test_send_problem_report)' in body.split('Callstack:')[1].splitlines()[1]
+
+    def test_deduplicates(self, reporter, memory_transport):
+        for _ in range(3):
+            reporter.report('ldapmodify failed', ('a.py:1 (f)',))
+        reporter.report('ldapmodify failed', ('b.py:1 (g)',))
+        assert len(memory_transport.outbox) == 2
+
+        reporter.clock.now += 60
+        reporter.report('ldapmodify failed', ('a.py:1 (f)',))
+        assert len(memory_transport.outbox) == 2  # rate limited, so held
+
+        reporter.flush()
+        digest = memory_transport.outbox[-1]
+        assert digest['Subject'].startswith('[ocflib] 3 problem report(s) from')
+        body = digest.get_payload(0).get_payload()
+        assert 'a.py:1 (f)' in body
+        assert '2 more time(s): ldapmodify failed' in body
+
+    def test_rate_limits_into_digest(self, reporter, memory_transport):
+        for i in range(5):
+            reporter.report('problem {}'.format(i), ())
+        assert [msg['Subject'].split(' from ')[0] for msg in memory_transport.outbox] == [
+            '[ocflib] Problem report',
+            '[ocflib] Problem report',
+        ]
+        assert reporter._timer is not None
+
+        reporter.flush()
+        assert len(memory_transport.outbox) == 3
+        body = memory_transport.outbox[-1].get_payload(0).get_payload()
+        assert all('problem {}'.format(i) in body for i in (2, 3, 4))
+        assert reporter._timer is None
+
+        # the digest counts against the limit too
+        reporter.clock.now += 599
+        reporter.report('problem 5', ())
+        assert len(memory_transport.outbox) == 3
+        reporter.clock.now += 1
+        reporter.report('problem 6', ())
+        assert len(memory_transport.outbox) == 3  # still behind problem 5
+
+    def test_digest_sent_by_timer(self, memory_transport):
+        reporter = ProblemReporter(max_reports=1, period=0.05)
+        reporter.report('first', ())
+        reporter.report('second', ())
+        for _ in range(100):
+            if len(memory_transport.outbox) == 2:
+                break
+            time.sleep(0.01)
+        assert 'second' in memory_transport.outbox[1].get_payload(0).get_payload()
+
+    def test_flush_nothing(self, reporter, memory_transport):
+        reporter.flush()
+        assert memory_transport.outbox == []
+
+
+class TestTemplates:
+
+    REJECTED = 'account/mail_templates/account-rejected.jinja'
+
+    def test_render_mail_template(self):
+        body = render_mail_template(self.REJECTED, request=mock.Mock(user_name='ggroup'), reason='too cool')
+        assert 'Your OCF account, ggroup has been rejected' in body
+        assert 'too cool' in body
+        assert mail.MAIL_SIGNATURE in body
+
+    def test_render_many(self):
+        bodies = render_many(
+            self.REJECTED,
+            [
+                {'request': mock.Mock(user_name='ggroup')},
+                {'request': mock.Mock(user_name='jvperrin'), 'reason': 'different reason'},
+            ],
+            reason='shared reason',
+        )
+        assert len(bodies) == 2
+        assert 'ggroup' in bodies[0] and 'shared reason' in bodies[0]
+        assert 'jvperrin' in bodies[1] and 'different reason' in bodies[1]
+
+    def test_compiles_each_template_once(self):
+        with mock.patch.object(mail.get_mail_env(), 'cache', {}), \
+                mock.patch.object(
+                    mail.get_mail_env(), 'compile', autospec=True, side_effect=mail.get_mail_env().compile,
+                ) as compile:
+            warm_mail_templates()
+            assert compile.call_count <= 2
+            render_many(self.REJECTED, [{'request': mock.Mock(user_name='ggroup')}] * 10, reason='')
+            render_mail_template(self.REJECTED, request=mock.Mock(user_name='ggroup'), reason='')
+            assert compile.call_count <= 2
+
+    def test_bytecode_cache(self, tmpdir):
+        cache = mail._bytecode_cache(tmpdir.strpath)
+        with mock.patch.object(mail.get_mail_env(), 'cache', {}), \
+                mock.patch.object(mail.get_mail_env(), 'bytecode_cache', cache):
+            warm_mail_templates()
+        assert len(tmpdir.listdir()) == 2
+
+    def test_cache_dir_read_when_env_is_built(self, tmpdir):
+        with mock.patch.object(mail, '_mail_env', None), \
+                mock.patch.object(mail, 'MAIL_TEMPLATE_CACHE_DIR', tmpdir.join('cache').strpath):
+            env = mail.get_mail_env()
+            assert env.bytecode_cache.directory == tmpdir.join('cache').strpath
+            assert mail.get_mail_env() is env
+            assert mail.jinja_mail_env is env
+
+    def test_unusable_bytecode_cache_dir(self, tmpdir):
+        tmpdir.join('file').write('')
+        assert mail._bytecode_cache(tmpdir.join('file').join('cache').strpath) is None
+
+    def test_broken_bytecode_cache_dir(self, tmpdir):
+        cache = mail._bytecode_cache(tmpdir.join('cache').strpath)
+        tmpdir.join('cache').remove()
+        with mock.patch.object(mail.get_mail_env(), 'cache', {}), \
+                mock.patch.object(mail.get_mail_env(), 'bytecode_cache', cache):
+            assert 'ggroup' in render_mail_template(self.REJECTED, request=mock.Mock(user_name='ggroup'), reason='')
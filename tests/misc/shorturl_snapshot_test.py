@@ -0,0 +1,144 @@
+import os
+
+import pytest
+
+from ocflib.misc.shorturl_snapshot import export_shorturl_snapshot
+from ocflib.misc.shorturl_snapshot import ShorturlSnapshot
+from ocflib.misc.shorturl_snapshot import SnapshotReader
+from ocflib.misc.shorturl_snapshot import write_shorturl_snapshot
+from tests.fixtures_test import FakeClock
+from tests.misc.shorturls_test import FakeCursor
+
+
+SHORTURLS = {
+    'wiki': 'https://wiki.example.com/',
+    'docs': 'https://docs.example.com/',
+    'a': 'https://a.example.com/',
+    'über': 'https://example.com/ü',
+    'x/y.z': 'https://example.com/?q=1',
+}
+
+
+@pytest.fixture
+def path(tmpdir):
+    path = tmpdir.join('shorturls.snapshot').strpath
+    write_shorturl_snapshot(path, SHORTURLS.items())
+    return path
+
+
+class TestShorturlSnapshot:
+
+    def test_get(self, path):
+        snapshot = ShorturlSnapshot(path)
+        for slug, target in SHORTURLS.items():
+            assert snapshot.get(slug) == target
+        for slug in ('', 'b', 'wik', 'wikis', 'zzz'):
+            assert snapshot.get(slug) is None
+        snapshot.close()
+
+    def test_iter(self, path):
+        snapshot = ShorturlSnapshot(path)
+        assert len(snapshot) == len(SHORTURLS)
+        assert dict(snapshot) == SHORTURLS
+        slugs = [slug for slug, _ in snapshot]
+        assert slugs == sorted(slugs, key=lambda slug: slug.encode('utf8'))
+
+    @pytest.mark.parametrize('prefix,limit,slugs', [
+        ('', None, ['a', 'docs', 'wiki', 'x/y.z', 'über']),
+        ('w', None, ['wiki']),
+        ('wiki', None, ['wiki']),
+        ('wikis', None, []),
+        ('', 2, ['a', 'docs']),
+        ('ü', None, ['über']),
+        ('zzz', None, []),
+    ])
+    def test_with_prefix(self, path, prefix, limit, slugs):
+        matches = ShorturlSnapshot(path).with_prefix(prefix, limit=limit)
+        assert [slug for slug, _ in matches] == slugs
+        assert all(target == SHORTURLS[slug] for slug, target in matches)
+
+    @pytest.mark.parametrize('text,limit,slugs', [
+        ('', None, ['a', 'docs', 'wiki', 'x/y.z', 'über']),
+        ('ki', None, ['wiki']),
+        ('DOCS', None, ['docs']),
+        ('example.com/', None, ['a', 'docs', 'wiki', 'x/y.z', 'über']),
+        ('example.com/', 2, ['a', 'docs']),
+        ('Ü', None, ['über']),
+        ('?q=1', None, ['x/y.z']),
+        ('wiki.example.com', None, ['wiki']),
+        ('wikidocs', None, []),
+        ('zzz', None, []),
+    ])
+    def test_containing(self, path, text, limit, slugs):
+        matches = ShorturlSnapshot(path).containing(text, limit=limit)
+        assert [slug for slug, _ in matches] == slugs
+        assert all(target == SHORTURLS[slug] for slug, target in matches)
+
+    def test_containing_does_not_span_slug_and_target(self, tmpdir):
+        path = tmpdir.join('shorturls.snapshot').strpath
+        write_shorturl_snapshot(path, [('abc', 'def')])
+        snapshot = ShorturlSnapshot(path)
+        assert snapshot.containing('cde') == []
+        assert snapshot.containing('bc') == [('abc', 'def')]
+
+    def test_empty(self, tmpdir):
+        path = tmpdir.join('empty').strpath
+        write_shorturl_snapshot(path, [])
+        snapshot = ShorturlSnapshot(path)
+        assert len(snapshot) == 0
+        assert snapshot.get('wiki') is None
+        assert snapshot.containing('wiki') == []
+
+    @pytest.mark.parametrize('contents', [
+        b'',
+        b'OCFSURL1',
+        b'NOTSURL1' + bytes(8),
+        b'OCFSURL1\xff\x00\x00\x00' + bytes(4),
+    ])
+    def test_invalid(self, tmpdir, contents):
+        tmpdir.join('bad').write_binary(contents)
+        with pytest.raises(ValueError):
+            ShorturlSnapshot(tmpdir.join('bad').strpath)
+
+    def test_truncated(self, path):
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 1)
+        with pytest.raises(ValueError):
+            ShorturlSnapshot(path)
+
+    def test_export(self, tmpdir):
+        path = tmpdir.join('exported').strpath
+        export_shorturl_snapshot(FakeCursor(dict(SHORTURLS)), path)
+        assert dict(ShorturlSnapshot(path)) == SHORTURLS
+
+    def test_atomic_write(self, path, tmpdir):
+        snapshot = ShorturlSnapshot(path)
+        write_shorturl_snapshot(path, [('wiki', 'https://new.example.com/')])
+
+        # the old mapping still works, and no temporary files are left
+        assert snapshot.get('wiki') == 'https://wiki.example.com/'
+        assert ShorturlSnapshot(path).get('wiki') == 'https://new.example.com/'
+        assert tmpdir.listdir() == [tmpdir.join('shorturls.snapshot')]
+
+
+class TestSnapshotReader:
+
+    def test_picks_up_new_snapshots(self, path):
+        clock = FakeClock()
+        reader = SnapshotReader(path, check_interval=5, clock=clock)
+        assert reader.get('wiki') == 'https://wiki.example.com/'
+
+        write_shorturl_snapshot(path, [('wiki', 'https://new.example.com/')])
+        clock.now += 4
+        assert reader.get('wiki') == 'https://wiki.example.com/'
+        clock.now += 1
+        assert reader.get('wiki') == 'https://new.example.com/'
+        assert reader.get('docs') is None
+
+    def test_keeps_old_snapshot_on_error(self, path):
+        reader = SnapshotReader(path, check_interval=0)
+        os.unlink(path)
+        assert reader.get('wiki') == 'https://wiki.example.com/'
+        with open(path, 'wb') as f:
+            f.write(b'garbage')
+        assert reader.get('wiki') == 'https://wiki.example.com/'
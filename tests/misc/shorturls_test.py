@@ -0,0 +1,336 @@
+from contextlib import contextmanager
+
+import mock
+import pytest
+
+from ocflib.misc.shorturls import add_shorturl
+from ocflib.misc.shorturls import delete_shorturl
+from ocflib.misc.shorturls import import_shorturls
+from ocflib.misc.shorturls import iter_shorturls
+from ocflib.misc.shorturls import rename_shorturl
+from ocflib.misc.shorturls import replace_shorturl
+from ocflib.misc.shorturls import resolve_shorturl
+from ocflib.misc.shorturls import search_shorturls
+from ocflib.misc.shorturls import ShorturlCache
+from tests.fixtures_test import FakeClock
+
+
+class FakeCursor:
+    """Just enough of a MySQL cursor on the ocfshorturls database."""
+
+    def __init__(self, shorturls):
+        self.shorturls = shorturls
+        self.queries = []
+        self.rowcount = 0
+        self._result = None
+
+    def execute(self, query, args=()):
+        self.queries.append(query)
+        if isinstance(args, str):
+            args = (args,)
+        rows = [{'slug': slug, 'target': target} for slug, target in sorted(self.shorturls.items())]
+        if query.startswith('SELECT `target`'):
+            slug, = args
+            self._result = [{'target': self.shorturls[slug]}] if slug in self.shorturls else []
+        elif 'IN (' in query:
+            self._result = [row for row in rows if row['slug'] in args]
+        elif 'LIMIT' in query:
+            *last, limit = args
+            self._result = [row for row in rows if not last or row['slug'] > last[0]][:limit]
+        elif query.startswith('SELECT `slug`, `target`'):
+            self._result = rows
+        elif query.startswith('INSERT'):
+            # affected rows as MySQL counts them: 1 for an insert, 2 for an
+            # update which changed the row, 0 for one which didn't
+            slug, target = args
+            if slug in self.shorturls and 'UPDATE `target`' not in query:
+                if 'ON DUPLICATE' not in query:
+                    raise AssertionError('duplicate slug: ' + slug)
+                self.rowcount = 0
+            else:
+                self.rowcount = 1 if slug not in self.shorturls else 2 if self.shorturls[slug] != target else 0
+                self.shorturls[slug] = target
+        elif query.startswith('DELETE'):
+            slug, = args
+            self.shorturls.pop(slug, None)
+        elif 'SET `slug`' in query:
+            new_slug, old_slug = args
+            self.shorturls[new_slug] = self.shorturls.pop(old_slug)
+        elif 'SET `target`' in query:
+            target, slug = args
+            self.shorturls[slug] = target
+        else:
+            raise AssertionError('unexpected query: ' + query)
+
+    def executemany(self, query, args):
+        self.queries.append(query)
+        rowcount = 0
+        for row in args:
+            self.execute(query, row)
+            self.queries.pop()
+            rowcount += self.rowcount
+        self.rowcount = rowcount
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return self._result
+
+
+@pytest.fixture
+def cursor():
+    return FakeCursor({'wiki': 'https://wiki.example.com/', 'docs': 'https://docs.example.com/'})
+
+
+@pytest.fixture
+def cache(cursor):
+    @contextmanager
+    def connect():
+        yield cursor
+
+    return ShorturlCache(size=3, ttl=300, negative_ttl=60, connect=connect, clock=FakeClock())
+
+
+class TestShorturlCache:
+
+    def test_hits_dont_query(self, cache, cursor):
+        for _ in range(3):
+            assert cache.get('wiki') == 'https://wiki.example.com/'
+        assert len(cursor.queries) == 1
+
+    def test_uses_given_cursor(self, cache):
+        other = FakeCursor({'wiki': 'https://other.example.com/'})
+        assert cache.get('wiki', ctx=other) == 'https://other.example.com/'
+        assert len(other.queries) == 1
+
+    def test_ttl(self, cache, cursor):
+        cache.get('wiki')
+        cache.clock.now += 299
+        cache.get('wiki')
+        assert len(cursor.queries) == 1
+        cache.clock.now += 1
+        cache.get('wiki')
+        assert len(cursor.queries) == 2
+
+    def test_negative_caching(self, cache, cursor):
+        assert cache.get('nope') is None
+        cache.clock.now += 59
+        assert cache.get('nope') is None
+        assert len(cursor.queries) == 1
+        cache.clock.now += 1
+        cache.get('nope')
+        assert len(cursor.queries) == 2
+
+    def test_bounded_size(self, cache, cursor):
+        for slug in ('wiki', 'docs', 'a', 'wiki', 'b'):
+            cache.get(slug)
+        assert len(cache) == 3
+
+        # docs was least recently used, so it was evicted
+        queries = len(cursor.queries)
+        cache.get('wiki')
+        assert len(cursor.queries) == queries
+        cache.get('docs')
+        assert len(cursor.queries) == queries + 1
+
+    def test_invalidate(self, cache, cursor):
+        cache.get('wiki')
+        cursor.shorturls['wiki'] = 'https://new.example.com/'
+        cache.invalidate('wiki')
+        assert cache.get('wiki') == 'https://new.example.com/'
+
+    def test_stale_fill_not_stored(self, cache, cursor):
+        def get_shorturl(ctx, slug):
+            # someone changes the shorturl while we're looking it up
+            cache.invalidate(slug)
+            return 'https://stale.example.com/'
+
+        with mock.patch('ocflib.misc.shorturls.get_shorturl', side_effect=get_shorturl):
+            assert cache.get('wiki') == 'https://stale.example.com/'
+        assert cache.get('wiki') == 'https://wiki.example.com/'
+
+    def test_reload(self, cache, cursor):
+        version = cache.version
+        assert cache.reload()
+        assert cache.version > version
+        assert len(cursor.queries) == 1
+        assert cache.get('wiki') == 'https://wiki.example.com/'
+        assert cache.get('docs') == 'https://docs.example.com/'
+        assert len(cursor.queries) == 1
+
+    def test_reload_retries_when_changed(self, cache, cursor):
+        rows = [{'slug': 'wiki', 'target': 'https://stale.example.com/'}]
+        fresh = [{'slug': 'wiki', 'target': 'https://wiki.example.com/'}]
+
+        def list_shorturls(ctx):
+            if list_shorturls.calls == 0:
+                cache.invalidate('wiki')
+            list_shorturls.calls += 1
+            return rows if list_shorturls.calls == 1 else fresh
+        list_shorturls.calls = 0
+
+        with mock.patch('ocflib.misc.shorturls.list_shorturls', side_effect=list_shorturls):
+            assert cache.reload()
+        assert cache.get('wiki') == 'https://wiki.example.com/'
+
+    def test_reload_gives_up(self, cache):
+        with mock.patch('ocflib.misc.shorturls.list_shorturls', side_effect=lambda ctx: cache.invalidate('x') or []):
+            assert not cache.reload(attempts=2)
+
+
+@pytest.yield_fixture
+def module_cache(cache):
+    with mock.patch('ocflib.misc.shorturls.shorturl_cache', cache):
+        yield cache
+
+
+class TestWriteThrough:
+
+    def test_add(self, module_cache, cursor):
+        assert resolve_shorturl('new') is None
+        add_shorturl(cursor, 'new', 'https://new.example.com/')
+        assert resolve_shorturl('new') == 'https://new.example.com/'
+
+    def test_delete(self, module_cache, cursor):
+        assert resolve_shorturl('wiki')
+        delete_shorturl(cursor, 'wiki')
+        assert resolve_shorturl('wiki') is None
+
+    def test_rename(self, module_cache, cursor):
+        assert resolve_shorturl('wiki')
+        assert resolve_shorturl('w') is None
+        rename_shorturl(cursor, 'wiki', 'w')
+        assert resolve_shorturl('wiki') is None
+        assert resolve_shorturl('w') == 'https://wiki.example.com/'
+
+    def test_replace(self, module_cache, cursor):
+        assert resolve_shorturl('wiki')
+        replace_shorturl(cursor, 'wiki', 'https://new.example.com/')
+        assert resolve_shorturl('wiki') == 'https://new.example.com/'
+
+
+class TestImportShorturls:
+
+    def test_skip(self, module_cache, cursor):
+        assert resolve_shorturl('new') is None
+        result = import_shorturls(cursor, [
+            ('new', 'https://new.example.com/'),
+            ('wiki', 'https://other.example.com/'),
+            ('bad slug', 'https://bad.example.com/'),
+            ('twice', 'https://1.example.com/'),
+            ('twice', 'https://2.example.com/'),
+            ('x' * 101, 'https://long.example.com/'),
+        ])
+        assert result.added == ['new']
+        assert result.replaced == []
+        assert set(result.conflicts) == {'wiki', 'bad slug', 'twice', 'x' * 101}
+        assert 'already exists' in result.conflicts['wiki']
+        assert 'illegal characters' in result.conflicts['bad slug']
+
+        assert cursor.shorturls['wiki'] == 'https://wiki.example.com/'
+        assert 'twice' not in cursor.shorturls
+        assert resolve_shorturl('new') == 'https://new.example.com/'
+
+    def test_replace(self, module_cache, cursor):
+        assert resolve_shorturl('wiki') == 'https://wiki.example.com/'
+        result = import_shorturls(cursor, [
+            ('new', 'https://new.example.com/'),
+            ('wiki', 'https://other.example.com/'),
+            ('docs', 'https://docs.example.com/'),
+        ], on_conflict='replace')
+        assert result.added == ['new']
+        assert result.replaced == ['wiki']
+        assert result.conflicts == {}
+        assert result.unchanged == ['docs']
+        assert resolve_shorturl('wiki') == 'https://other.example.com/'
+
+    def test_skip_unchanged(self, module_cache, cursor):
+        result = import_shorturls(cursor, [('docs', 'https://docs.example.com/')])
+        assert result == ([], [], {}, ['docs'])
+        assert not any(query.startswith('INSERT') for query in cursor.queries)
+
+    def test_skip_concurrently_added(self, module_cache, cursor):
+        executemany = cursor.executemany
+
+        def racing_executemany(query, args):
+            # someone else adds two of the slugs between our check and insert
+            cursor.shorturls['raced'] = 'https://theirs.example.com/'
+            cursor.shorturls['same'] = 'https://same.example.com/'
+            executemany(query, args)
+
+        with mock.patch.object(cursor, 'executemany', side_effect=racing_executemany):
+            result = import_shorturls(cursor, [
+                ('new', 'https://new.example.com/'),
+                ('raced', 'https://ours.example.com/'),
+                ('same', 'https://same.example.com/'),
+            ])
+        assert result.added == ['new', 'same']
+        assert result.conflicts == {'raced': 'already exists with target https://theirs.example.com/'}
+        assert cursor.shorturls['raced'] == 'https://theirs.example.com/'
+
+    def test_batches(self, module_cache, cursor):
+        pairs = [('slug{:03}'.format(i), 'https://example.com/{}'.format(i)) for i in range(12)]
+        with mock.patch('ocflib.misc.shorturls.BATCH_SIZE', 5), \
+                mock.patch.object(cursor, 'executemany', wraps=cursor.executemany) as executemany:
+            result = import_shorturls(cursor, pairs)
+        assert len(result.added) == 12
+        assert executemany.call_count == 3
+        assert sum(query.startswith('SELECT') for query in cursor.queries) == 3
+
+    def test_nothing_to_do(self, module_cache, cursor):
+        assert import_shorturls(cursor, []) == ([], [], {}, [])
+        assert not any(query.startswith('INSERT') for query in cursor.queries)
+
+    def test_invalid_mode(self, cursor):
+        with pytest.raises(ValueError):
+            import_shorturls(cursor, [], on_conflict='explode')
+
+
+def test_iter_shorturls(cursor):
+    cursor.shorturls.update(('slug{}'.format(i), 'https://example.com/{}'.format(i)) for i in range(5))
+    assert list(iter_shorturls(cursor, page_size=2)) == sorted(cursor.shorturls.items())
+    assert len(cursor.queries) == 4
+
+
+class TestSearchShorturls:
+
+    @pytest.fixture
+    def ctx(self):
+        ctx = mock.Mock()
+        ctx.fetchall.return_value = [
+            {'slug': 'slug{}'.format(i), 'target': 'https://example.com/{}'.format(i)}
+            for i in range(3)
+        ]
+        return ctx
+
+    def test_no_filters(self, ctx):
+        page = search_shorturls(ctx, limit=5)
+        assert page.shorturls == [('slug{}'.format(i), 'https://example.com/{}'.format(i)) for i in range(3)]
+        assert page.cursor is None
+
+        query, args = ctx.execute.call_args[0]
+        assert 'WHERE' not in query
+        assert query.endswith('ORDER BY `slug` LIMIT %s')
+        assert args == (6,)
+
+    def test_pagination(self, ctx):
+        page = search_shorturls(ctx, limit=2)
+        assert [slug for slug, _ in page.shorturls] == ['slug0', 'slug1']
+        assert page.cursor == 'slug1'
+
+        ctx.fetchall.return_value = ctx.fetchall.return_value[2:]
+        page = search_shorturls(ctx, limit=2, cursor=page.cursor)
+        assert [slug for slug, _ in page.shorturls] == ['slug2']
+        assert page.cursor is None
+        query, args = ctx.execute.call_args[0]
+        assert '`slug` > %s' in query
+        assert args == ('slug1', 3)
+
+    def test_filters(self, ctx):
+        search_shorturls(ctx, prefix='my_slug', target_domain='WWW.ocf.berkeley.edu', limit=10)
+        query, args = ctx.execute.call_args[0]
+        assert '`slug` LIKE %s' in query
+        assert '`target` LIKE' not in query
+        assert '`target_domain` = %s' in query
+        assert args == ('my\\_slug%', 'www.ocf.berkeley.edu', 11)
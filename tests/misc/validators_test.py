@@ -1,9 +1,13 @@
+import mock
 import pytest
 
+from ocflib.infra.resolver import CachingResolver
+from ocflib.infra.resolver import set_resolver
 from ocflib.misc.validators import email_host_exists
 from ocflib.misc.validators import host_exists
 from ocflib.misc.validators import valid_email
 from ocflib.misc.validators import valid_login_shell
+from ocflib.misc.validators import validate_emails
 
 
 REAL_HOSTS = [
@@ -77,3 +81,85 @@ def test_valid_email(email, valid):
 ])
 def test_valid_login_shell(shell, valid):
     assert valid_login_shell(shell) == valid
+
+
+@pytest.yield_fixture
+def stub_lookup():
+    lookup = mock.Mock(return_value=(('10 mx.berkeley.edu.',), 300))
+    old = set_resolver(CachingResolver(lookup=lookup))
+    try:
+        yield lookup
+    finally:
+        set_resolver(old)
+
+
+def test_valid_email_cached(stub_lookup):
+    for _ in range(5):
+        assert valid_email('ckuehl@example.com')
+        assert host_exists('example.com')
+    assert stub_lookup.call_args_list == [mock.call('example.com', 'MX'), mock.call('example.com', 'ANY')]
+
+
+@pytest.mark.parametrize('email', ['ckuehl@ocf.berkeley.edu', 'ckuehl@Berkeley.EDU'])
+def test_valid_email_known_domains(stub_lookup, email):
+    stub_lookup.return_value = ((), None)
+    assert valid_email(email)
+    assert not stub_lookup.called
+
+
+def test_valid_email_custom_known_domains(stub_lookup):
+    stub_lookup.return_value = ((), None)
+    assert valid_email('ckuehl@example.com', known_domains={'example.com'})
+    assert not valid_email('ckuehl@berkeley.edu', known_domains=frozenset())
+    stub_lookup.assert_called_once_with('berkeley.edu', 'MX')
+
+
+@pytest.mark.parametrize('email,valid', [
+    ('derp@langasdgkjsadhglkjbjgsdfgsd.com', True),
+    ('hello world@ocf.berkeley.edu', False),
+    ('', False),
+])
+def test_valid_email_syntax_only(stub_lookup, email, valid):
+    assert valid_email(email, check_dns=False) == valid
+    assert not stub_lookup.called
+
+
+def test_validate_emails():
+    def lookup(name, rdtype):
+        if name == 'timeout.com':
+            raise ValueError('timed out')
+        return {'example.com': (('10 mx.example.com.',), 300)}.get(name, ((), None))
+
+    lookup = mock.Mock(side_effect=lookup)
+    old = set_resolver(CachingResolver(lookup=lookup))
+    try:
+        results = validate_emails([
+            'ckuehl@example.com',
+            'jvperrin@example.com',
+            'mattmcal@Example.com',
+            'hello world@example.com',
+            'ckuehl@ocf.berkeley.edu',
+            'derp@www.ocf.berkeley.edu',
+            'derp@timeout.com',
+        ])
+        assert validate_emails(['derp@timeout.com', 'hello world@example.com'], check_dns=False) == {
+            'derp@timeout.com': True,
+            'hello world@example.com': False,
+        }
+    finally:
+        set_resolver(old)
+
+    assert isinstance(results.pop('derp@timeout.com'), ValueError)
+    assert results == {
+        'ckuehl@example.com': True,
+        'jvperrin@example.com': True,
+        'mattmcal@Example.com': True,
+        'hello world@example.com': False,
+        'ckuehl@ocf.berkeley.edu': True,
+        'derp@www.ocf.berkeley.edu': False,
+    }
+    assert sorted(lookup.call_args_list) == [
+        mock.call('example.com', 'MX'),
+        mock.call('timeout.com', 'MX'),
+        mock.call('www.ocf.berkeley.edu', 'MX'),
+    ]
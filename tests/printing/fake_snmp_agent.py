@@ -0,0 +1,270 @@
+"""A local stand-in for a printer's SNMP agent.
+
+FakeSNMPAgent answers SNMPv2c GET, GETNEXT, and GETBULK requests over UDP from
+an in-memory MIB, optionally with artificial latency and packet loss. It speaks
+just enough BER to be understood by real SNMP clients, so the printer functions
+can be exercised (and benchmarked, see tests-manual/printing/benchmark.py)
+without any real printers around.
+"""
+import random
+import socketserver
+import threading
+import time
+from bisect import bisect_right
+
+from ocflib.printing.printers import OID_LIFETIME_PAGES_PRINTED
+from ocflib.printing.printers import OID_MAINTKIT_CUR
+from ocflib.printing.printers import OID_MAINTKIT_MAX
+from ocflib.printing.printers import OID_STATUS
+from ocflib.printing.printers import OID_TONER_CUR
+from ocflib.printing.printers import OID_TONER_MAX
+from ocflib.printing.printers import OID_TRAY_CUR
+from ocflib.printing.printers import OID_TRAY_MAX
+from ocflib.printing.printers import OID_TRAY_NAME
+
+TAG_INTEGER = 0x02
+TAG_OCTET_STRING = 0x04
+TAG_NULL = 0x05
+TAG_OID = 0x06
+TAG_SEQUENCE = 0x30
+TAG_GET = 0xa0
+TAG_GETNEXT = 0xa1
+TAG_RESPONSE = 0xa2
+TAG_GETBULK = 0xa5
+TAG_NO_SUCH_OBJECT = 0x80
+TAG_END_OF_MIB_VIEW = 0x82
+
+
+def printer_mib(
+    toner=(500, 24000),
+    maintkit=(2000, 100000),
+    pages=500000,
+    trays=(('Tray 1', 100, 100), ('Tray 2', 250, 500), ('Tray 3', 0, 500)),
+    status=('Ready',),
+):
+    """Return a Printer-MIB table (dict of OID to value) for a fake printer.
+
+    :param trays: sequence of (name, cur, max) tuples
+    :param status: sequence of status strings shown on the display
+    """
+    mib = {
+        OID_TONER_CUR: toner[0],
+        OID_TONER_MAX: toner[1],
+        OID_MAINTKIT_CUR: maintkit[0],
+        OID_MAINTKIT_MAX: maintkit[1],
+        OID_LIFETIME_PAGES_PRINTED: pages,
+    }
+    for i, (name, cur, max_) in enumerate(trays, 1):
+        mib['{}.{}'.format(OID_TRAY_NAME, i)] = name
+        mib['{}.{}'.format(OID_TRAY_CUR, i)] = cur
+        mib['{}.{}'.format(OID_TRAY_MAX, i)] = max_
+    for i, line in enumerate(status, 1):
+        mib['{}.{}'.format(OID_STATUS, i)] = line
+    return mib
+
+
+def _oid_key(oid):
+    return tuple(int(arc) for arc in oid.strip('.').split('.'))
+
+
+def _tlv(tag, payload):
+    n = len(payload)
+    if n < 0x80:
+        length = bytes((n,))
+    else:
+        encoded = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+        length = bytes((0x80 | len(encoded),)) + encoded
+    return bytes((tag,)) + length + payload
+
+
+def _encode_int(n):
+    return _tlv(TAG_INTEGER, n.to_bytes((n.bit_length() + 8) // 8, 'big', signed=True))
+
+
+def _encode_oid(key):
+    out = bytearray((40 * key[0] + key[1],))
+    for arc in key[2:]:
+        chunk = [arc & 0x7f]
+        arc >>= 7
+        while arc:
+            chunk.append(0x80 | (arc & 0x7f))
+            arc >>= 7
+        out.extend(reversed(chunk))
+    return _tlv(TAG_OID, bytes(out))
+
+
+def _encode_value(value):
+    if isinstance(value, int):
+        return _encode_int(value)
+    if isinstance(value, str):
+        value = value.encode('utf8')
+    return _tlv(TAG_OCTET_STRING, value)
+
+
+def _decode(data, pos=0):
+    """Decode one TLV, returning (tag, value bytes, position after it)."""
+    tag = data[pos]
+    length = data[pos + 1]
+    pos += 2
+    if length & 0x80:
+        n = length & 0x7f
+        length = int.from_bytes(data[pos:pos + n], 'big')
+        pos += n
+    return tag, data[pos:pos + length], pos + length
+
+
+def _decode_all(data):
+    items, pos = [], 0
+    while pos < len(data):
+        tag, value, pos = _decode(data, pos)
+        items.append((tag, value))
+    return items
+
+
+def _decode_oid(value):
+    key = [value[0] // 40, value[0] % 40]
+    arc = 0
+    for byte in value[1:]:
+        arc = (arc << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            key.append(arc)
+            arc = 0
+    return tuple(key)
+
+
+class FakeSNMPAgent:
+    """SNMPv2c agent serving a fixed MIB on a local UDP port.
+
+    :param mib: dict mapping OID strings to int, str, or bytes values
+    :param latency: seconds to wait before answering each request
+    :param loss: probability of silently dropping a request
+    """
+
+    def __init__(self, mib, host='127.0.0.1', port=0, latency=0, loss=0, community='public', seed=None):
+        self.mib = {_oid_key(oid): value for oid, value in mib.items()}
+        self._keys = sorted(self.mib)
+        self.latency = latency
+        self.loss = loss
+        self.community = community.encode('ascii')
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._server = socketserver.ThreadingUDPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def _handler(self):
+        agent = self
+
+        class Handler(socketserver.BaseRequestHandler):
+
+            def handle(self):
+                data, sock = self.request
+                response = agent.respond(data)
+                if response is not None:
+                    sock.sendto(response, self.client_address)
+
+        return Handler
+
+    def _next(self, key):
+        i = bisect_right(self._keys, key)
+        if i < len(self._keys):
+            found = self._keys[i]
+            return _encode_oid(found) + _encode_value(self.mib[found])
+        return _encode_oid(key) + _tlv(TAG_END_OF_MIB_VIEW, b'')
+
+    def _get(self, key):
+        if key in self.mib:
+            return _encode_oid(key) + _encode_value(self.mib[key])
+        return _encode_oid(key) + _tlv(TAG_NO_SUCH_OBJECT, b'')
+
+    def _next_key(self, key):
+        i = bisect_right(self._keys, key)
+        return self._keys[i] if i < len(self._keys) else None
+
+    def respond(self, data):
+        """Return the response to a raw request, or None to drop it."""
+        self.requests += 1
+        if self._random.random() < self.loss:
+            return None
+        if self.latency:
+            time.sleep(self.latency)
+
+        tag, message, _ = _decode(data)
+        (_, version), (_, community), (pdu_tag, pdu) = _decode_all(message)
+        if community != self.community:
+            return None
+
+        (_, request_id), (_, arg1), (_, arg2), (_, varbinds) = _decode_all(pdu)
+        keys = [_decode_oid(_decode_all(varbind)[0][1]) for _, varbind in _decode_all(varbinds)]
+
+        if pdu_tag == TAG_GET:
+            answers = [self._get(key) for key in keys]
+        elif pdu_tag == TAG_GETNEXT:
+            answers = [self._next(key) for key in keys]
+        elif pdu_tag == TAG_GETBULK:
+            non_repeaters = int.from_bytes(arg1, 'big')
+            max_repetitions = int.from_bytes(arg2, 'big')
+            answers = [self._next(key) for key in keys[:non_repeaters]]
+            repeating = keys[non_repeaters:]
+            for _ in range(max_repetitions):
+                answers.extend(self._next(key) for key in repeating)
+                repeating = [self._next_key(key) or key for key in repeating]
+        else:
+            return None
+
+        return _tlv(TAG_SEQUENCE, b''.join((
+            _tlv(TAG_INTEGER, version),
+            _tlv(TAG_OCTET_STRING, community),
+            _tlv(TAG_RESPONSE, b''.join((
+                _tlv(TAG_INTEGER, request_id),
+                _encode_int(0),
+                _encode_int(0),
+                _tlv(TAG_SEQUENCE, b''.join(_tlv(TAG_SEQUENCE, answer) for answer in answers)),
+            ))),
+        )))
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            kwargs={'poll_interval': 0.05},
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def start_agents(mibs, **kwargs):
+    """Start one agent per MIB, all on the same port.
+
+    Agents listen on consecutive loopback addresses (127.0.0.1, 127.0.0.2, ...)
+    since printers are always polled on the same port.
+
+    :return: list of started FakeSNMPAgent objects
+    """
+    agents = []
+    port = 0
+    try:
+        for i, mib in enumerate(mibs, 1):
+            agent = FakeSNMPAgent(mib, host='127.0.0.{}'.format(i), port=port, **kwargs)
+            port = agent.address[1]
+            agents.append(agent.start())
+    except Exception:
+        for agent in agents:
+            agent.stop()
+        raise
+    return agents
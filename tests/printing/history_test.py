@@ -0,0 +1,73 @@
+from datetime import datetime
+from datetime import timedelta
+
+import mock
+
+from ocflib.printing.history import iter_jobs
+from ocflib.printing.history import iter_refunds
+from ocflib.printing.history import pages_by_hour
+from ocflib.printing.history import pages_by_printer
+from ocflib.printing.quota import add_job
+from ocflib.printing.quota import add_refund
+from tests.printing.quota_test import mysql_connection  # noqa
+from tests.printing.quota_test import TEST_JOB
+from tests.printing.quota_test import TEST_REFUND
+
+START = datetime(2019, 5, 6, 9)
+
+
+def test_keyset_pagination():
+    rows = [
+        dict(TEST_JOB._asdict(), id=i, time=START + timedelta(minutes=i // 2))
+        for i in range(5)
+    ]
+    c = mock.Mock()
+    c.fetchall.side_effect = [rows[0:2], rows[2:4], rows[4:5]]
+
+    jobs = list(iter_jobs(c, user='mattmcal', page_size=2))
+    assert [job.time for job in jobs] == [row['time'] for row in rows]
+
+    first, second, third = c.execute.call_args_list
+    assert 'OFFSET' not in first[0][0]
+    assert first[0][1] == ('mattmcal', 2)
+    assert second[0][1] == ('mattmcal', rows[1]['time'], rows[1]['time'], 1, 2)
+    assert third[0][1] == ('mattmcal', rows[3]['time'], rows[3]['time'], 3, 2)
+
+
+def add_jobs(c):
+    for i in range(7):
+        add_job(c, TEST_JOB._replace(
+            time=START + timedelta(hours=i % 3),
+            printer='logjam' if i % 2 else 'pagefault',
+            pages=i + 1,
+        ))
+    add_job(c, TEST_JOB._replace(user='ckuehl', time=START, pages=100))
+
+
+def test_iter_jobs(mysql_connection):  # noqa
+    add_jobs(mysql_connection)
+
+    jobs = list(iter_jobs(mysql_connection, user='mattmcal', page_size=2))
+    assert len(jobs) == 7
+    assert [job.time for job in jobs] == sorted(job.time for job in jobs)
+    assert sorted(job.pages for job in jobs) == list(range(1, 8))
+
+    assert {job.pages for job in iter_jobs(mysql_connection, printer='logjam', user='mattmcal')} == {2, 4, 6}
+    assert len(list(iter_jobs(mysql_connection, since=START + timedelta(hours=2)))) == 2
+    assert len(list(iter_jobs(mysql_connection, until=START + timedelta(hours=1)))) == 4
+
+
+def test_iter_refunds(mysql_connection):  # noqa
+    for i in range(3):
+        add_refund(mysql_connection, TEST_REFUND._replace(time=START + timedelta(days=i)))
+
+    refunds = list(iter_refunds(mysql_connection, user='mattmcal', since=START + timedelta(days=1)))
+    assert [refund.time for refund in refunds] == [START + timedelta(days=1), START + timedelta(days=2)]
+
+
+def test_aggregates(mysql_connection):  # noqa
+    add_jobs(mysql_connection)
+
+    assert pages_by_printer(mysql_connection, user='mattmcal') == {'logjam': 12, 'pagefault': 16}
+    assert pages_by_hour(mysql_connection) == {9: 112, 10: 7, 11: 9}
+    assert pages_by_hour(mysql_connection, printer='logjam', user='mattmcal') == {9: 4, 10: 2, 11: 6}
@@ -1,7 +1,10 @@
+import threading
+
 import mock
 import pytest
 
 from ocflib.printing.printers import _snmp
+from ocflib.printing.printers import CachedPrinterStatus
 from ocflib.printing.printers import get_lifetime_pages
 from ocflib.printing.printers import get_maintkit
 from ocflib.printing.printers import get_toner
@@ -10,6 +13,8 @@ from ocflib.printing.printers import OID_MAINTKIT_CUR
 from ocflib.printing.printers import OID_MAINTKIT_MAX
 from ocflib.printing.printers import OID_TONER_CUR
 from ocflib.printing.printers import OID_TONER_MAX
+from ocflib.printing.printers import PrinterSnapshot
+from ocflib.printing.printers import PrinterStatusCache
 
 
 class TestSNMP:
@@ -52,3 +57,96 @@ def test_get_maintkit(mock_snmp):
 
 def test_get_lifetime_pages(mock_snmp):
     assert get_lifetime_pages('pagefault') == 500000
+
+
+def fake_snapshot(printer, polled_at=1000):
+    return PrinterSnapshot(
+        printer=printer,
+        toner=(500, 24000),
+        trays=[('Tray 2', 250, 500)],
+        status=['Ready'],
+        pages=500000,
+        polled_at=polled_at,
+    )
+
+
+class TestPrinterStatusCache:
+
+    def test_never_polled(self):
+        cache = PrinterStatusCache(printers=('logjam',), poll=mock.Mock())
+        assert cache.get('logjam') == CachedPrinterStatus(snapshot=None, age=None, stale=True, error=None)
+
+    @mock.patch('ocflib.printing.printers.time.time', return_value=1030)
+    def test_refresh(self, _):
+        cache = PrinterStatusCache(printers=('logjam', 'pagefault'), poll=fake_snapshot)
+        cache.refresh()
+
+        assert cache.get_all() == {
+            printer: CachedPrinterStatus(snapshot=fake_snapshot(printer), age=30, stale=False, error=None)
+            for printer in ('logjam', 'pagefault')
+        }
+
+    @mock.patch('ocflib.printing.printers.time.time', return_value=1030)
+    def test_stale_after_missed_polls(self, _):
+        poll = mock.Mock(side_effect=fake_snapshot)
+        cache = PrinterStatusCache(printers=('logjam',), max_missed_polls=2, poll=poll)
+        cache.refresh()
+
+        poll.side_effect = IOError('printer is on fire')
+        cache.refresh()
+        status = cache.get('logjam')
+        assert status.snapshot == fake_snapshot('logjam')
+        assert not status.stale
+        assert status.error == 'printer is on fire'
+
+        cache.refresh()
+        status = cache.get('logjam')
+        assert status.snapshot == fake_snapshot('logjam')
+        assert status.stale
+
+        # a successful poll makes the printer fresh again
+        poll.side_effect = fake_snapshot
+        cache.refresh()
+        assert not cache.get('logjam').stale
+        assert cache.get('logjam').error is None
+
+    def test_malformed_values(self):
+        poll = mock.Mock(side_effect=ValueError("invalid literal for int() with base 10: b'abc'"))
+        cache = PrinterStatusCache(printers=('logjam',), max_missed_polls=1, poll=poll)
+        with mock.patch('ocflib.printing.printers.send_problem_report') as send_problem_report:
+            cache.refresh()
+
+        assert cache.get('logjam').stale
+        assert cache.get('logjam').error == "invalid literal for int() with base 10: b'abc'"
+        assert not send_problem_report.called
+
+    def test_unexpected_errors(self):
+        poll = mock.Mock(side_effect=[KeyError('toner'), fake_snapshot('pagefault')])
+        cache = PrinterStatusCache(printers=('logjam', 'pagefault'), max_missed_polls=1, poll=poll)
+        with mock.patch('ocflib.printing.printers.send_problem_report') as send_problem_report:
+            cache.refresh()
+
+        assert cache.get('logjam').stale
+        assert cache.get('logjam').error == "'toner'"
+        assert cache.get('pagefault').snapshot == fake_snapshot('pagefault')
+        report, = send_problem_report.call_args[0]
+        assert 'Unexpected error polling printer logjam' in report
+        assert 'KeyError' in report
+
+    def test_background_refresh(self):
+        polled = threading.Event()
+
+        def poll(printer):
+            polled.set()
+            return fake_snapshot(printer)
+
+        poll = mock.Mock(side_effect=poll)
+        cache = PrinterStatusCache(printers=('logjam',), interval=60, poll=poll)
+        cache.start()
+        try:
+            assert polled.wait(timeout=5)
+        finally:
+            cache.stop(timeout=5)
+
+        poll.assert_called_once_with('logjam')
+        assert cache.get('logjam').snapshot == fake_snapshot('logjam')
@@ -1,4 +1,5 @@
 import re
+from datetime import date
 from datetime import datetime
 from datetime import timedelta
 
@@ -10,10 +11,16 @@ from freezegun import freeze_time
 from ocflib.printing.quota import add_job
 from ocflib.printing.quota import add_refund
 from ocflib.printing.quota import daily_quota
+from ocflib.printing.quota import default_quota_calendar
 from ocflib.printing.quota import get_quota
 from ocflib.printing.quota import HAPPY_HOUR_QUOTA
 from ocflib.printing.quota import Job
+from ocflib.printing.quota import price_job
+from ocflib.printing.quota import QuotaCalendar
+from ocflib.printing.quota import QuotaOverride
+from ocflib.printing.quota import read_quota_calendar
 from ocflib.printing.quota import Refund
+from ocflib.printing.quota import release_job
 from ocflib.printing.quota import SEMESTERLY_QUOTA
 from ocflib.printing.quota import UserQuota
 from ocflib.printing.quota import WEEKDAY_QUOTA
@@ -68,6 +75,80 @@ def test_daily_quota(time, expected):
     assert daily_quota(time) == expected
 
 
+class TestQuotaCalendar:
+
+    def test_matches_daily_quota(self):
+        calendar = QuotaCalendar.for_semester(date(2019, 3, 1))
+        assert calendar.start == date(2019, 1, 1)
+        assert calendar.end == date(2019, 7, 31)
+
+        for day, quota in calendar.items():
+            assert quota == daily_quota(datetime.combine(day, datetime.min.time()))
+
+    def test_overrides(self):
+        calendar = QuotaCalendar(date(2019, 1, 1), date(2019, 1, 31), overrides=(
+            QuotaOverride(date(2019, 1, 10), date(2019, 1, 12), 50, 'dead week'),
+            {'start': date(2019, 1, 12), 'end': date(2019, 1, 12), 'quota': 0, 'reason': 'outage'},
+        ))
+        assert calendar.quota_on(date(2019, 1, 9)) == WEEKDAY_QUOTA
+        assert calendar.quota_on(date(2019, 1, 10)) == 50
+        assert calendar.quota_on(datetime(2019, 1, 11, 15, 30)) == 50
+        assert calendar.quota_on(date(2019, 1, 12)) == 0
+        assert calendar.quota_on(date(2019, 1, 13)) == WEEKEND_QUOTA
+
+    def test_outside_calendar(self):
+        calendar = QuotaCalendar(date(2019, 1, 1), date(2019, 1, 31))
+        assert calendar.quota_on(date(2019, 5, 6)) == HAPPY_HOUR_QUOTA
+
+    def test_invalid_range(self):
+        with pytest.raises(ValueError):
+            QuotaCalendar(date(2019, 1, 31), date(2019, 1, 1))
+
+    def test_read_quota_calendar(self, tmpdir):
+        config = tmpdir.join('quota.yaml')
+        config.write(
+            'overrides:\n'
+            '  - reason: Finals week\n'
+            '    start: 2019-12-09\n'
+            '    end: 2019-12-13\n'
+            '    quota: 40\n'
+        )
+        calendar = read_quota_calendar(date(2019, 10, 1), path=config.strpath)
+        assert calendar.start == date(2019, 8, 1)
+        assert calendar.quota_on(date(2019, 12, 10)) == 40
+        assert calendar.quota_on(date(2019, 12, 16)) == WEEKDAY_QUOTA
+
+    def test_override_without_reason(self):
+        calendar = QuotaCalendar(date(2019, 1, 1), date(2019, 1, 31), overrides=(
+            {'start': date(2019, 1, 10), 'end': date(2019, 1, 12), 'quota': 50},
+        ))
+        assert calendar.overrides[0].reason == ''
+        assert calendar.quota_on(date(2019, 1, 10)) == 50
+
+    @pytest.mark.parametrize('override', [
+        {'start': date(2019, 1, 10), 'quota': 50},
+        {'start': date(2019, 1, 10), 'end': date(2019, 1, 12), 'quota': 50, 'color': 5},
+    ])
+    def test_invalid_override(self, override):
+        with pytest.raises(ValueError):
+            QuotaCalendar(date(2019, 1, 1), date(2019, 1, 31), overrides=(override,))
+
+    def test_daily_quota_uses_config(self, tmpdir):
+        config = tmpdir.join('quota.yaml')
+        with mock.patch('ocflib.printing.quota.QUOTA_CONFIG', config.strpath):
+            assert daily_quota(date(2019, 12, 10)) == WEEKDAY_QUOTA
+            assert default_quota_calendar(date(2019, 12, 10)).overrides == ()
+
+            config.write(
+                'overrides:\n'
+                '  - start: 2019-12-09\n'
+                '    end: 2019-12-13\n'
+                '    quota: 40\n'
+            )
+            assert daily_quota(date(2019, 12, 10)) == 40
+            assert daily_quota(date(2019, 12, 16)) == WEEKDAY_QUOTA
+
+
 def test_quotas_are_sane():
     assert SEMESTERLY_QUOTA > 0
     assert WEEKDAY_QUOTA > 0
@@ -305,6 +386,92 @@ def test_several_jobs_refunds_previous_days_and_semesters(mysql_connection):
         assert_quota(mysql_connection, user, 17, 28)
 
 
+class TestPriceJob:
+
+    @pytest.fixture(autouse=True)
+    def fake_quota(self):
+        with mock.patch('ocflib.printing.quota.daily_quota', return_value=10), \
+                mock.patch('ocflib.printing.quota.SEMESTERLY_QUOTA', 100):
+            yield
+
+    def test_reserves_pages(self, mysql_connection):
+        price = price_job(mysql_connection, 'mattmcal', 4)
+        assert price.approved
+        assert price.quota.daily == 6
+
+        # the held pages count against the next job
+        assert not price_job(mysql_connection, 'mattmcal', 7).approved
+        assert price_job(mysql_connection, 'mattmcal', 6).approved
+        assert not price_job(mysql_connection, 'mattmcal', 1).approved
+
+    def test_add_job_releases_hold(self, mysql_connection):
+        assert price_job(mysql_connection, 'mattmcal', 8).approved
+        add_job(mysql_connection, TEST_JOB._replace(pages=8))
+
+        price = price_job(mysql_connection, 'mattmcal', 2)
+        assert price.approved
+        assert price.quota.daily == 0
+
+    def test_release_job(self, mysql_connection):
+        assert price_job(mysql_connection, 'mattmcal', 10).approved
+        assert not price_job(mysql_connection, 'mattmcal', 1).approved
+
+        release_job(mysql_connection, 'mattmcal', 10)
+        assert price_job(mysql_connection, 'mattmcal', 10).approved
+
+    def test_color(self, mysql_connection):
+        with mock.patch('ocflib.printing.quota.COLOR_QUOTA', 5):
+            assert not price_job(mysql_connection, 'mattmcal', 6, color=True).approved
+            assert price_job(mysql_connection, 'mattmcal', 5, color=True).approved
+            assert not price_job(mysql_connection, 'mattmcal', 1, color=True).approved
+            assert price_job(mysql_connection, 'mattmcal', 1).approved
+
+    def test_groups_are_never_approved(self, mysql_connection):
+        assert not price_job(mysql_connection, 'ggroup', 1).approved
+
+
+class TestTransactions:
+
+    @pytest.fixture(autouse=True)
+    def regular_user(self):
+        with mock.patch('ocflib.printing.quota.daily_quota', return_value=10), \
+                mock.patch('ocflib.printing.quota._special_quota', return_value=None):
+            yield
+
+    @pytest.fixture
+    def cursor(self):
+        c = mock.Mock()
+        c.connection.server_status = 0
+        c.fetchone.return_value = {'pages': 0, 'color': 0, 'today': 0, 'semester': 0}
+        c.rowcount = 1
+        return c
+
+    def test_price_job_in_one_transaction(self, cursor):
+        assert price_job(cursor, 'mattmcal', 4).approved
+
+        # the hold reset happens inside the transaction too
+        names = [name for name, _, _ in cursor.mock_calls]
+        assert names.index('connection.begin') < names.index('execute')
+        assert names[-1] == 'connection.commit'
+        assert 'INSERT INTO `quota_holds`' in cursor.execute.call_args_list[0][0][0]
+        assert not cursor.connection.rollback.called
+
+    def test_add_job_rolls_back_on_error(self, cursor):
+        cursor.execute.side_effect = [None, IOError('lost connection')]
+        with pytest.raises(IOError):
+            add_job(cursor, TEST_JOB)
+        assert cursor.connection.begin.called
+        assert cursor.connection.rollback.called
+        assert not cursor.connection.commit.called
+
+    def test_callers_transaction_is_left_open(self, cursor):
+        cursor.connection.server_status = 1  # SERVER_STATUS_IN_TRANS
+        assert price_job(cursor, 'mattmcal', 4).approved
+        add_job(cursor, TEST_JOB)
+        assert not cursor.connection.begin.called
+        assert not cursor.connection.commit.called
+
+
 @pytest.yield_fixture
 def mysql_connection(mysql_database):
     schema = pkg_resources.resource_string('ocflib.printing', 'ocfprinting.sql')
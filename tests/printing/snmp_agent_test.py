@@ -0,0 +1,88 @@
+import time
+
+import mock
+import pytest
+
+from ocflib.printing.printers import get_lifetime_pages
+from ocflib.printing.printers import get_maintkit
+from ocflib.printing.printers import get_paper_trays
+from ocflib.printing.printers import get_status
+from ocflib.printing.printers import get_toner
+from ocflib.printing.printers import OID_TONER_CUR
+from ocflib.printing.printers import OID_TONER_MAX
+from tests.printing.fake_snmp_agent import _encode_int
+from tests.printing.fake_snmp_agent import _encode_oid
+from tests.printing.fake_snmp_agent import _oid_key
+from tests.printing.fake_snmp_agent import _tlv
+from tests.printing.fake_snmp_agent import FakeSNMPAgent
+from tests.printing.fake_snmp_agent import printer_mib
+from tests.printing.fake_snmp_agent import start_agents
+from tests.printing.fake_snmp_agent import TAG_GET
+from tests.printing.fake_snmp_agent import TAG_NULL
+from tests.printing.fake_snmp_agent import TAG_OCTET_STRING
+from tests.printing.fake_snmp_agent import TAG_SEQUENCE
+
+
+@pytest.yield_fixture
+def snmp_agent():
+    with FakeSNMPAgent(printer_mib()) as agent, \
+            mock.patch('ocflib.printing.printers.SNMP_PORT', agent.address[1]):
+        yield agent
+
+
+def test_get_toner(snmp_agent):
+    assert get_toner('127.0.0.1') == (500, 24000)
+
+
+def test_get_maintkit(snmp_agent):
+    assert get_maintkit('127.0.0.1') == (2000, 100000)
+
+
+def test_get_lifetime_pages(snmp_agent):
+    assert get_lifetime_pages('127.0.0.1') == 500000
+
+
+def test_get_paper_trays(snmp_agent):
+    assert get_paper_trays('127.0.0.1') == [('Tray 2', 250, 500), ('Tray 3', 0, 500)]
+
+
+def test_get_status(snmp_agent):
+    assert get_status('127.0.0.1') == ['Ready']
+
+
+def test_missing_oid(snmp_agent):
+    snmp_agent.mib.pop(_oid_key(OID_TONER_MAX))
+    with pytest.raises(IOError):
+        get_toner('127.0.0.1')
+
+
+def test_latency():
+    with FakeSNMPAgent(printer_mib(), latency=0.05) as agent, \
+            mock.patch('ocflib.printing.printers.SNMP_PORT', agent.address[1]):
+        start = time.monotonic()
+        get_lifetime_pages('127.0.0.1')
+        assert time.monotonic() - start >= 0.05
+
+
+def test_wrong_community_is_ignored():
+    agent = FakeSNMPAgent(printer_mib(), community='private')
+    try:
+        request = _tlv(TAG_SEQUENCE, _encode_int(1) + _tlv(TAG_OCTET_STRING, b'public') + _tlv(
+            TAG_GET,
+            _encode_int(1) + _encode_int(0) + _encode_int(0) + _tlv(
+                TAG_SEQUENCE, _tlv(TAG_SEQUENCE, _encode_oid(_oid_key(OID_TONER_CUR)) + _tlv(TAG_NULL, b'')),
+            ),
+        ))
+        assert agent.respond(request) is None
+    finally:
+        agent._server.server_close()
+
+
+def test_start_agents():
+    agents = start_agents([printer_mib(pages=i) for i in range(3)])
+    try:
+        with mock.patch('ocflib.printing.printers.SNMP_PORT', agents[0].address[1]):
+            assert [get_lifetime_pages(agent.address[0]) for agent in agents] == [0, 1, 2]
+    finally:
+        for agent in agents:
+            agent.stop()
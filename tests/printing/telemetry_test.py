@@ -0,0 +1,125 @@
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+import mock
+import pytest
+
+from ocflib.printing.printers import PrinterSnapshot
+from ocflib.printing.telemetry import daily_pages
+from ocflib.printing.telemetry import depletion_rate
+from ocflib.printing.telemetry import forecast_days_until_empty
+from ocflib.printing.telemetry import pages_per_day
+from ocflib.printing.telemetry import Sample
+from ocflib.printing.telemetry import TelemetryRecorder
+
+START = datetime(2019, 5, 6, 12)
+
+
+def snapshot(printer, pages, toner, polled_at=START.timestamp()):
+    return PrinterSnapshot(
+        printer=printer,
+        toner=toner,
+        trays=[],
+        status=[],
+        pages=pages,
+        polled_at=polled_at,
+    )
+
+
+@pytest.fixture
+def ctx():
+    ctx = mock.Mock()
+    ctx.fetchall.side_effect = [
+        [{'printer': 'logjam', 'value': 1000}],
+        [{'printer': 'logjam', 'value': 500, 'max': 24000}],
+    ]
+    return ctx
+
+
+class TestTelemetryRecorder:
+
+    def test_skips_unchanged_values(self, ctx):
+        recorder = TelemetryRecorder()
+        assert recorder.record(ctx, [
+            snapshot('logjam', 1000, (500, 24000)),
+            snapshot('pagefault', 2000, (100, 24000)),
+            None,
+        ]) == (1, 1)
+
+        pages_call, toner_call = ctx.executemany.call_args_list
+        assert pages_call[0][1] == [(START, 'pagefault', 2000)]
+        assert toner_call[0][1] == [(START, 'pagefault', 100, 24000)]
+
+    def test_remembers_recorded_values(self, ctx):
+        recorder = TelemetryRecorder()
+        recorder.record(ctx, [snapshot('logjam', 1010, (490, 24000))])
+        assert ctx.executemany.call_count == 2
+
+        # nothing changed, so nothing should be written (or read) again
+        assert recorder.record(ctx, [snapshot('logjam', 1010, (490, 24000))]) == (0, 0)
+        assert ctx.executemany.call_count == 2
+        assert ctx.fetchall.call_count == 2
+
+
+def test_daily_pages():
+    samples = [
+        Sample(START, 100),
+        Sample(START + timedelta(hours=4), 150),
+        Sample(START + timedelta(days=1), 170),
+        Sample(START + timedelta(days=3), 200),
+    ]
+    assert daily_pages(samples) == {
+        date(2019, 5, 6): 50,
+        date(2019, 5, 7): 20,
+        date(2019, 5, 8): 0,
+        date(2019, 5, 9): 30,
+    }
+    assert daily_pages([]) == {}
+
+
+def test_daily_pages_baseline():
+    samples = [Sample(START, 100), Sample(START + timedelta(hours=4), 150)]
+    assert daily_pages(samples, baseline=90) == {date(2019, 5, 6): 60}
+    assert daily_pages([Sample(START, 100)]) == {date(2019, 5, 6): 0}
+
+
+def test_pages_per_day():
+    ctx = mock.Mock()
+    ctx.fetchone.return_value = {'date': START - timedelta(days=2), 'value': 80}
+    ctx.fetchall.return_value = [
+        {'date': START, 'value': 100},
+        {'date': START + timedelta(days=1), 'value': 130},
+    ]
+    assert pages_per_day(ctx, 'logjam', since=date(2019, 5, 6)) == {
+        date(2019, 5, 6): 20,
+        date(2019, 5, 7): 30,
+    }
+    query, args = ctx.execute.call_args_list[0][0]
+    assert '`date` < %s' in query
+    assert args == ('logjam', date(2019, 5, 6))
+
+
+class TestDepletion:
+
+    def test_linear_usage(self):
+        samples = [Sample(START + timedelta(days=i), 1000 - 100 * i) for i in range(5)]
+        assert depletion_rate(samples) == pytest.approx(100)
+        assert forecast_days_until_empty(samples) == pytest.approx(6)
+
+    def test_ignores_previous_cartridge(self):
+        samples = [
+            Sample(START, 100),
+            Sample(START + timedelta(days=1), 10),
+            Sample(START + timedelta(days=2), 1000),
+            Sample(START + timedelta(days=3), 950),
+        ]
+        assert depletion_rate(samples) == pytest.approx(50)
+
+    @pytest.mark.parametrize('samples', [
+        [],
+        [Sample(START, 100)],
+        [Sample(START, 100), Sample(START + timedelta(days=1), 100)],
+    ])
+    def test_no_forecast(self, samples):
+        assert forecast_days_until_empty(samples) is None